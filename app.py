@@ -4,15 +4,34 @@ Vishnu by Valkyrie
 Discord bot that handles dice rolling and other things
 """
 
-import yaml
+import sys
+from modules.startup import timeline, ImportTimer, warm
+
+# python3 app.py --profile-imports times every import from here on.
+import_timer = None
+if '--profile-imports' in sys.argv:
+    import_timer = ImportTimer()
+    import_timer.install()
+
 import modules.pgsql as pgsql
+from modules.groupindex import GroupIndex
+from modules.config import config
+from modules.checks import role_whitelisted
+from modules.metrics import metrics
+from modules.scheduler import ReminderScheduler
+from modules.provision import RouteLimiter
+from modules.archive import Archiver
+from modules.coordination import Coordinator
+import os
+import signal
+import asyncio
+import importlib
 import traceback
 from discord.ext import commands
 
-config = yaml.safe_load(open("config.yaml"))
-guild_id = config['guild_id']
+timeline.mark("Imported modules")
+
 token = config['token']
-role_whitelist = " ".join(config['role_whitelist'])
 
 description = """
 Vishnu, a multipurpose D&D bot. Having issues? Create a bug report here:
@@ -22,13 +41,60 @@ https://github.com/r3valkyrie/vishnu/issues/new?assignees=&labels=&template=bug_
 
 
 extensions = ['cogs.groupmanagement',
-              'cogs.questmanagement']
+              'cogs.questmanagement',
+              'cogs.configuration',
+              'cogs.dice',
+              'cogs.stats']
+
+# Imports the cogs only make on first use, warmed up once the bot is
+# ready.
+DEFERRED_IMPORTS = ['modules.dice',
+                    'modules.odds',
+                    'modules.questfile']
+
+sharding = config.get('sharding') or {}
+
+if 'VISHNU_SHARD_COUNT' in os.environ:
+    # Started by launcher.py, which hands each process a range of shards.
+    bot = commands.AutoShardedBot(
+        command_prefix='!',
+        description=description,
+        shard_count=int(os.environ['VISHNU_SHARD_COUNT']),
+        shard_ids=[int(shard) for shard in
+                   os.environ['VISHNU_SHARD_IDS'].split(',')])
+elif sharding.get('enabled'):
+    # Every shard in this process; Discord picks the count if it's unset.
+    bot = commands.AutoShardedBot(command_prefix='!',
+                                  description=description,
+                                  shard_count=sharding.get('shard_count'))
+else:
+    bot = commands.Bot(command_prefix='!', description=description)
+
+# One connection pool for the whole bot, shared by every cog.
+bot.pg = pgsql.pgSQLManagement()
 
-bot = commands.Bot(command_prefix='!', description=description)
+# Keeps the caches and jobs of the other bot processes in step.
+bot.coordinator = Coordinator(bot.pg)
+
+# Discord objects of every group, by ID.
+bot.groups = GroupIndex()
+
+# Reminders before each group's session.
+bot.reminders = ReminderScheduler(bot)
+
+# Paces the Discord calls of every cog per rate-limit route.
+bot.limiter = RouteLimiter()
+
+# Moves groups whose sessions are long over out of the way.
+bot.archiver = Archiver(bot)
+
+# Time every command and database call.
+metrics.instrument(bot.pg)
+metrics.install(bot)
 
 
 @bot.command()
-@commands.has_any_role(role_whitelist)
+@role_whitelisted()
 async def load(ctx, extension_name: str):
     """
     Loads an extension
@@ -40,7 +106,21 @@ async def load(ctx, extension_name: str):
 
     await ctx.send("{} loaded".format(extension_name))
 
-if __name__ == '__main__':
+
+def import_extensions():
+    """
+    Imports the modules of the extensions. Runs in a thread while the bot
+    connects, so load_extensions() finds them imported already.
+    """
+    for extension in extensions:
+        try:
+            importlib.import_module(extension)
+        except Exception:
+            # load_extensions() reports it.
+            pass
+
+
+def load_extensions():
     for extension in extensions:
         try:
             bot.load_extension(extension)
@@ -49,13 +129,118 @@ if __name__ == '__main__':
             traceback.print_exc()
 
 
+def member_id(guild_id, name):
+    """
+    Returns the ID of the member of a guild called name, or None.
+    """
+    guild = bot.get_guild(guild_id)
+    member = guild.get_member_named(name) if guild is not None else None
+    return member.id if member is not None else None
+
+
 @bot.event
 async def on_ready():
-    # Create PostgreSQL tables.
-    pg = pgsql.pgSQLManagement()
-    async for guild in bot.fetch_guilds():
-        await pg.create_tables(guild.id)
+    timeline.mark(f"Ready with {len(bot.guilds)} guild(s)")
+
+    # Create or migrate PostgreSQL tables for guilds that aren't current.
+    migrated = await bot.pg.bootstrap([guild.id for guild in bot.guilds])
+
+    print(f"Migrated {migrated} guild(s)")
+    timeline.mark("Migrated guilds")
+
+    # Older groups list their members by name; move them to group_members.
+    moved = await bot.pg.migrate_group_members(
+        [guild.id for guild in bot.guilds], member_id)
+    if moved:
+        print(f"Moved {moved} group member(s) to group_members")
+
+    await config.load_guilds(bot.pg, [guild.id for guild in bot.guilds])
+    bot.loop.create_task(config.watch())
+    timeline.mark("Loaded guild config")
 
+    await bot.groups.load(bot)
+    print(f"Indexed {len(bot.groups)} group(s)")
+    timeline.mark("Indexed groups")
+
+    await bot.reminders.load()
+    bot.reminders.start()
+    print(f"Scheduled reminders for {len(bot.reminders)} session(s)")
+    timeline.mark("Scheduled reminders")
+
+    bot.archiver.start()
     print(f"Logged in as {bot.user.name}")
 
-bot.run(token, bot=True, reconnect=True)
+    # Only the first on_ready is startup; later ones are reconnects.
+    if not timeline.finished:
+        print(f"Startup timeline:\n{timeline.finish()}")
+        if import_timer is not None:
+            print(import_timer.report())
+        warm(bot.loop, DEFERRED_IMPORTS)
+
+
+@bot.event
+async def on_guild_join(guild):
+    await bot.pg.create_tables(guild.id)
+    await config.load_guilds(bot.pg, [guild.id])
+
+
+async def start():
+    """
+    Connects to PostgreSQL and Discord. The extensions are imported in
+    the meantime, and loaded while the gateway connects.
+    """
+
+    imported = bot.loop.run_in_executor(None, import_extensions)
+
+    await asyncio.gather(bot.pg.connect(), bot.login(token, bot=True))
+    timeline.mark("Connected to PostgreSQL and logged in")
+
+    # New quests and groups would take the IDs of the ones in the old
+    # tables, which then couldn't be copied.
+    if await bot.pg.legacy_tables_pending():
+        raise SystemExit("Found tables of the old table-per-guild layout. "
+                         "Run python3 migrate.py before starting the bot.")
+
+    await bot.coordinator.connect()
+
+    metrics_config = config.get('metrics') or {}
+    if metrics_config.get('port'):
+        # Processes started by launcher.py each take the next port.
+        await metrics.serve(
+            metrics_config.get('host', '127.0.0.1'),
+            metrics_config['port'] + int(os.environ.get('VISHNU_PROCESS', 0)))
+
+    gateway = asyncio.ensure_future(bot.connect(reconnect=True))
+
+    await imported
+    load_extensions()
+    timeline.mark(f"Loaded {len(bot.extensions)} extension(s)")
+
+    await gateway
+
+
+def main():
+    loop = bot.loop
+    for name in ('SIGINT', 'SIGTERM'):
+        try:
+            loop.add_signal_handler(getattr(signal, name), loop.stop)
+        except NotImplementedError:
+            # Windows
+            pass
+
+    future = asyncio.ensure_future(start(), loop=loop)
+    future.add_done_callback(lambda future: loop.stop())
+
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(bot.logout())
+        loop.run_until_complete(bot.coordinator.close())
+        loop.run_until_complete(bot.pg.close())
+
+    if future.done() and not future.cancelled():
+        future.result()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,751 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for vishnu's commands.
+
+python3 benchmark.py [--backend memory|postgres] [--output FILE]
+                     [--compare FILE] [--discord-latency SECONDS]
+                     [--route-interval SECONDS] [SCENARIO ...]
+
+Runs the group and quest commands against fake Discord objects, with
+either the PostgreSQL database from config.yaml or an in-process
+stand-in, and reports per-command latency (p50/p99), database round
+trips and memory allocated. Each scenario runs twice: once for timing
+and once under tracemalloc, which slows everything down.
+
+The postgres backend uses throwaway guild IDs and deletes their rows
+afterwards. The memory backend measures the commands themselves, with
+the database reduced to a dictionary lookup.
+
+--output stores the results as JSON; --compare prints them next to the
+results of an earlier run, so two revisions can be compared.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import datetime
+import argparse
+import itertools
+import subprocess
+import tracemalloc
+import numpy as np
+from modules.config import config
+from modules.groupindex import GroupIndex
+from modules.metrics import CountedConnection
+from modules.provision import RouteLimiter
+from modules.scheduler import ReminderScheduler
+import modules.pgsql as pgsql
+import modules.filters as filters
+
+# Guild IDs far outside the range Discord hands out.
+BENCHMARK_GUILD = 9000000000000000000
+
+ids = itertools.count(1000000)
+
+
+class FakeObject:
+    """
+    A Discord role, channel or message. Every API call on it waits for
+    the simulated Discord latency.
+    """
+
+    def __init__(self, guild, name=None):
+        self.id = next(ids)
+        self.guild = guild
+        self.name = name
+
+    async def delete(self, reason=None):
+        await self.guild.api()
+        self.guild.objects.pop(self.id, None)
+
+    async def add_reaction(self, emoji):
+        await self.guild.api()
+
+    async def remove_reaction(self, emoji, member):
+        await self.guild.api()
+
+    async def clear_reactions(self):
+        await self.guild.api()
+
+    async def edit(self, **kwargs):
+        await self.guild.api()
+
+    async def send(self, content=None, embed=None):
+        await self.guild.api()
+        return FakeObject(self.guild)
+
+
+class FakeMember:
+    def __init__(self, guild, name):
+        self.id = next(ids)
+        self.guild = guild
+        self.name = name
+        self.bot = False
+        self.roles = []
+        self.mention = "<@{}>".format(self.id)
+
+    def __str__(self):
+        return "{}#0001".format(self.name)
+
+    async def add_roles(self, *roles, reason=None):
+        await self.guild.api()
+        self.roles.extend(roles)
+
+    async def remove_roles(self, *roles, reason=None):
+        await self.guild.api()
+        self.roles = [role for role in self.roles if role not in roles]
+
+
+class FakeGuild:
+    """
+    A guild with the announcement channel and group category its config
+    points at.
+    """
+
+    def __init__(self, guild_id, latency):
+        self.id = guild_id
+        self.latency = latency
+        self.objects = {}
+        self.members = {}
+        self.default_role = self.add(FakeObject(self, "@everyone"))
+
+        for option in ('group_category', 'announce_chan'):
+            channel = FakeObject(self, option)
+            channel.id = config.option(guild_id, option)
+            self.add(channel)
+
+    async def api(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def add(self, created):
+        self.objects[created.id] = created
+        return created
+
+    def member(self, name):
+        member = FakeMember(self, name)
+        self.members[member.id] = member
+        return member
+
+    def get_role(self, role_id):
+        return self.objects.get(role_id)
+
+    def get_channel(self, channel_id):
+        return self.objects.get(channel_id)
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    async def create_role(self, name=None, **kwargs):
+        await self.api()
+        return self.add(FakeObject(self, name))
+
+    async def create_text_channel(self, name, **kwargs):
+        await self.api()
+        return self.add(FakeObject(self, name))
+
+    async def create_voice_channel(self, name, **kwargs):
+        await self.api()
+        return self.add(FakeObject(self, name))
+
+
+class FakeBot:
+    def __init__(self, pg):
+        self.pg = pg
+        self.groups = GroupIndex()
+        self.reminders = ReminderScheduler(self)
+        self.loop = asyncio.get_event_loop()
+        self.user = FakeMember(None, "vishnu")
+        self.guilds = []
+
+    def get_guild(self, guild_id):
+        for guild in self.guilds:
+            if guild.id == guild_id:
+                return guild
+        return None
+
+    async def wait_for(self, event, check=None, timeout=None):
+        # Nobody presses the paginator's arrows.
+        raise asyncio.TimeoutError
+
+
+class FakeContext:
+    def __init__(self, bot, guild, author, channel=None):
+        self.bot = bot
+        self.guild = guild
+        self.author = author
+        self.channel = channel or guild.get_channel(
+            config.option(guild.id, 'announce_chan'))
+        self.message = FakeObject(guild)
+        self.message.channel = self.channel
+
+    async def send(self, content=None, embed=None):
+        await self.guild.api()
+        return FakeObject(self.guild)
+
+
+class CountedAcquire:
+    def __init__(self, context, pg):
+        self._context = context
+        self._pg = pg
+
+    async def __aenter__(self):
+        return CountedConnection(await self._context.__aenter__(),
+                                 self._pg.count_round_trip)
+
+    async def __aexit__(self, *exc):
+        return await self._context.__aexit__(*exc)
+
+
+class PostgresBackend(pgsql.pgSQLManagement):
+    """
+    The real database, with every statement counted.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.round_trips = 0
+
+    def acquire(self):
+        return CountedAcquire(super().acquire(), self)
+
+    def count_round_trip(self):
+        self.round_trips += 1
+
+    async def setup(self):
+        await self.connect()
+        await self.migrate_shared_tables()
+
+    async def add_guild(self, guild_id):
+        await self.create_tables(guild_id)
+
+    async def seed_quests(self, guild_id, rows):
+        async with self.acquire() as conn:
+            await conn.copy_records_to_table(
+                'quests',
+                records=[(guild_id, tier, description, creator, False)
+                         for tier, description, creator in rows],
+                columns=['guild_id', 'tier', 'description', 'creator',
+                         'completed'])
+        self.cache.invalidate('quests', guild_id)
+
+    async def remove_guild(self, guild_id):
+        async with self.acquire() as conn:
+            for table in pgsql.SHARED_TABLES:
+                await conn.execute(
+                    "DELETE FROM {} WHERE guild_id = $1".format(table),
+                    guild_id)
+            await conn.execute("DELETE FROM schema_version WHERE scope = $1",
+                               "guild:{}".format(guild_id))
+
+
+def matches(row, predicate):
+    """
+    Evaluates one filter predicate against a MemoryBackend row.
+    """
+
+    column, op, value = predicate
+    if op == 'open':
+        return row['member_count'] < row['max_users']
+    if op == 'full':
+        return row['member_count'] >= row['max_users']
+    if op == 'any':
+        return row[column] in value
+    if op == 'member':
+        return value in row['members']
+    if op == 'between':
+        return value[0] <= row[column] <= value[1]
+    if op == '>=':
+        return row[column] >= value
+    if op == '<=':
+        return row[column] <= value
+    return row[column] == value
+
+
+class MemoryBackend(pgsql.pgSQLManagement):
+    """
+    Stands in for the database with dictionaries. Implements the methods
+    the cogs call; each one counts as a round trip. The result cache is
+    the real one.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.round_trips = 0
+        self.quests = {}
+        self.groups = {}
+        self.serial = itertools.count(1)
+
+    async def setup(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def add_guild(self, guild_id):
+        self.quests[guild_id] = {}
+        self.groups[guild_id] = {}
+
+    async def remove_guild(self, guild_id):
+        self.quests.pop(guild_id, None)
+        self.groups.pop(guild_id, None)
+
+    async def seed_quests(self, guild_id, rows):
+        self.round_trips += 1
+        for tier, description, creator in rows:
+            quest_id = next(self.serial)
+            self.quests[guild_id][quest_id] = {
+                'id': quest_id, 'tier': tier, 'description': description,
+                'creator': creator, 'completed': False}
+        self.cache.invalidate('quests', guild_id)
+
+    async def import_quest_data(self, guild_id, quest_tier, quest_desc,
+                                creator):
+        await self.seed_quests(guild_id, [(quest_tier, quest_desc, creator)])
+
+    async def complete_quest(self, guild_id, quest_id, completion):
+        self.round_trips += 1
+        quest = self.quests[guild_id].get(int(quest_id))
+        if quest is not None:
+            quest['completed'] = completion
+        self.cache.invalidate('quests', guild_id)
+
+    async def delete_quest(self, guild_id, quest_id):
+        self.round_trips += 1
+        self.quests[guild_id].pop(int(quest_id), None)
+        self.cache.invalidate('quests', guild_id)
+
+    async def import_group_data(self, guild_id, creator, start_date,
+                                max_users, group_notes="None"):
+        self.round_trips += 1
+        group_id = next(self.serial)
+        self.groups[guild_id][group_id] = {
+            'id': group_id, 'creator': creator,
+            'start_date': datetime.datetime.strptime(start_date,
+                                                     '%Y-%m-%d').date(),
+            'max_users': int(max_users), 'member_count': 0,
+            'notes': group_notes, 'members': [],
+            'announce_message_id': None}
+        self.cache.invalidate('groups', guild_id)
+        return group_id
+
+    async def set_group_objects(self, guild_id, group_id, role_id,
+                                text_channel_id, voice_channel_id,
+                                announce_message_id):
+        self.round_trips += 1
+        group = self.groups[guild_id][int(group_id)]
+        group['announce_message_id'] = announce_message_id
+
+    async def delete_group(self, guild_id, group_id):
+        self.round_trips += 1
+        self.groups[guild_id].pop(int(group_id), None)
+        self.cache.invalidate('groups', guild_id)
+
+    async def retrieve_group_info(self, guild_id, group_id):
+        self.round_trips += 1
+        group = self.groups[guild_id].get(int(group_id))
+        if group is None:
+            return []
+        return [(group['id'], group['max_users'], group['member_count'],
+                 group['creator'])]
+
+    async def join_group(self, guild_id, group_id, user_id):
+        self.round_trips += 1
+        group = self.groups[guild_id].get(int(group_id))
+        if group is None:
+            return None
+
+        is_member = user_id in group['members']
+        joined = (not is_member and
+                  group['member_count'] < group['max_users'])
+        if joined:
+            group['members'].append(user_id)
+            group['member_count'] += 1
+            self.cache.invalidate('groups', guild_id)
+
+        return {'joined': joined, 'is_member': is_member,
+                'member_count': group['member_count'],
+                'max_users': group['max_users']}
+
+    async def search_quests(self, guild_id, text, limit=10):
+        self.round_trips += 1
+
+        words = text.lower().split()
+        return [(quest['id'], quest['tier'], quest['creator'],
+                 quest['description'])
+                for quest in self.quests[guild_id].values()
+                if not quest['completed'] and
+                all(word in quest['description'].lower()
+                    for word in words)][:limit]
+
+    async def _retrieve_list(self, guild_id, list_filter, after=None,
+                             before=None, limit=None):
+        self.round_trips += 1
+
+        table = list_filter.table
+        if table == 'quests':
+            rows = [quest for quest in self.quests[guild_id].values()
+                    if not quest['completed']]
+        else:
+            rows = list(self.groups[guild_id].values())
+
+        for predicate in list_filter.predicates:
+            rows = [row for row in rows if matches(row, predicate)]
+
+        sort = filters.FIELDS[table][list_filter.sort].column
+
+        def key(row):
+            if sort == 'id':
+                return row['id']
+            return (row[sort], row['id'])
+
+        descending = list_filter.descending
+        rows.sort(key=key, reverse=descending != (before is not None))
+        if before is not None:
+            rows = [row for row in rows
+                    if (key(row) > before if descending else
+                        key(row) < before)]
+        elif after is not None:
+            rows = [row for row in rows
+                    if (key(row) < after if descending else
+                        key(row) > after)]
+        rows = rows[:limit]
+        if before is not None:
+            rows.reverse()
+
+        if table == 'quests':
+            return [(row['id'], row['tier'], row['creator'],
+                     row['description']) for row in rows]
+        return [(row['id'], row['creator'], row['start_date'],
+                 "{}/{}".format(row['member_count'], row['max_users']),
+                 row['notes']) for row in rows]
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'postgres': PostgresBackend,
+}
+
+
+class Harness:
+    """
+    A fake bot with the group and quest cogs loaded against one backend.
+    """
+
+    def __init__(self, pg, latency, route_interval):
+        self.pg = pg
+        self.latency = latency
+        self.route_interval = route_interval
+        self.guild_ids = itertools.count(BENCHMARK_GUILD)
+        self.reset()
+
+    def reset(self):
+        """
+        Starts over with a new bot and cogs.
+        """
+
+        from cogs.groupmanagement import GroupManagement
+        from cogs.questmanagement import QuestManagement
+
+        self.bot = FakeBot(self.pg)
+        self.bot.limiter = RouteLimiter(interval=self.route_interval)
+        self.group_cog = GroupManagement(self.bot)
+        self.quest_cog = QuestManagement(self.bot)
+
+    async def guild(self):
+        guild = FakeGuild(next(self.guild_ids), self.latency)
+        self.bot.guilds.append(guild)
+        await self.pg.add_guild(guild.id)
+        return guild
+
+    async def cleanup(self):
+        for guild in self.bot.guilds:
+            await self.pg.remove_guild(guild.id)
+        self.pg.cache.clear()
+        self.pg.pages.clear()
+        self.reset()
+
+    def context(self, guild, author):
+        return FakeContext(self.bot, guild, author)
+
+    async def invoke(self, cog, command, ctx, *args, **kwargs):
+        """
+        Runs a command's body, without its checks.
+        """
+
+        await getattr(cog, command).callback(cog, ctx, *args, **kwargs)
+
+
+# Words the questsearch descriptions are made of.
+QUEST_WORDS = ['dragon', 'goblin', 'lich', 'necromancer', 'hag', 'troll',
+               'bandit', 'cult', 'horde', 'pack', 'king', 'queen', 'ruins',
+               'swamp', 'keep']
+
+
+def search_description(number):
+    """
+    The description of the numberth questsearch quest.
+    """
+
+    return "Defeat the {} {} near the {}".format(
+        QUEST_WORDS[number % 7], QUEST_WORDS[7 + number % 5],
+        QUEST_WORDS[12 + number % 3])
+
+
+async def quest_guild(harness, description, count=10000):
+    """
+    Returns a new guild with count quests, spread over its tiers and 50
+    creators, and the context of a player in it. description(number)
+    describes each quest.
+    """
+
+    guild = await harness.guild()
+    tiers = config.option(guild.id, 'quest_tiers')
+    await harness.pg.seed_quests(guild.id, [
+        (tiers[number % len(tiers)],
+         description(number),
+         "dm{}#0001".format(number % 50))
+        for number in range(count)])
+
+    return guild, harness.context(guild, guild.member("player"))
+
+
+async def questlist(harness, iterations):
+    """
+    questlist over 10k quests: unfiltered, by tier and by creator, each
+    with a cold cache.
+    """
+
+    guild, ctx = await quest_guild(harness, "Quest number {}".format)
+    tiers = config.option(guild.id, 'quest_tiers')
+    arguments = [(), ("tier={}".format(tiers[0]),), ("creator=dm7#0001",)]
+
+    async def run(number):
+        harness.pg.cache.clear()
+        harness.pg.pages.clear()
+        await harness.invoke(harness.quest_cog, 'questlist', ctx,
+                             *arguments[number % len(arguments)])
+
+    return [run(number) for number in range(iterations)], 1
+
+
+async def questlist_cached(harness, iterations):
+    """
+    The questlist scenario without clearing the caches, with a quest
+    added every 20 lists.
+    """
+
+    guild, ctx = await quest_guild(harness, "Quest number {}".format)
+    tiers = config.option(guild.id, 'quest_tiers')
+    arguments = [(), ("tier={}".format(tiers[0]),), ("creator=dm7#0001",)]
+
+    async def run(number):
+        if number % 20 == 19:
+            await harness.pg.seed_quests(guild.id, [
+                (tiers[0], "Quest number {}".format(10000 + number),
+                 "dm7#0001")])
+        await harness.invoke(harness.quest_cog, 'questlist', ctx,
+                             *arguments[number % len(arguments)])
+
+    return [run(number) for number in range(iterations)], 1
+
+
+async def questsearch(harness, iterations):
+    """
+    questsearch over 10k quests: a common word, two words, and a typo
+    that only the trigram fallback matches, each with a cold cache.
+    """
+
+    guild, ctx = await quest_guild(harness, search_description)
+    searches = ["dragon", "goblin cult", "necromancre"]
+
+    async def run(number):
+        harness.pg.cache.clear()
+        await harness.invoke(harness.quest_cog, 'questsearch', ctx,
+                             text=searches[number % len(searches)])
+
+    return [run(number) for number in range(iterations)], 1
+
+
+async def groupjoin(harness, iterations):
+    """
+    iterations members running groupjoin on the same group at once.
+    """
+
+    guild = await harness.guild()
+    creator = guild.member("dm")
+    await harness.invoke(harness.group_cog, 'groupadd',
+                         harness.context(guild, creator),
+                         "2030-01-01", str(iterations), "Benchmark")
+    group_id = (await harness.pg.retrieve_group_list(
+        guild.id, limit=1))[0][0]
+
+    async def run(number):
+        ctx = harness.context(guild, guild.member("player{}".format(number)))
+        await harness.invoke(harness.group_cog, 'groupjoin', ctx,
+                             str(group_id))
+
+    return [run(number) for number in range(iterations)], iterations
+
+
+async def groupadd(harness, iterations):
+    """
+    Creating iterations groups, 10 at a time.
+    """
+
+    guild = await harness.guild()
+    ctx = harness.context(guild, guild.member("dm"))
+
+    async def run(number):
+        await harness.invoke(harness.group_cog, 'groupadd', ctx,
+                             "2030-01-01", "5", "Group", str(number))
+
+    return [run(number) for number in range(iterations)], 10
+
+
+SCENARIOS = {
+    'questlist': (questlist, 200),
+    'questlist_cached': (questlist_cached, 200),
+    'questsearch': (questsearch, 200),
+    'groupjoin': (groupjoin, 500),
+    'groupadd': (groupadd, 100),
+}
+
+
+async def measure(harness, scenario, iterations, trace):
+    """
+    Runs one pass of a scenario. Returns per-command latencies in
+    milliseconds, round trips, and with trace the allocation figures.
+    """
+
+    runs, concurrency = await scenario(harness, iterations)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def timed(run):
+        async with semaphore:
+            start = time.perf_counter()
+            await run
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    if trace:
+        tracemalloc.start()
+    round_trips = harness.pg.round_trips
+
+    await asyncio.gather(*[timed(run) for run in runs])
+
+    round_trips = harness.pg.round_trips - round_trips
+    allocations = {}
+    if trace:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        allocations = {'peak_kib': peak / 1024,
+                       'retained_kib_per_command':
+                       current / 1024 / len(latencies)}
+
+    await harness.cleanup()
+    return latencies, round_trips, allocations
+
+
+async def run_scenario(harness, name):
+    scenario, iterations = SCENARIOS[name]
+
+    latencies, round_trips, _ = await measure(harness, scenario,
+                                              iterations, False)
+    _, _, allocations = await measure(harness, scenario, iterations, True)
+
+    result = {
+        'commands': len(latencies),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'mean_ms': float(np.mean(latencies)),
+        'round_trips_per_command': round_trips / len(latencies),
+    }
+    result.update(allocations)
+    return result
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, previous=None):
+    columns = ['p50_ms', 'p99_ms', 'round_trips_per_command', 'peak_kib']
+    print("{:12}".format("scenario") +
+          "".join("{:>26}".format(column) for column in columns))
+
+    for name, result in results['scenarios'].items():
+        line = "{:12}".format(name)
+        for column in columns:
+            value = "{:.2f}".format(result.get(column, 0))
+            if previous is not None and name in previous['scenarios']:
+                before = previous['scenarios'][name].get(column)
+                if before:
+                    value += " ({:+.0%})".format(
+                        result.get(column, 0) / before - 1)
+            line += "{:>26}".format(value)
+        print(line)
+
+
+async def main(args):
+    pg = BACKENDS[args.backend]()
+    await pg.setup()
+
+    try:
+        harness = Harness(pg, args.discord_latency, args.route_interval)
+        results = {
+            'revision': revision(),
+            'date': datetime.datetime.utcnow().isoformat(),
+            'backend': args.backend,
+            'discord_latency': args.discord_latency,
+            'route_interval': args.route_interval,
+            'scenarios': {},
+        }
+        for name in args.scenarios or SCENARIOS:
+            results['scenarios'][name] = await run_scenario(harness, name)
+    finally:
+        await pg.close()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as results_file:
+            previous = json.load(results_file)
+    report(results, previous)
+
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark vishnu's commands offline.")
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help="one of {} (default: all)".format(
+                            ", ".join(SCENARIOS)))
+    parser.add_argument('--backend', choices=BACKENDS, default='memory')
+    parser.add_argument('--output', help="write the results to this file")
+    parser.add_argument('--compare',
+                        help="show changes against an earlier --output")
+    parser.add_argument('--discord-latency', type=float, default=0.0,
+                        help="seconds each fake Discord call takes")
+    parser.add_argument('--route-interval', type=float, default=0.0,
+                        help="seconds between Discord calls on one route "
+                        "(the bot uses 0.25)")
+
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario {}".format(name))
+
+    loop = asyncio.get_event_loop()
+    sys.exit(loop.run_until_complete(main(args)))
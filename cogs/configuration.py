@@ -0,0 +1,84 @@
+import yaml
+from discord.ext import commands
+from modules.config import config, GUILD_OPTIONS, LIST_OPTIONS
+from modules.checks import role_whitelisted
+
+
+class Configuration(commands.Cog, name="Configuration Commands"):
+    """
+    Per-guild settings
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.pg = bot.pg
+        self._last_member = None
+
+    @commands.command()
+    @role_whitelisted()
+    async def configshow(self, ctx):
+        """
+        Shows this guild's settings.
+
+        !configshow
+        """
+
+        settings = config.guild(ctx.guild.id)
+        await ctx.send("```yaml\n{}```".format(
+            yaml.safe_dump(settings, default_flow_style=False)))
+
+    @commands.command()
+    @role_whitelisted()
+    async def configset(self, ctx, option, *value):
+        """
+        Sets one of this guild's settings. Values are YAML, so lists look
+        like [TIER-1, TIER-2]; for options that take a list, TIER-1 TIER-2
+        works too. Leave the value out to go back to the default from
+        config.yaml.
+
+        !configset [OPTION] [*VALUE]
+        """
+
+        if option not in GUILD_OPTIONS:
+            await ctx.send("Error: Unknown option {}. Valid options are: {}."
+                           .format(option, ", ".join(GUILD_OPTIONS)))
+            return
+
+        if value:
+            try:
+                parsed = yaml.safe_load(" ".join(value))
+                if option in LIST_OPTIONS and not isinstance(parsed, list):
+                    # One item per word, so a single value is a list of one.
+                    parsed = [yaml.safe_load(word) for word in value]
+            except yaml.YAMLError as e:
+                await ctx.send("Error: Could not parse value: {}".format(e))
+                return
+
+            if option in LIST_OPTIONS and any(
+                    isinstance(item, (list, dict)) for item in parsed):
+                await ctx.send("Error: {} takes a list of plain values."
+                               .format(option))
+                return
+        else:
+            parsed = None
+
+        await config.set_option(self.pg, ctx.guild.id, option, parsed)
+        await ctx.send("{} set to {}".format(
+            option, config.option(ctx.guild.id, option)))
+
+    @commands.command()
+    @role_whitelisted()
+    async def configreload(self, ctx):
+        """
+        Reloads config.yaml and this guild's settings without restarting.
+
+        !configreload
+        """
+
+        config.reload(force=True)
+        await config.load_guilds(self.pg, [ctx.guild.id])
+        await ctx.send("Configuration reloaded.")
+
+
+def setup(bot):
+    bot.add_cog(Configuration(bot))
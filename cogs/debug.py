@@ -1,11 +1,5 @@
-import yaml
 from discord.ext import commands
-
-config = yaml.safe_load(open("config.yaml"))
-role_whitelist = " ".join(config['role_whitelist'])
-chan_whitelist = config['chan_whitelist']
-pg_connection = config['pg_connection']
-group_category = config['group_category']
+from modules.checks import role_whitelisted
 
 
 class Debug(commands.Cog, name="Debug"):
@@ -18,7 +12,7 @@ class Debug(commands.Cog, name="Debug"):
         self._last_member = None
 
     @commands.command()
-    @commands.has_any_role(role_whitelist)
+    @role_whitelisted()
     async def test(self, ctx):
         """
         Tests various things
@@ -0,0 +1,166 @@
+import re
+import functools
+from discord.ext import commands
+
+# modules.dice and modules.odds import numpy, so they're imported by the
+# first command that rolls, not at startup. See DEFERRED_IMPORTS in
+# app.py.
+
+TARGET = re.compile(r"^(>=|<=|>|<|=)(-?\d+)$")
+PERCENTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+class Dice(commands.Cog, name="Dice Commands"):
+    """
+    Dice rolling commands
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._last_member = None
+
+    @commands.command(aliases=['r'])
+    async def roll(self, ctx, *expression):
+        """
+        Rolls dice. Defaults to 1d20.
+
+        Supports NdS, keep/drop (4d6kh3, 2d20kl1, 4d6dl1), exploding
+        dice (6d6!), rerolls (4d6r1, 4d6r<3), math (2d8+1d6+3) and
+        repeats (6x(4d6kh3)).
+
+        !roll [EXPRESSION]
+        """
+
+        from modules.dice import (DiceError, compile_expression,
+                                  format_details)
+
+        text = "".join(expression) or "1d20"
+
+        try:
+            roller = compile_expression(text)
+            totals, details = await self.bot.loop.run_in_executor(
+                None, roller.roll)
+        except DiceError as e:
+            await ctx.send("Error: {}".format(e))
+            return
+
+        if roller.times is None:
+            result = "**{}**".format(totals[0])
+        else:
+            result = ", ".join("**{}**".format(total) for total in totals)
+
+        message = "{} rolled {}: {}\n{}".format(
+            ctx.author.mention, roller.text, result, format_details(details))
+
+        # Leave out the dice if they don't fit in one message.
+        if len(message) > 2000:
+            message = "{} rolled {}: {}".format(
+                ctx.author.mention, roller.text, result)
+
+        await ctx.send(message[:2000])
+
+    @commands.command()
+    async def statarrays(self, ctx, players: int = 1):
+        """
+        Rolls ability scores (6x 4d6kh3) for one or more players at once.
+
+        !statarrays [PLAYERS]
+        """
+
+        from modules.dice import compile_expression
+
+        if not 1 <= players <= 20:
+            await ctx.send("Error: Can roll for 1 to 20 players at once.")
+            return
+
+        scores = compile_expression("4d6kh3").sample(players * 6)
+        scores = scores.reshape(players, 6)
+
+        lines = ["Player {}: {} (total {})".format(
+            player + 1,
+            ", ".join(str(score) for score in sorted(row, reverse=True)),
+            row.sum())
+            for player, row in enumerate(scores)]
+
+        await ctx.send("```{}```".format("\n".join(lines)))
+
+    async def distribution(self, ctx, text):
+        """
+        Computes an expression's distribution off the event loop. Sends
+        the error and returns None if the expression is invalid.
+        """
+
+        from modules.dice import DiceError
+        from modules.odds import expression_distribution
+
+        try:
+            return await self.bot.loop.run_in_executor(
+                None, functools.partial(expression_distribution, text))
+        except DiceError as e:
+            await ctx.send("Error: {}".format(e))
+            return None
+
+    @commands.command()
+    async def odds(self, ctx, *expression):
+        """
+        Shows the exact odds of a roll, optionally against a target.
+
+        !odds [EXPRESSION] [>= TARGET]
+        !odds 2d20kh1+5 >= 15
+        """
+
+        from modules.dice import compile_expression
+
+        expression = list(expression)
+        compare = None
+
+        # The target is the last word(s): ">=15" or ">= 15".
+        for words in (1, 2):
+            if len(expression) <= words:
+                break
+            match = TARGET.match("".join(expression[-words:]))
+            if match is not None:
+                compare, target = match.group(1), int(match.group(2))
+                expression = expression[:-words]
+                break
+
+        text = "".join(expression) or "1d20"
+        dist = await self.distribution(ctx, text)
+        if dist is None:
+            return
+
+        lines = ["Range {} to {}, average {:.2f} (sd {:.2f})".format(
+            dist.low, dist.high, dist.mean(), dist.std())]
+        lines.append("Percentiles: " + ", ".join(
+            "{:g}%: {}".format(fraction * 100, dist.percentile(fraction))
+            for fraction in PERCENTILES))
+        if compare is not None:
+            lines.append("Chance of {} {}: {:.2%}".format(
+                compare, target, dist.chance(compare, target)))
+
+        await ctx.send("Odds of {}:\n```{}```".format(
+            compile_expression(text).text, "\n".join(lines)))
+
+    @commands.command(aliases=['distribution'])
+    async def dist(self, ctx, *expression):
+        """
+        Shows a histogram of the outcomes of a roll.
+
+        !dist [EXPRESSION]
+        """
+
+        from modules.dice import compile_expression
+        from modules.odds import histogram
+
+        text = "".join(expression) or "1d20"
+        dist = await self.distribution(ctx, text)
+        if dist is None:
+            return
+
+        await ctx.send("Distribution of {} (average {:.2f}):\n```{}```"
+                       .format(compile_expression(text).text, dist.mean(),
+                               histogram(dist)))
+
+
+def setup(bot):
+    bot.add_cog(Dice(bot))
@@ -1,19 +1,17 @@
-import re
-import texttable as tt
-import yaml
-import modules.pgsql as pgsql
+import asyncio
+import datetime
 import discord
 from discord import Embed
 from discord.ext import commands
-from discord.utils import get
 from inspect import cleandoc
-
-config = yaml.safe_load(open("config.yaml"))
-role_whitelist = " ".join(config['role_whitelist'])
-group_category = config['group_category']
-announce_chan = config['announce_chan']
-
-pg = pgsql.pgSQLManagement()
+from modules.paginator import Paginator
+import modules.filters as filters
+import modules.tables as tables
+from modules.batch import Batcher
+from modules.provision import provision_group, join_emoji
+from modules.groupindex import GroupObjects
+from modules.config import config
+from modules.checks import role_whitelisted
 
 
 class GroupManagement(commands.Cog, name="Group Management Commands"):
@@ -23,10 +21,17 @@ class GroupManagement(commands.Cog, name="Group Management Commands"):
 
     def __init__(self, bot):
         self.bot = bot
+        self.pg = bot.pg
+        self.groups = bot.groups
         self._last_member = None
+        # Seconds to collect reactions on an announcement before joining
+        # them.
+        self.reactions = Batcher(config.get('reaction_batch_window', 1.5),
+                                 self.flush_reactions)
+        self.limiter = bot.limiter
 
     @commands.command()
-    @commands.has_any_role(role_whitelist)
+    @role_whitelisted()
     async def groupadd(self, ctx, start_date, max_users, *notes):
         """
         Allows a DM to create a new group. Optionally add notes.
@@ -38,103 +43,206 @@ class GroupManagement(commands.Cog, name="Group Management Commands"):
 
         creator = str(ctx.author)
 
-        group_id = await pg.import_group_data(
+        group_id = await self.pg.import_group_data(
             ctx.guild.id,
             creator,
             start_date,
             max_users,
             " ".join(notes))
 
+        embed = Embed(title="New Group!",
+                      description="A new group has been created! React to this message to join the group, or use !groupjoin {}".format(group_id),
+                      color=0xffc84b)
+        embed.add_field(name='Start Date:', value=start_date, inline=True)
+        embed.add_field(name='Max Players:', value=max_users, inline=True)
+        embed.add_field(name='Creator:', value=ctx.author, inline=True)
+        embed.add_field(name='Description:', value=" ".join(notes))
+
+        def announced(ids):
+            # Members can react to the announcement from now on.
+            self.groups.add(GroupObjects(ctx.guild.id,
+                                         group_id,
+                                         ids['role_id'],
+                                         ids['text_channel_id'],
+                                         ids['voice_channel_id'],
+                                         ids['announce_message_id']))
+
+        try:
+            await provision_group(self.limiter,
+                                  ctx,
+                                  group_id,
+                                  config.option(ctx.guild.id,
+                                                'group_category'),
+                                  config.option(ctx.guild.id,
+                                                'announce_chan'),
+                                  embed,
+                                  announced)
+        except Exception as e:
+            print(e)
+            self.groups.remove(ctx.guild.id, group_id)
+            await self.pg.delete_group(ctx.guild.id, group_id)
+            await ctx.send(embed=discord.Embed(
+                title="Error!",
+                description=""" Could not create the group: {} """.format(e),
+                color=0xe00038))
+            return
+
+        await self.pg.set_group_objects(
+            *self.groups.group(ctx.guild.id, group_id))
+        self.bot.reminders.add(ctx.guild.id, group_id,
+                               datetime.datetime.strptime(start_date,
+                                                          '%Y-%m-%d').date())
+
         await ctx.send(cleandoc("""
         Created group with ID of {} starting on {}
         """.format(group_id, start_date)))
 
-        group_role = await ctx.guild.create_role(
-            name="group-{}".format(str(group_id)),
-            mentionable=True,
-            reason="Automated role creation, requested by {}"
-            .format(str(ctx.author)))
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        self.queue_reaction(payload, True)
 
-        new_role = "group-{}".format(str(group_id))
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload):
+        self.queue_reaction(payload, False)
 
-        await ctx.author.add_roles(group_role)
+    def queue_reaction(self, payload, added):
+        """
+        Queues a reaction on a group announcement to be joined (or left)
+        together with the others arriving in the same window. Only the
+        join emoji counts.
+        """
 
-        channel_overwrites = {
-            ctx.guild.default_role: discord.PermissionOverwrite(
-                read_messages=False),
-            ctx.guild.roles[ctx.guild.roles.index(group_role)]:
-            discord.PermissionOverwrite(
-                read_messages=True)
-        }
+        if str(payload.emoji) != join_emoji:
+            return
 
-        try:
-            for category in ctx.guild.categories:
-                if category.id == group_category:
-                    await ctx.guild.create_text_channel(
-                        new_role + "-text",
-                        category=category,
-                        overwrites=channel_overwrites)
-
-                    await ctx.guild.create_voice_channel(
-                        new_role + "-voice",
-                        category=category,
-                        overwrites=channel_overwrites)
-        except Exception as e:
-            print(e)
+        if self.groups.by_announcement(payload.message_id) is None:
+            return
 
-        finally:
+        if payload.user_id == self.bot.user.id:
+            return
 
-            embed = Embed(title="New Group!",
-                          description="A new group has been created! React to this message to join the group, or use !groupjoin {}".format(group_id),
-                          color=0xffc84b)
-            embed.add_field(name='Start Date:', value=start_date, inline=True)
-            embed.add_field(name='Max Players:', value=max_users, inline=True)
-            embed.add_field(name='Creator:', value=ctx.author, inline=True)
-            embed.add_field(name='Description:', value=" ".join(notes))
+        self.reactions.add((payload.guild_id, payload.message_id),
+                           (payload.user_id, added))
 
-            announce_channel = get(ctx.message.guild.channels,
-                                   id=announce_chan)
-            await announce_channel.send(embed=embed)
+    async def flush_reactions(self, key, reactions):
+        """
+        Joins and removes every member who reacted to one announcement
+        during the window, with one query each, then updates their roles.
+        """
+
+        guild_id, message_id = key
+        guild = self.bot.get_guild(guild_id)
+        if guild is None:
+            return
+
+        # Only a member's last reaction counts.
+        latest = {}
+        for user_id, added in reactions:
+            latest.pop(user_id, None)
+            latest[user_id] = added
+
+        members = {}
+        joining = []
+        leaving = []
+        for user_id, added in latest.items():
+            member = guild.get_member(user_id)
+            if member is None or member.bot:
+                continue
+
+            members[user_id] = member
+            if added:
+                joining.append(user_id)
+            else:
+                leaving.append(user_id)
+
+        if joining:
+            joined = await self.pg.join_group_batch(guild_id,
+                                                    message_id,
+                                                    joining)
+            role = None
+            if joined is not None:
+                role = self.group_role(guild, joined['id'])
+
+            if role is not None:
+                await asyncio.gather(*[
+                    self.limiter.run(('member_roles', guild.id),
+                                     members[user_id].add_roles, role)
+                    for user_id in joined['joined']], return_exceptions=True)
+
+        if leaving:
+            left = await self.pg.leave_group_batch(guild_id,
+                                                   message_id,
+                                                   leaving)
+            role = None
+            if left is not None:
+                role = self.group_role(guild, left['id'])
+
+            if role is not None:
+                await asyncio.gather(*[
+                    self.limiter.run(('member_roles', guild.id),
+                                     members[user_id].remove_roles, role)
+                    for user_id in left['left']], return_exceptions=True)
 
     @commands.command()
     async def grouplist(self, ctx, *args):
         """
-        Allows any user to list the groups available.
+        Allows any user to list the groups available, filtered by ID,
+        creator, start date, or whether they have free places.
+
+        !grouplist [id=ID] [creator=CREATOR] [date=DATE] [open|full] [sort=COLUMN]
 
-        !grouplist [id=ID] [creator=CREATOR]
+        Filters take several values (id=3,7) and IDs and dates take
+        ranges (date=2019-06-01..2019-06-30). sort=-COLUMN sorts in
+        descending order. Use the arrow reactions to flip through the
+        pages.
         """
 
-        command = " ".join(map(str, args))
+        try:
+            list_filter = filters.parse('groups', args)
+        except filters.FilterError as e:
+            await ctx.send("Error: {}".format(e))
+            return
 
-        idsearch = r"id=([\d])"
-        creatorsearch = r"creator=([^\s]+)"
+        await self.list_groups(ctx, list_filter)
 
-        value_id = None
-        value_creator = None
+    @commands.command()
+    async def mygroups(self, ctx, *args):
+        """
+        Allows any user to list the groups they have joined. Takes the
+        same filters as !grouplist.
 
-        if re.search(idsearch, command) is not None:
-            value_id = re.search(idsearch, command).group(1)
+        !mygroups [FILTERS]
+        """
+
+        try:
+            list_filter = filters.joined_by(filters.parse('groups', args),
+                                            ctx.author.id)
+        except filters.FilterError as e:
+            await ctx.send("Error: {}".format(e))
+            return
 
-        if re.search(creatorsearch, command) is not None:
-            value_creator = re.search(creatorsearch, command).group(1)
+        await self.list_groups(ctx, list_filter)
 
-        query_return = await pg.retrieve_group_list(
-            ctx.guild.id,
-            value_id,
-            value_creator)
+    async def list_groups(self, ctx, list_filter):
+        """
+        Shows the groups matched by a Filter, a page at a time.
+        """
 
-        # Format the results as a table
-        tab = tt.Texttable()
-        headings = ['ID', 'CREATOR', 'START DATE', 'MAX USERS', 'NOTES']
-        tab.header(headings)
+        async def fetch(after, limit):
+            return await self.pg.retrieve_group_list(
+                ctx.guild.id,
+                list_filter,
+                after=after,
+                limit=limit)
 
-        for x in range(0, len(query_return), 5):
-            for row in query_return[x:x+5]:
-                tab.add_row(row)
+        def render(rows, page):
+            return tables.GROUPS.pack(rows, "Page {}".format(page))
 
-            s = tab.draw()
-            await ctx.send("```{}```".format(s))
-            tab.reset()
+        paginator = Paginator(ctx, fetch, render,
+                              key=list_filter.cursor,
+                              cache=self.pg.pages,
+                              cache_key=('groups', ctx.guild.id, list_filter))
+        await paginator.start()
 
     @commands.command()
     async def groupjoin(self, ctx, group_id):
@@ -143,52 +251,65 @@ class GroupManagement(commands.Cog, name="Group Management Commands"):
 
         !groupjoin [ID]
         """
-        ret_groupinfo = await pg.retrieve_group_info(
-            ctx.guild.id,
-            group_id)
-
-        print(ret_groupinfo)
-
-        # session_id = ret_groupinfo[0][0]
-        max_players = ret_groupinfo[0][1]
-        session_members = ret_groupinfo[0][2]
-        # session_owner = ret_groupinfo[0][3]
+        result = await self.pg.join_group(ctx.guild.id,
+                                          group_id,
+                                          ctx.author.id)
 
-        regex_check = r"(^\d+)\/(\d+)$"
-
-        matches = re.search(regex_check, max_players)
+        if result is None:
+            await ctx.send(embed=discord.Embed(
+                title="Error!",
+                description=""" No group with ID of {} exists! """.format(group_id),
+                color=0xe00038))
+        elif result['joined']:
+            role = self.group_role(ctx.guild, group_id)
+            if role is not None:
+                await ctx.author.add_roles(role)
 
-        print(matches.group(0), matches.group(1), matches.group(2))
-        print(session_members)
+            await ctx.send(embed=discord.Embed(
+                title="Joined Group!",
+                description="{} joined group with ID of {}".format(ctx.author, group_id),
+                color=0x79ff4b))
+        elif result['is_member']:
+            await ctx.send(embed=discord.Embed(
+                title="Error!",
+                description=""" {} is already a member of this group! """.format(str(ctx.author)),
+                color=0xe00038))
+        else:
+            await ctx.send(embed=discord.Embed(
+                title="Error!",
+                description=""" Group is already full! ({}/{}) """.format(
+                    result['member_count'], result['max_users']),
+                color=0xe00038))
 
-        slots_taken = int(matches.group(1))
-        slots_max = int(matches.group(2))
+    @commands.command()
+    async def groupleave(self, ctx, group_id):
+        """
+        Allows any user to leave a group they joined.
 
-        if slots_taken < slots_max:
-            if session_members is None or str(ctx.author) not in session_members:
-                slots_taken += 1
-                new_max = "{}/{}".format(slots_taken, slots_max)
-                await pg.join_group(ctx.guild.id,
-                                    group_id,
-                                    str(ctx.author),
-                                    new_max)
+        !groupleave [ID]
+        """
+        result = await self.pg.leave_group(ctx.guild.id,
+                                           group_id,
+                                           ctx.author.id)
 
-                role = get(ctx.guild.roles, name="group-{}".format(group_id))
-                await ctx.author.add_roles(role)
+        if result is None:
+            await ctx.send(embed=discord.Embed(
+                title="Error!",
+                description=""" No group with ID of {} exists! """.format(group_id),
+                color=0xe00038))
+        elif result['left']:
+            role = self.group_role(ctx.guild, group_id)
+            if role is not None:
+                await ctx.author.remove_roles(role)
 
-                await ctx.send(embed=discord.Embed(
-                    title="Joined Group!",
-                    description="{} joined group with ID of {}".format(ctx.author, group_id),
-                    color=0x79ff4b))
-            else:
-                await ctx.send(embed=discord.Embed(
-                    title="Error!",
-                    description=""" {} is already a member of this group! """.format(str(ctx.author)),
-                    color=0xe00038))
+            await ctx.send(embed=discord.Embed(
+                title="Left Group!",
+                description="{} left group with ID of {}".format(ctx.author, group_id),
+                color=0x79ff4b))
         else:
             await ctx.send(embed=discord.Embed(
                 title="Error!",
-                description=""" Group is already full! ({}) """.format(ret_groupinfo[0][1]),
+                description=""" {} is not a member of this group! """.format(str(ctx.author)),
                 color=0xe00038))
 
     @commands.command()
@@ -199,34 +320,73 @@ class GroupManagement(commands.Cog, name="Group Management Commands"):
         Run this in the group's channel.
         """
 
-        text_channel = ctx.message.channel
+        objects = self.groups.by_channel(ctx.message.channel.id)
+        if objects is None:
+            await ctx.send("Run this in the group's channel!")
+            return
 
-        channel_regex = r"^group-(\d+)-"
-        matches = re.search(channel_regex, str(text_channel))
-
-        group_id = matches.group(1)
-        voice_channel_name = "group-{}-voice".format(group_id)
-        role_name = "group-{}".format(group_id)
-
-        voice_channel = get(ctx.guild.voice_channels, name=voice_channel_name)
-        role = get(ctx.guild.roles, name=role_name)
-
-        query_return = await pg.retrieve_group_info(
+        query_return = await self.pg.retrieve_group_info(
             ctx.guild.id,
-            group_id)
+            objects.group_id)
 
         for row in query_return:
             if str(ctx.author) == str(row[3]):
-                await role.delete(reason="Group has been closed.")
-                await voice_channel.delete(reason="Group has been closed.")
-                await text_channel.delete(reason="Group has been closed.")
+                for target in (ctx.guild.get_role(objects.role_id),
+                               ctx.guild.get_channel(objects.voice_channel_id),
+                               ctx.guild.get_channel(objects.text_channel_id)):
+                    if target is not None:
+                        await target.delete(reason="Group has been closed.")
 
-                await pg.delete_group(
+                await self.pg.delete_group(
                     ctx.guild.id,
-                    group_id)
+                    objects.group_id)
+                self.groups.remove(ctx.guild.id, objects.group_id)
+                self.bot.reminders.remove(ctx.guild.id, objects.group_id)
             else:
                 await ctx.send("You are not the owner of this group!")
 
+    @commands.command()
+    @role_whitelisted()
+    async def grouparchive(self, ctx, mode=None):
+        """
+        Allows a DM to archive this server's groups whose sessions are long
+        over, deleting their roles and channels. Add "dry" to only list
+        them.
+
+        !grouparchive [dry]
+        """
+
+        dry_run = mode == 'dry'
+        groups = await self.bot.archiver.archive([ctx.guild.id],
+                                                 dry_run=dry_run)
+
+        if not groups:
+            await ctx.send("No groups have expired.")
+            return
+
+        ids = ", ".join(str(group['id']) for group in groups[:50])
+        if len(groups) > 50:
+            ids += ", ..."
+
+        if dry_run:
+            await ctx.send("Would archive {} group(s): {}".format(
+                len(groups), ids))
+        else:
+            await ctx.send("Archived {} group(s): {}. Their roles and "
+                           "channels are being deleted.".format(
+                               len(groups), ids))
+
+    def group_role(self, guild, group_id):
+        """
+        Returns a group's role, or None if it doesn't exist anymore.
+        """
+
+        objects = self.groups.group(guild.id, group_id)
+        if objects is None or objects.role_id is None:
+            return None
+
+        return guild.get_role(objects.role_id)
+
 
 def setup(bot):
     bot.add_cog(GroupManagement(bot))
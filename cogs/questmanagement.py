@@ -1,15 +1,22 @@
-import re
-import texttable as tt
-import yaml
-import modules.pgsql as pgsql
+import io
+import discord
 from discord.ext import commands
 from inspect import cleandoc
+from modules.paginator import Paginator
+import modules.filters as filters
+import modules.tables as tables
+from modules.config import config
+from modules.checks import role_whitelisted
 
-config = yaml.safe_load(open("config.yaml"))
-role_whitelist = " ".join(config['role_whitelist'])
-quest_tier_whitelist = config['quest_tiers']
+# Largest quest file !questimport reads, and the most quests in one.
+MAX_IMPORT_BYTES = 8 * 1024 * 1024
+MAX_IMPORT_QUESTS = 10000
 
-pg = pgsql.pgSQLManagement()
+# Most quests !questsearch shows.
+SEARCH_RESULTS = 10
+
+# Discord's upload limit.
+MAX_UPLOAD_BYTES = 8 * 1024 * 1024
 
 
 class QuestManagement(commands.Cog, name="Quest Management Commands"):
@@ -19,10 +26,11 @@ class QuestManagement(commands.Cog, name="Quest Management Commands"):
 
     def __init__(self, bot):
         self.bot = bot
+        self.pg = bot.pg
         self._last_member = None
 
     @commands.command()
-    @commands.has_any_role(role_whitelist)
+    @role_whitelisted()
     async def questadd(self, ctx, quest_tier, *desc):
         """
         Allows a DM to create a quest.
@@ -30,15 +38,17 @@ class QuestManagement(commands.Cog, name="Quest Management Commands"):
         !questadd [TIER] [DESCRIPTION]
         """
 
+        quest_tier_whitelist = config.option(ctx.guild.id, 'quest_tiers')
+
         if quest_tier in quest_tier_whitelist:
             if len(desc) < 100:
                 quest_desc = " ".join(desc)
                 creator = str(ctx.author)
 
-                await pg.import_quest_data(ctx.guild.id,
-                                           quest_tier,
-                                           quest_desc,
-                                           creator)
+                await self.pg.import_quest_data(ctx.guild.id,
+                                                quest_tier,
+                                                quest_desc,
+                                                creator)
 
                 print(cleandoc("""Tier {} quest added by {}.
                 Description: {}""".format(
@@ -66,7 +76,7 @@ class QuestManagement(commands.Cog, name="Quest Management Commands"):
                        quest_tier)))
 
     @commands.command()
-    @commands.has_any_role(role_whitelist)
+    @role_whitelisted()
     async def questdel(self, ctx, quest_id):
         """
         Allows a DM to delete a quest by their ID.
@@ -74,12 +84,12 @@ class QuestManagement(commands.Cog, name="Quest Management Commands"):
         !questdel [ID]
         """
 
-        await pg.delete_quest(ctx.guild.id,
-                              quest_id)
+        await self.pg.delete_quest(ctx.guild.id,
+                                   quest_id)
         await ctx.send("Quest with ID " + quest_id + " deleted.")
 
     @commands.command()
-    @commands.has_any_role(role_whitelist)
+    @role_whitelisted()
     async def questcomplete(self, ctx, quest_id):
         """
         Allows a DM to set a quest to 'complete' by specifying a quest ID.
@@ -87,15 +97,15 @@ class QuestManagement(commands.Cog, name="Quest Management Commands"):
         !questcomplete [ID]
         """
 
-        await pg.complete_quest(ctx.guild.id,
-                                quest_id,
-                                True)
+        await self.pg.complete_quest(ctx.guild.id,
+                                     quest_id,
+                                     True)
         await ctx.send("""
         {} set quest with ID of {} to COMPLETE!
         """.format(ctx.author, quest_id))
 
     @commands.command()
-    @commands.has_any_role(role_whitelist)
+    @role_whitelisted()
     async def questincomplete(self, ctx, quest_id):
         """
         Allows a DM to set a quest to 'uncomplete' by specifying a quest ID.
@@ -103,58 +113,163 @@ class QuestManagement(commands.Cog, name="Quest Management Commands"):
         !questuncomplete [ID]
         """
 
-        await pg.complete_quest(ctx.guild.id,
-                                quest_id,
-                                False)
+        await self.pg.complete_quest(ctx.guild.id,
+                                     quest_id,
+                                     False)
         await ctx.send("""
         {} set quest with ID of {} to UNCOMPLETE!
         """.format(ctx.author, quest_id))
 
     @commands.command()
-    async def questlist(self, ctx, *args):
+    @role_whitelisted()
+    async def questimport(self, ctx):
+        """
+        Allows a DM to add many quests at once from an attached file.
+
+        Attach a CSV file with the columns tier and description, or a YAML
+        list of quests with those keys. creator and completed columns are
+        optional, so a file from !questexport can be imported again.
+
+        !questimport
         """
-        Allows any user to retrieve quests by specifying an
-        ID, tier, or creator. Otherwise, returns all quests.
 
-        !questlist [id=ID] [tier=TIER] [creator=CREATOR]
+        # Reading quest files takes numpy, imported on first use.
+        from modules.questfile import (QuestFileError, read_quests,
+                                       check_quests)
+
+        if not ctx.message.attachments:
+            await ctx.send("Error: Attach a .csv or .yaml file of quests.")
+            return
+
+        attachment = ctx.message.attachments[0]
+        if attachment.size > MAX_IMPORT_BYTES:
+            await ctx.send("Error: Quest files can be up to {} MiB.".format(
+                MAX_IMPORT_BYTES // 1024 // 1024))
+            return
+
+        data = io.BytesIO()
+        await attachment.save(data)
+
+        def parse():
+            rows = read_quests(attachment.filename, data.getvalue())
+            if len(rows) > MAX_IMPORT_QUESTS:
+                raise QuestFileError("Can import up to {} quests at once."
+                                     .format(MAX_IMPORT_QUESTS))
+            return check_quests(rows,
+                                config.option(ctx.guild.id, 'quest_tiers'),
+                                str(ctx.author))
+
+        try:
+            records, errors = await self.bot.loop.run_in_executor(None, parse)
+        except (QuestFileError, UnicodeDecodeError) as e:
+            await ctx.send("Error: {}".format(e))
+            return
+
+        if errors:
+            lines = ["Quest {}: {}".format(row, problem)
+                     for row, problem in errors[:10]]
+            if len(errors) > 10:
+                lines.append("... and {} more.".format(len(errors) - 10))
+            await ctx.send("Error: Nothing was imported.\n```{}```".format(
+                "\n".join(lines)))
+            return
+
+        if not records:
+            await ctx.send("Error: The file has no quests.")
+            return
+
+        count = await self.pg.import_quests(ctx.guild.id, records)
+        print("{} quests imported by {}.".format(count, ctx.author))
+        await ctx.send("Imported {} quests.".format(count))
+
+    @commands.command()
+    @role_whitelisted()
+    async def questexport(self, ctx):
+        """
+        Allows a DM to download every quest as a CSV file.
+
+        !questexport
         """
 
-        command = " ".join(map(str, args))
+        output = io.BytesIO()
+        size = 0
 
-        idsearch = r"id=([\d])"
-        tiersearch = r"tier=([^\s]+)"
-        creatorsearch = r"creator=([^\s]+)"
-        value_id = None
-        value_tier = None
-        value_creator = None
+        # Only what can be uploaded is kept; the rest is counted.
+        async def write(chunk):
+            nonlocal size
+            size += len(chunk)
+            if size <= MAX_UPLOAD_BYTES:
+                output.write(chunk)
 
-        if re.search(idsearch, command) is not None:
-            value_id = re.search(idsearch, command).group(1)
+        await self.pg.export_quests(ctx.guild.id, write)
 
-        if re.search(tiersearch, command) is not None:
-            value_tier = re.search(tiersearch, command).group(1)
+        if size > MAX_UPLOAD_BYTES:
+            await ctx.send("Error: Too many quests to upload at once.")
+            return
 
-        if re.search(creatorsearch, command) is not None:
-            value_creator = re.search(creatorsearch, command).group(1)
+        output.seek(0)
+        await ctx.send(file=discord.File(
+            output, filename="quests-{}.csv".format(ctx.guild.id)))
 
-        query_return = await pg.retrieve_quest_data(
-            ctx.guild.id,
-            value_id,
-            value_tier,
-            value_creator)
+    @commands.command()
+    async def questsearch(self, ctx, *, text=""):
+        """
+        Allows any user to search the descriptions of the open quests.
 
-        # Format the results as a table
-        tab = tt.Texttable()
-        headings = ['ID', 'TIER', 'CREATOR', 'DESCRIPTION']
-        tab.header(headings)
+        !questsearch [WORDS]
 
-        for x in range(0, len(query_return), 5):
-            for row in query_return[x:x+5]:
-                tab.add_row(row)
+        Put phrases in "quotes" and -word to leave a word out. If nothing
+        matches, quests with similar words are shown.
+        """
+
+        if not text:
+            await ctx.send("Error: Give some words to search for.")
+            return
+
+        quests = await self.pg.search_quests(ctx.guild.id, text,
+                                             SEARCH_RESULTS)
+        if not quests:
+            await ctx.send("No open quests match {}.".format(text))
+            return
+
+        await ctx.send("\n".join(
+            "**{}** {} by {}: {}".format(quest_id, tier, creator, snippet)
+            for quest_id, tier, creator, snippet in quests))
+
+    @commands.command()
+    async def questlist(self, ctx, *args):
+        """
+        Allows any user to list the open quests, filtered by ID, tier or
+        creator. Otherwise, returns all quests.
+
+        !questlist [id=ID] [tier=TIER] [creator=CREATOR] [sort=COLUMN]
+
+        Filters take several values (tier=TIER-1,TIER-2) and IDs take
+        ranges (id=10..20). sort=-COLUMN sorts in descending order.
+        Use the arrow reactions to flip through the pages.
+        """
 
-            s = tab.draw()
-            await ctx.send("```{}```".format(s))
-            tab.reset()
+        try:
+            list_filter = filters.parse('quests', args)
+        except filters.FilterError as e:
+            await ctx.send("Error: {}".format(e))
+            return
+
+        async def fetch(after, limit):
+            return await self.pg.retrieve_quest_data(
+                ctx.guild.id,
+                list_filter,
+                after=after,
+                limit=limit)
+
+        def render(rows, page):
+            return tables.QUESTS.pack(rows, "Page {}".format(page))
+
+        paginator = Paginator(ctx, fetch, render,
+                              key=list_filter.cursor,
+                              cache=self.pg.pages,
+                              cache_key=('quests', ctx.guild.id, list_filter))
+        await paginator.start()
 
 
 def setup(bot):
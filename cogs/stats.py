@@ -0,0 +1,60 @@
+import time
+import datetime
+from discord.ext import commands
+from modules.metrics import metrics
+from modules.checks import role_whitelisted
+
+
+class Stats(commands.Cog, name="Stats"):
+    """
+    Bot statistics
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.pg = bot.pg
+        self._last_member = None
+
+    @commands.command()
+    @role_whitelisted()
+    async def stats(self, ctx):
+        """
+        Shows the slowest and busiest commands and queries.
+
+        !stats
+        """
+
+        lines = ["Uptime: {}".format(datetime.timedelta(
+            seconds=int(time.time() - metrics.started)))]
+
+        for title, name in (("Commands", 'vishnu_command_duration_seconds'),
+                            ("Queries", 'vishnu_query_duration_seconds')):
+            rows = metrics.summary(name, ctx.guild.id)
+            if not rows:
+                continue
+
+            lines.append("")
+            lines.append("{:24} {:>7} {:>9} {:>9} {:>6}".format(
+                title, "count", "p50 ms", "p99 ms", "errors"))
+            for labels, count, p50, p99, errors in rows:
+                lines.append("{:24} {:>7} {:>9.1f} {:>9.1f} {:>6}".format(
+                    labels[0][:24], count, p50 * 1000, p99 * 1000, errors))
+
+        cache = self.pg.cache.stats()
+        pages = self.pg.pages.stats()
+        statements = self.pg.statements.stats()
+        lines.append("")
+        lines.append("Result cache: {:.0%} hits, {} entries, {} KiB".format(
+            cache['hit_rate'], cache['entries'],
+            cache['memory_bytes'] // 1024))
+        lines.append("Page cache: {:.0%} hits, {} pages, {} KiB".format(
+            pages['hit_rate'], pages['entries'],
+            pages['memory_bytes'] // 1024))
+        lines.append("Prepared statements: about {:.0%} reused".format(
+            statements['hit_rate']))
+
+        await ctx.send("```{}```".format("\n".join(lines)))
+
+
+def setup(bot):
+    bot.add_cog(Stats(bot))
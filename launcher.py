@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Runs vishnu as several processes, each with its own range of shards.
+
+python3 launcher.py [--processes N] [--shards N]
+
+The shard count defaults to sharding.shard_count in config.yaml, or to
+the count Discord recommends for the bot. The process count defaults to
+sharding.processes, or to the number of CPU cores. Shards are split into
+contiguous ranges, one per process, and a process that exits is started
+again after a short pause. Ctrl+C stops them all.
+
+The processes share pg_connection.max_size between them, and coordinate
+through PostgreSQL; see modules/coordination.py.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import subprocess
+import urllib.request
+from modules.config import config
+
+GATEWAY = "https://discordapp.com/api/v7/gateway/bot"
+
+# Seconds to wait before restarting a process that exited.
+RESTART_DELAY = 5
+
+
+def recommended_shards(token):
+    """
+    Asks Discord how many shards the bot should use.
+    """
+
+    request = urllib.request.Request(GATEWAY, headers={
+        'Authorization': "Bot {}".format(token),
+        'User-Agent': "vishnu launcher",
+    })
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)['shards']
+
+
+def shard_ranges(shards, processes):
+    """
+    Splits shards 0 ... shards - 1 into processes contiguous ranges.
+    """
+
+    processes = min(processes, shards)
+    size, extra = divmod(shards, processes)
+
+    ranges = []
+    start = 0
+    for process in range(processes):
+        end = start + size + (1 if process < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+
+    return ranges
+
+
+def spawn(process, shard_ids, shards, processes):
+    env = dict(os.environ,
+               VISHNU_PROCESS=str(process),
+               VISHNU_PROCESSES=str(processes),
+               VISHNU_SHARD_COUNT=str(shards),
+               VISHNU_SHARD_IDS=",".join(map(str, shard_ids)))
+
+    print("Starting process {} with shards {}-{}".format(
+        process, shard_ids[0], shard_ids[-1]))
+    return subprocess.Popen([sys.executable, 'app.py'], env=env)
+
+
+def main(args):
+    sharding = config.get('sharding') or {}
+
+    shards = (args.shards or sharding.get('shard_count') or
+              recommended_shards(config['token']))
+    processes = (args.processes or sharding.get('processes') or
+                 os.cpu_count() or 1)
+
+    ranges = shard_ranges(shards, processes)
+    children = [spawn(process, shard_ids, shards, len(ranges))
+                for process, shard_ids in enumerate(ranges)]
+    exited = {}
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        while True:
+            time.sleep(1)
+            for process, child in enumerate(children):
+                if child.poll() is None:
+                    continue
+
+                # Give a crashing process a moment before restarting it.
+                since = exited.setdefault(process, time.monotonic())
+                if time.monotonic() - since < RESTART_DELAY:
+                    continue
+
+                print("Process {} exited with {}".format(process,
+                                                         child.returncode))
+                del exited[process]
+                children[process] = spawn(process, ranges[process], shards,
+                                          len(ranges))
+    except KeyboardInterrupt:
+        for child in children:
+            if child.poll() is None:
+                child.terminate()
+        for child in children:
+            child.wait()
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Run vishnu as several sharded processes.")
+    parser.add_argument('--processes', type=int,
+                        help="number of bot processes")
+    parser.add_argument('--shards', type=int,
+                        help="total number of shards")
+
+    sys.exit(main(parser.parse_args()))
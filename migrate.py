@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Database maintenance for vishnu.
+
+python3 migrate.py [--drop]
+    Copies the tables of the old table-per-guild layout ("<guild>_quests",
+    "<guild>_groups", "<guild>_config") into the shared tables. --drop
+    removes the old tables once they have been copied. Run it before
+    starting the upgraded bot for the first time: the bot won't start
+    while there are old tables that haven't been copied.
+
+python3 migrate.py --check-indexes
+    EXPLAINs every shape of the list queries and fails if one of them
+    can't use an index.
+"""
+
+import sys
+import asyncio
+import modules.pgsql as pgsql
+
+
+async def migrate(pg, drop):
+    copied, conflicts = await pg.migrate_legacy_tables(drop=drop)
+    print(f"Copied {copied} table(s)")
+
+    for table, skipped in conflicts:
+        print(f"Kept {table}: {skipped} row(s) have IDs that were reused "
+              f"after the upgrade and weren't copied")
+
+    return 1 if conflicts else 0
+
+
+async def check_indexes(pg):
+    await pg.migrate_shared_tables()
+
+    failed = 0
+    for name, nodes, uses_index in await pg.check_indexes():
+        status = "ok" if uses_index else "SEQ SCAN"
+        print(f"{status:8} {name}: {' > '.join(nodes)}")
+        if not uses_index:
+            failed += 1
+
+    return 1 if failed else 0
+
+
+async def main(args):
+    pg = pgsql.pgSQLManagement()
+    await pg.connect()
+
+    try:
+        if '--check-indexes' in args:
+            return await check_indexes(pg)
+        return await migrate(pg, '--drop' in args)
+    finally:
+        await pg.close()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    sys.exit(loop.run_until_complete(main(sys.argv[1:])))
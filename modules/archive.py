@@ -0,0 +1,167 @@
+"""
+Archives groups whose sessions are long over.
+"""
+
+import asyncio
+import datetime
+import traceback
+import discord
+from modules.config import config
+
+# Seconds between the other processes' checks for whether the archiving
+# process is still around.
+LEADER_RETRY = 60
+
+
+class Archiver:
+    """
+    Moves expired groups to the groups_archive table and deletes their
+    roles and channels.
+
+    A group is expired once its start date is more than
+    archive.retention_days days ago. Every archive.interval_hours hours
+    the expired groups of all guilds are moved in batches of
+    archive.batch_size, each batch one statement. Their Discord objects go
+    on a queue that a few workers empty through the bot's RouteLimiter, so
+    archiving hundreds of groups doesn't hit Discord's rate limits.
+
+    With several bot processes, only the one holding the 'archiver' lock
+    runs the job; the others check every LEADER_RETRY seconds whether
+    they should take over. It publishes every archived group, and each
+    process tears down the ones in its own guilds.
+    """
+
+    def __init__(self, bot, workers=2):
+        self.bot = bot
+        self.workers = workers
+
+        self._queue = asyncio.Queue()
+        self._tasks = []
+
+    @staticmethod
+    def settings():
+        settings = config.get('archive') or {}
+        return {
+            'retention_days': settings.get('retention_days', 30),
+            'interval_hours': settings.get('interval_hours', 24),
+            'batch_size': settings.get('batch_size', 500),
+            'dry_run': settings.get('dry_run', False),
+        }
+
+    def start(self):
+        """
+        Starts the periodic job and the teardown workers, if they aren't
+        running yet.
+        """
+
+        if self._tasks:
+            return
+
+        self.bot.coordinator.on('archived', self.forget)
+        self._tasks.append(self.bot.loop.create_task(self.run()))
+        for worker in range(self.workers):
+            self._tasks.append(self.bot.loop.create_task(self.teardown()))
+
+    async def run(self):
+        while True:
+            settings = self.settings()
+            try:
+                if not await self.bot.coordinator.leader('archiver'):
+                    # Take over soon if the leader goes away.
+                    await asyncio.sleep(LEADER_RETRY)
+                    continue
+
+                groups = await self.archive(None,
+                                            dry_run=settings['dry_run'])
+                print("{} {} expired group(s)".format(
+                    "Found" if settings['dry_run'] else "Archived",
+                    len(groups)))
+            except Exception:
+                traceback.print_exc()
+
+            await asyncio.sleep(settings['interval_hours'] * 3600)
+
+    async def archive(self, guild_ids, dry_run=False):
+        """
+        Archives the expired groups of the given guilds, or of every guild
+        if guild_ids is None, and queues their roles and channels for
+        deletion. With dry_run, only returns the groups that would be
+        archived.
+        """
+
+        settings = self.settings()
+        before = (datetime.datetime.utcnow().date() -
+                  datetime.timedelta(days=settings['retention_days']))
+        batch_size = settings['batch_size']
+
+        if dry_run:
+            # A dry run reports at most one batch.
+            return await self.bot.pg.expired_groups(before, guild_ids,
+                                                    batch_size)
+
+        archived = []
+        while True:
+            groups = await self.bot.pg.archive_groups(before, guild_ids,
+                                                      batch_size)
+            archived.extend(groups)
+
+            for group in groups:
+                objects = (group['guild_id'], group['id'], group['role_id'],
+                           group['text_channel_id'],
+                           group['voice_channel_id'])
+                self.forget(*objects)
+                self.bot.coordinator.publish('archived', *objects)
+
+            if len(groups) < batch_size:
+                return archived
+
+    def forget(self, guild_id, group_id, role_id, text_channel_id,
+               voice_channel_id):
+        """
+        Drops an archived group and queues its Discord objects for
+        deletion, if its guild belongs to this process.
+        """
+
+        if self.bot.get_guild(guild_id) is None:
+            return
+
+        self.bot.groups.remove(guild_id, group_id)
+        self.bot.reminders.remove(guild_id, group_id)
+
+        for kind, object_id in (('role_id', role_id),
+                                ('text_channel_id', text_channel_id),
+                                ('voice_channel_id', voice_channel_id)):
+            if object_id is not None:
+                self._queue.put_nowait((guild_id, kind, object_id))
+
+    def pending(self):
+        """
+        Returns how many roles and channels are waiting to be deleted.
+        """
+
+        return self._queue.qsize()
+
+    async def teardown(self):
+        while True:
+            guild_id, kind, object_id = await self._queue.get()
+            try:
+                guild = self.bot.get_guild(guild_id)
+                if guild is None:
+                    continue
+
+                if kind == 'role_id':
+                    route = ('roles', guild_id)
+                    target = guild.get_role(object_id)
+                else:
+                    route = ('channels', guild_id)
+                    target = guild.get_channel(object_id)
+
+                if target is not None:
+                    await self.bot.limiter.run(route, target.delete,
+                                               reason="Group archived.")
+            except discord.NotFound:
+                pass
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
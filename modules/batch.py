@@ -0,0 +1,40 @@
+"""
+Coalesces events that arrive close together into one batch.
+"""
+
+import asyncio
+import traceback
+
+
+class Batcher:
+    """
+    Collects items per key and hands them to flush(key, items) once the
+    first item for that key is window seconds old.
+    """
+
+    def __init__(self, window, flush):
+        self.window = window
+        self.flush = flush
+
+        self._pending = {}
+
+    def add(self, key, item):
+        """
+        Queues item under key, starting the window if it's the first.
+        """
+
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = []
+            asyncio.ensure_future(self._flush_later(key))
+
+        pending.append(item)
+
+    async def _flush_later(self, key):
+        await asyncio.sleep(self.window)
+
+        items = self._pending.pop(key)
+        try:
+            await self.flush(key, items)
+        except Exception:
+            traceback.print_exc()
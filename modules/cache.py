@@ -0,0 +1,233 @@
+"""
+In-process result cache for vishnu.
+"""
+
+import sys
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A size-bounded LRU whose entries also expire after ttl seconds. With
+    max_memory, entries are also evicted while the approximate memory use
+    is over that many bytes.
+
+    Subclasses decide what the keys mean, and can keep track of entries
+    coming and going in _added() and _removed().
+    """
+
+    def __init__(self, ttl=60, max_entries=1000, max_memory=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.memory = 0
+
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Returns the cached value for key, or None.
+        """
+
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        value, expires, size = entry
+        if expires < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Stores value under key, evicting the least recently used entries
+        if the cache is full.
+        """
+
+        if self.max_entries <= 0:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+
+        size = self._sizeof(value)
+        self._entries[key] = (value, time.monotonic() + self.ttl, size)
+        self._added(key)
+        self.memory += size
+
+        while len(self._entries) > self.max_entries or (
+                self.max_memory is not None and
+                self.memory > self.max_memory):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Drops everything.
+        """
+
+        self._entries.clear()
+        self.memory = 0
+
+    def stats(self):
+        """
+        Returns the hit rate, entry count and approximate memory use.
+        """
+
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': len(self._entries),
+            'evictions': self.evictions,
+            'memory_bytes': self.memory,
+        }
+
+    def _remove(self, key):
+        value, expires, size = self._entries.pop(key)
+        self.memory -= size
+        self._removed(key)
+
+    def _added(self, key):
+        pass
+
+    def _removed(self, key):
+        pass
+
+    @staticmethod
+    def _sizeof(value):
+        return sys.getsizeof(value)
+
+
+class ResultCache(LRUCache):
+    """
+    An LRU of query results.
+
+    Keys are tuples that start with (table, guild_id, ...). Writes call
+    invalidate(table, guild_id), which drops every entry of that table
+    for that guild and nothing else, bumps the version of that table for
+    that guild, and tells every function in listeners so other processes
+    can do the same.
+    """
+
+    def __init__(self, ttl=60, max_entries=1000):
+        super().__init__(ttl, max_entries)
+        self.invalidations = 0
+        self.listeners = []
+
+        # (table, guild_id): how many times it has been invalidated.
+        self.versions = {}
+
+        self._index = {}
+
+    def version(self, table, guild_id):
+        """
+        Returns a number that changes whenever table is invalidated for
+        guild_id.
+        """
+
+        return self.versions.get((table, guild_id), 0)
+
+    def invalidate(self, table, guild_id, broadcast=True):
+        """
+        Drops every cached result of table for guild_id. Listeners are
+        called unless broadcast is False.
+        """
+
+        self.versions[(table, guild_id)] = self.version(table, guild_id) + 1
+
+        for key in list(self._index.get((table, guild_id), ())):
+            self._remove(key)
+            self.invalidations += 1
+
+        if broadcast:
+            for listener in self.listeners:
+                listener(table, guild_id)
+
+    def set(self, key, value, version=None):
+        """
+        Stores value under key. Pass the version() of key's table taken
+        before fetching value; if the table was invalidated since, value
+        may be stale and isn't stored.
+        """
+
+        if version is not None and version != self.version(*key[:2]):
+            return
+
+        super().set(key, value)
+
+    def clear(self):
+        super().clear()
+        self._index.clear()
+
+    def stats(self):
+        stats = super().stats()
+        stats['invalidations'] = self.invalidations
+        return stats
+
+    def _added(self, key):
+        self._index.setdefault(key[:2], set()).add(key)
+
+    def _removed(self, key):
+        keys = self._index.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._index[key[:2]]
+
+    @staticmethod
+    def _sizeof(rows):
+        """
+        Rough size in bytes of a list of records.
+        """
+
+        size = sys.getsizeof(rows)
+        for row in rows:
+            size += sys.getsizeof(row)
+            for value in row:
+                size += sys.getsizeof(value)
+        return size
+
+
+class PageCache(LRUCache):
+    """
+    An LRU of rendered list pages.
+
+    Keys start with (table, guild_id, ...) like those of a ResultCache.
+    key() adds the table's current version from results, so a write to
+    the table leaves the pages rendered before it unreachable; they're
+    never looked up again and fall out of the LRU.
+    """
+
+    def __init__(self, results, ttl=60, max_entries=500):
+        super().__init__(ttl, max_entries)
+        self.results = results
+
+    def key(self, key):
+        """
+        Returns key with the current version of its table. Take it before
+        fetching the rows of a page, so a write during the fetch doesn't
+        leave the page cached as current.
+        """
+
+        return key[:2] + (self.results.version(*key[:2]),) + key[2:]
+
+    @staticmethod
+    def _sizeof(page):
+        """
+        Rough size in bytes of a page, a tuple that starts with its text.
+        """
+
+        return sys.getsizeof(page) + sum(sys.getsizeof(value)
+                                         for value in page)
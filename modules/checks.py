@@ -0,0 +1,23 @@
+"""
+Command checks for vishnu.
+"""
+
+from discord.ext import commands
+from modules.config import config
+
+
+def role_whitelisted():
+    """
+    Allows a command only for members with a role in the guild's
+    role_whitelist, matched by name or ID.
+    """
+
+    async def predicate(ctx):
+        if ctx.guild is None:
+            return False
+
+        whitelist = config.option(ctx.guild.id, 'role_whitelist') or []
+        return any(role.name in whitelist or role.id in whitelist
+                   for role in ctx.author.roles)
+
+    return commands.check(predicate)
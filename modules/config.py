@@ -0,0 +1,142 @@
+"""
+Configuration for vishnu.
+
+config.yaml is read once, here. Every other module imports the shared
+config object instead of parsing the file itself.
+"""
+
+import os
+import yaml
+import asyncio
+
+# Options a guild can override in its guild_config rows.
+GUILD_OPTIONS = [
+    'chan_whitelist',
+    'group_category',
+    'announce_chan',
+    'role_whitelist',
+    'quest_tiers',
+]
+
+# Options whose value is a list; commands check membership in them.
+LIST_OPTIONS = [
+    'chan_whitelist',
+    'role_whitelist',
+    'quest_tiers',
+]
+
+
+class Config:
+    """
+    The contents of config.yaml, plus each guild's overrides from the
+    guild_config table.
+
+    config['key'] and config.get('key') read the file. option(guild_id,
+    'key') returns the guild's override if it has one, or the file's
+    value otherwise. Both are plain dictionary lookups; the database is
+    only read by load_guilds().
+    """
+
+    def __init__(self, path="config.yaml"):
+        self.path = path
+        self.data = {}
+        self.mtime = None
+
+        self._guilds = {}
+        self._watching = False
+
+        self.reload()
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def reload(self, force=False):
+        """
+        Re-reads config.yaml if it changed on disk, or always with force.
+        Returns True if it was read.
+        """
+
+        mtime = os.path.getmtime(self.path)
+        if mtime == self.mtime and not force:
+            return False
+
+        with open(self.path) as config_file:
+            self.data = yaml.safe_load(config_file)
+        self.mtime = mtime
+
+        return True
+
+    def option(self, guild_id, key):
+        """
+        Returns a guild's setting for key.
+        """
+
+        overrides = self._guilds.get(guild_id)
+        if overrides is not None and key in overrides:
+            return overrides[key]
+
+        return self.data.get(key)
+
+    def guild(self, guild_id):
+        """
+        Returns every per-guild option for a guild.
+        """
+
+        return {key: self.option(guild_id, key) for key in GUILD_OPTIONS}
+
+    async def load_guilds(self, pg, guild_ids):
+        """
+        Loads the overrides of the given guilds from the database.
+        """
+
+        rows = await pg.retrieve_guild_config(guild_ids)
+
+        for guild_id in guild_ids:
+            self._guilds[guild_id] = {}
+
+        for row in rows:
+            value = yaml.safe_load(row['value'])
+            if row['option'] in LIST_OPTIONS and not isinstance(
+                    value, (list, type(None))):
+                # Stored by !configset before it made lists of these.
+                value = [value]
+            self._guilds[row['guild_id']][row['option']] = value
+
+    async def set_option(self, pg, guild_id, key, value):
+        """
+        Stores a guild's override for key. A value of None removes it.
+        """
+
+        if value is None:
+            await pg.set_guild_config(guild_id, key, None)
+            self._guilds.get(guild_id, {}).pop(key, None)
+        else:
+            await pg.set_guild_config(guild_id, key, yaml.safe_dump(value))
+            self._guilds.setdefault(guild_id, {})[key] = value
+
+    async def watch(self, interval=5):
+        """
+        Reloads config.yaml whenever it changes. Runs until cancelled;
+        calling it again while it runs does nothing.
+        """
+
+        if self._watching:
+            return
+
+        self._watching = True
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    if self.reload():
+                        print("Reloaded {}".format(self.path))
+                except (OSError, yaml.YAMLError) as e:
+                    print("Could not reload {}: {}".format(self.path, e))
+        finally:
+            self._watching = False
+
+
+config = Config()
@@ -0,0 +1,213 @@
+"""
+Coordination between bot processes through PostgreSQL.
+
+When launcher.py runs several bot processes, each one owns the guilds of
+its shards, but they share the database. Each process keeps one
+dedicated connection that LISTENs on a channel every process publishes
+to, and holds the session-level advisory locks that decide which process
+runs the jobs that should only run once.
+"""
+
+import os
+import json
+import socket
+import asyncio
+import traceback
+
+try:
+    import contextvars
+except ImportError:
+    # Python 3.6: tasks don't carry a context.
+    contextvars = None
+
+CHANNEL = 'vishnu'
+
+# Advisory lock keys of the jobs only one process runs. Key 0 serializes
+# migrations.
+LOCKS = {
+    'archiver': 1,
+}
+
+# Seconds between checks of the listening connection, and between
+# attempts to open it again once it has dropped.
+HEARTBEAT = 30
+RECONNECT_DELAY = 5
+
+# True if this session holds the lock, taking it if nobody does. A bigint
+# advisory lock key shows up in pg_locks split into classid and objid.
+LEADER_QUERY = """
+SELECT CASE WHEN EXISTS (
+    SELECT 1 FROM pg_locks
+    WHERE locktype = 'advisory' AND
+    classid = ($1 >> 32)::oid AND
+    objid = ($1 & 4294967295)::oid AND
+    objsubid = 1 AND
+    pid = pg_backend_pid() AND
+    granted)
+THEN true
+ELSE pg_try_advisory_lock($1)
+END;
+"""
+
+
+class Coordinator:
+    """
+    Publishes events to the other bot processes and calls handlers for
+    the events they publish.
+
+    Cache invalidations are forwarded automatically: a write in one
+    process drops the stale results in every process. Other events are
+    registered with on(kind, handler).
+    """
+
+    def __init__(self, pg):
+        self.pg = pg
+        self.conn = None
+        self.sender = "{}:{}".format(socket.gethostname(), os.getpid())
+
+        self._handlers = {'invalidate': self.invalidated}
+        self._outbox = []
+        self._busy = asyncio.Lock()
+        self._watcher = None
+
+    async def connect(self):
+        """
+        Opens the listening connection, starts forwarding cache
+        invalidations and keeps the connection open from then on. Safe
+        to call more than once.
+        """
+
+        if self.conn is not None:
+            return
+
+        self.conn = await self.listen()
+        self.pg.cache.listeners.append(self.invalidate)
+        self._watcher = asyncio.ensure_future(self.watch())
+
+    async def listen(self):
+        conn = await self.pg.dedicated_connection()
+        await conn.add_listener(CHANNEL, self.received)
+        return conn
+
+    async def watch(self):
+        """
+        Checks the listening connection every HEARTBEAT seconds and opens
+        a new one when it has dropped.
+        """
+
+        while True:
+            await asyncio.sleep(HEARTBEAT)
+            try:
+                async with self._busy:
+                    await asyncio.wait_for(self.conn.fetchval("SELECT 1"),
+                                           HEARTBEAT)
+                continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print("Lost the coordination connection, reconnecting")
+
+            self.conn.terminate()
+            while True:
+                try:
+                    conn = await self.listen()
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    traceback.print_exc()
+                    await asyncio.sleep(RECONNECT_DELAY)
+
+            self.conn = conn
+
+            # Invalidations sent while nobody was listening were missed.
+            self.pg.cache.clear()
+            self.pg.pages.clear()
+
+    async def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+    def on(self, kind, handler):
+        """
+        Calls handler(*values) when another process publishes kind.
+        """
+
+        self._handlers[kind] = handler
+
+    def publish(self, kind, *values):
+        """
+        Sends an event to every other process. Events published in the
+        same iteration of the event loop go out in one statement.
+        """
+
+        if self.conn is None:
+            return
+
+        if not self._outbox:
+            # Sent from an empty context, so the metrics don't charge the
+            # NOTIFY to the command that published the event.
+            if contextvars is not None:
+                contextvars.Context().run(asyncio.ensure_future,
+                                          self._send())
+            else:
+                asyncio.ensure_future(self._send())
+        self._outbox.append(json.dumps([self.sender, kind, values]))
+
+    async def _send(self):
+        await asyncio.sleep(0)
+        payloads, self._outbox = self._outbox, []
+
+        try:
+            async with self.pg.acquire() as conn:
+                await conn.execute("""
+                SELECT pg_notify($1, payload)
+                FROM unnest($2::text[]) AS payload;
+                """, CHANNEL, payloads)
+        except Exception:
+            traceback.print_exc()
+
+    def received(self, conn, pid, channel, payload):
+        try:
+            sender, kind, values = json.loads(payload)
+            if sender == self.sender:
+                return
+
+            handler = self._handlers.get(kind)
+            if handler is not None:
+                handler(*values)
+        except Exception:
+            traceback.print_exc()
+
+    def invalidate(self, table, guild_id):
+        self.publish('invalidate', table, guild_id)
+
+    def invalidated(self, table, guild_id):
+        self.pg.cache.invalidate(table, guild_id, broadcast=False)
+
+    async def leader(self, job):
+        """
+        Returns True if this process runs job. The first process to ask
+        holds the lock until its connection closes, then another process
+        takes over the next time it asks. Ask before every run: the
+        answer is checked against the current connection each time.
+        """
+
+        if self.conn is None:
+            return True
+
+        try:
+            async with self._busy:
+                return await asyncio.wait_for(
+                    self.conn.fetchval(LEADER_QUERY, LOCKS[job]), HEARTBEAT)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The connection is down; watch() replaces it.
+            traceback.print_exc()
+            return False
@@ -0,0 +1,468 @@
+"""
+Dice expression parser and roller for vishnu.
+
+Expressions look like 1d20+5, 4d6kh3, 2d20kl1+5, 8d6!, 4d6r1, d% or
+6x(4d6kh3). parse() turns the text into a tree, compile_tree() turns the
+tree into a function that rolls any number of samples at once with
+NumPy, so a roll costs a handful of array operations however many dice
+it has.
+
+Supported dice modifiers, written after NdS:
+
+    khN / kN    keep the N highest dice
+    klN         keep the N lowest dice
+    dhN         drop the N highest dice
+    dlN         drop the N lowest dice
+    !           explode: a die that rolls its maximum is rolled again and
+                added to that die, as long as it keeps rolling the maximum
+    rN, r<N ... reroll (once) dice equal to, below, above, ... N
+
+Dice can be combined with numbers using + - * / and parentheses. A
+leading "Nx" repeats the whole expression N times.
+"""
+
+import re
+import functools
+import numpy as np
+from collections import namedtuple
+
+MAX_DICE = 10000
+MAX_SIDES = 10000
+MAX_REPEAT = 1000
+MAX_EXPLODE = 100
+
+# Most dice one expression rolls, counting every term and repeat.
+MAX_TOTAL_DICE = 10000
+
+# Shared random source. RandomState works with every supported NumPy.
+random = np.random.RandomState()
+
+Number = namedtuple('Number', ['value'])
+Dice = namedtuple('Dice', ['count', 'sides', 'keep', 'explode', 'reroll'])
+BinOp = namedtuple('BinOp', ['op', 'left', 'right'])
+Negate = namedtuple('Negate', ['operand'])
+Repeat = namedtuple('Repeat', ['times', 'expr'])
+
+TOKEN = re.compile(r"\s*(?:(\d+)|(kh|kl|dh|dl|k|d|!|r|x|<=|>=|<|>|=|%|"
+                   r"\+|-|\*|/|\(|\)))")
+
+COMPARE = {
+    '=': np.equal,
+    '<': np.less,
+    '>': np.greater,
+    '<=': np.less_equal,
+    '>=': np.greater_equal,
+}
+
+
+class DiceError(ValueError):
+    """
+    Raised for expressions that can't be parsed or rolled.
+    """
+
+
+def tokenize(text):
+    """
+    Splits an expression into number and operator tokens.
+    """
+
+    tokens = []
+    position = 0
+    text = text.lower().strip()
+
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None:
+            raise DiceError("Unexpected '{}'."
+                            .format(text[position:].strip()[:1]))
+        number, op = match.groups()
+        tokens.append(int(number) if number is not None else op)
+        position = match.end()
+
+    return tokens
+
+
+class Parser:
+    """
+    Recursive descent parser over the tokens of one expression.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None:
+            raise DiceError("Unexpected end of expression.")
+        if expected is not None and token != expected:
+            raise DiceError("Expected '{}' but found '{}'."
+                            .format(expected, token))
+        self.position += 1
+        return token
+
+    def number(self):
+        token = self.take()
+        if not isinstance(token, int):
+            raise DiceError("Expected a number but found '{}'.".format(token))
+        return token
+
+    def parse(self):
+        tree = None
+
+        if isinstance(self.peek(), int) and \
+                self.position + 1 < len(self.tokens) and \
+                self.tokens[self.position + 1] == 'x':
+            times = self.take()
+            self.take('x')
+            if not 1 <= times <= MAX_REPEAT:
+                raise DiceError("Can only repeat 1 to {} times."
+                                .format(MAX_REPEAT))
+            tree = Repeat(times, self.expr())
+        else:
+            tree = self.expr()
+
+        if self.peek() is not None:
+            raise DiceError("Unexpected '{}'.".format(self.peek()))
+
+        return tree
+
+    def expr(self):
+        tree = self.term()
+        while self.peek() in ('+', '-'):
+            op = self.take()
+            tree = BinOp(op, tree, self.term())
+        return tree
+
+    def term(self):
+        tree = self.unary()
+        while self.peek() in ('*', '/'):
+            op = self.take()
+            tree = BinOp(op, tree, self.unary())
+        return tree
+
+    def unary(self):
+        if self.peek() == '-':
+            self.take()
+            return Negate(self.unary())
+        return self.atom()
+
+    def atom(self):
+        token = self.peek()
+
+        if token == '(':
+            self.take()
+            tree = self.expr()
+            self.take(')')
+            return tree
+
+        if token == 'd':
+            return self.dice(1)
+
+        if isinstance(token, int):
+            count = self.take()
+            if self.peek() == 'd':
+                return self.dice(count)
+            return Number(count)
+
+        raise DiceError("Unexpected '{}'.".format(token)
+                        if token is not None else
+                        "Unexpected end of expression.")
+
+    def dice(self, count):
+        self.take('d')
+
+        if self.peek() == '%':
+            self.take()
+            sides = 100
+        else:
+            sides = self.number()
+
+        if not 1 <= count <= MAX_DICE:
+            raise DiceError("Can only roll 1 to {} dice at once."
+                            .format(MAX_DICE))
+        if not 1 <= sides <= MAX_SIDES:
+            raise DiceError("Dice can have 1 to {} sides.".format(MAX_SIDES))
+
+        keep = None
+        explode = False
+        reroll = None
+
+        while True:
+            token = self.peek()
+
+            if token in ('kh', 'kl', 'dh', 'dl', 'k'):
+                self.take()
+                amount = self.number() if isinstance(self.peek(), int) else 1
+                if keep is not None:
+                    raise DiceError("Only one keep or drop per dice.")
+                if amount > count:
+                    raise DiceError("Can't keep or drop {} of {} dice."
+                                    .format(amount, count))
+                # Everything becomes "keep the highest/lowest N".
+                if token in ('kh', 'k'):
+                    keep = ('h', amount)
+                elif token == 'kl':
+                    keep = ('l', amount)
+                elif token == 'dh':
+                    keep = ('l', count - amount)
+                else:
+                    keep = ('h', count - amount)
+            elif token == '!':
+                self.take()
+                if sides < 2:
+                    raise DiceError("Can't explode dice with one side.")
+                explode = True
+            elif token == 'r':
+                self.take()
+                compare = '='
+                if self.peek() in COMPARE:
+                    compare = self.take()
+                reroll = (compare, self.number())
+            else:
+                break
+
+        return Dice(count, sides, keep, explode, reroll)
+
+
+@functools.lru_cache(maxsize=256)
+def parse(text):
+    """
+    Parses an expression into a tree of Number, Dice, BinOp, Negate and
+    Repeat tuples. Results are cached, the trees are immutable.
+    """
+
+    tokens = tokenize(text)
+    if not tokens:
+        raise DiceError("Empty expression.")
+
+    tree = Parser(tokens).parse()
+    if count_dice(tree) > MAX_TOTAL_DICE:
+        raise DiceError("Can only roll up to {} dice in one expression."
+                        .format(MAX_TOTAL_DICE))
+
+    return tree
+
+
+def count_dice(tree):
+    """
+    Returns how many dice rolling tree takes, not counting explosions and
+    rerolls.
+    """
+
+    if isinstance(tree, Dice):
+        return tree.count
+    if isinstance(tree, BinOp):
+        return count_dice(tree.left) + count_dice(tree.right)
+    if isinstance(tree, Negate):
+        return count_dice(tree.operand)
+    if isinstance(tree, Repeat):
+        return tree.times * count_dice(tree.expr)
+    return 0
+
+
+def describe(tree):
+    """
+    Turns a tree back into canonical expression text.
+    """
+
+    if isinstance(tree, Number):
+        return str(tree.value)
+
+    if isinstance(tree, Dice):
+        text = "{}d{}".format(tree.count, tree.sides)
+        if tree.keep is not None:
+            text += "k{}{}".format(*tree.keep)
+        if tree.explode:
+            text += "!"
+        if tree.reroll is not None:
+            compare, value = tree.reroll
+            text += "r{}{}".format('' if compare == '=' else compare, value)
+        return text
+
+    if isinstance(tree, BinOp):
+        return "({} {} {})".format(describe(tree.left), tree.op,
+                                   describe(tree.right))
+
+    if isinstance(tree, Negate):
+        return "-{}".format(describe(tree.operand))
+
+    return "{}x({})".format(tree.times, expression_text(tree.expr))
+
+
+def expression_text(tree):
+    """
+    Like describe(), without the parentheses around the outermost
+    operation.
+    """
+
+    text = describe(tree)
+    if isinstance(tree, BinOp):
+        return text[1:-1]
+    return text
+
+
+def roll_dice(dice, samples):
+    """
+    Rolls samples sets of dice. Returns the (samples, count) array of die
+    values after rerolls and explosions, and a boolean array of the same
+    shape marking the dice that are kept.
+    """
+
+    count, sides = dice.count, dice.sides
+    values = random.randint(1, sides + 1, size=(samples, count))
+
+    if dice.reroll is not None:
+        compare, target = dice.reroll
+        mask = COMPARE[compare](values, target)
+        rerolls = int(mask.sum())
+        if rerolls:
+            values[mask] = random.randint(1, sides + 1, size=rerolls)
+
+    if dice.explode:
+        pending = values == sides
+        depth = 0
+        while depth < MAX_EXPLODE:
+            extra = int(pending.sum())
+            if not extra:
+                break
+            rolled = random.randint(1, sides + 1, size=extra)
+            values[pending] += rolled
+            pending[pending] = rolled == sides
+            depth += 1
+
+    kept = np.ones(values.shape, dtype=bool)
+    if dice.keep is not None and dice.keep[1] < count:
+        direction, amount = dice.keep
+        order = np.argsort(values, axis=1, kind='stable')
+        if direction == 'h':
+            dropped = order[:, :count - amount]
+        else:
+            dropped = order[:, amount:]
+        np.put_along_axis(kept, dropped, False, axis=1)
+
+    return values, kept
+
+
+def compile_tree(tree):
+    """
+    Turns a tree into roller(samples, details) returning an int64 array of
+    samples totals. If details is a list, the dice rolled for the first
+    sample are appended to it as (dice, values, kept).
+    """
+
+    if isinstance(tree, Number):
+        value = tree.value
+
+        def roller(samples, details):
+            return np.full(samples, value, dtype=np.int64)
+
+        return roller
+
+    if isinstance(tree, Dice):
+        dice = tree
+
+        def roller(samples, details):
+            values, kept = roll_dice(dice, samples)
+            if details is not None:
+                details.append((dice, values[0], kept[0]))
+            return np.where(kept, values, 0).sum(axis=1, dtype=np.int64)
+
+        return roller
+
+    if isinstance(tree, Negate):
+        operand = compile_tree(tree.operand)
+
+        def roller(samples, details):
+            return -operand(samples, details)
+
+        return roller
+
+    if isinstance(tree, BinOp):
+        left = compile_tree(tree.left)
+        right = compile_tree(tree.right)
+        op = tree.op
+
+        def roller(samples, details):
+            a = left(samples, details)
+            b = right(samples, details)
+            if op == '+':
+                return a + b
+            if op == '-':
+                return a - b
+            if op == '*':
+                return a * b
+            if np.any(b == 0):
+                raise DiceError("Division by zero.")
+            return np.floor_divide(a, b)
+
+        return roller
+
+    raise DiceError("Repeats can only be used at the start of an expression.")
+
+
+class Roller:
+    """
+    A compiled expression.
+    """
+
+    def __init__(self, text):
+        self.tree = parse(text)
+        self.text = expression_text(self.tree)
+
+        if isinstance(self.tree, Repeat):
+            self.times = self.tree.times
+            self.roller = compile_tree(self.tree.expr)
+        else:
+            self.times = None
+            self.roller = compile_tree(self.tree)
+
+    def sample(self, samples):
+        """
+        Returns samples totals of the expression (ignoring any repeat).
+        """
+
+        return self.roller(samples, None)
+
+    def roll(self):
+        """
+        Rolls the expression once. Returns a list of totals, one per
+        repeat, and the dice rolled for the first of them.
+        """
+
+        details = []
+        totals = self.roller(self.times or 1, details)
+        return [int(total) for total in totals], details
+
+
+@functools.lru_cache(maxsize=256)
+def compile_expression(text):
+    """
+    Returns the Roller for an expression, compiling it the first time.
+    """
+
+    return Roller(text.lower().replace(" ", ""))
+
+
+def format_details(details, max_dice=20):
+    """
+    Formats the dice of one roll, striking through the dropped ones.
+    Dice with more than max_dice dice are summarized instead.
+    """
+
+    parts = []
+    for dice, values, kept in details:
+        if len(values) > max_dice:
+            parts.append("{}: {} dice".format(describe(dice), len(values)))
+            continue
+
+        shown = ", ".join(str(value) if keep else "~~{}~~".format(value)
+                          for value, keep in zip(values, kept))
+        parts.append("{}: [{}]".format(describe(dice), shown))
+
+    return " ".join(parts)
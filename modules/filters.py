@@ -0,0 +1,226 @@
+"""
+Filters for the quest and group lists.
+
+!questlist and !grouplist take the same kind of arguments:
+
+    id=12           one value
+    tier=TIER-1,TIER-2
+                    any of several values
+    id=10..20       a range, either end may be left out (id=10..)
+    date=2019-06-01..2019-06-30
+                    groups starting in a range of dates
+    open / full     groups with or without free places
+    sort=date       order by a column, sort=-date for descending
+
+parse() turns them into a Filter, which pgsql.list_query() compiles into
+a statement with only the predicates it needs. Filters with the same
+columns and operators share one statement.
+"""
+
+import re
+import datetime
+from collections import namedtuple
+
+
+class FilterError(ValueError):
+    """
+    Raised for list arguments that aren't valid filters.
+    """
+
+
+# key=value, the value being one value, a comma separated list or a
+# low..high range.
+TERM = re.compile(r'(?P<key>\w+)=(?P<value>.*)', re.S)
+RANGE = re.compile(r'(?P<low>.*?)\.\.(?P<high>.*)', re.S)
+
+# Most values one key=a,b,c filter takes.
+MAX_VALUES = 25
+
+# IDs are SERIAL columns.
+MAX_ID = 2 ** 31 - 1
+
+
+def parse_id(text):
+    if not text.isdigit() or int(text) > MAX_ID:
+        raise FilterError("IDs are whole numbers, not {}.".format(text))
+    return int(text)
+
+
+def parse_date(text):
+    try:
+        return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+    except ValueError:
+        raise FilterError("Dates look like 2019-06-30, not {}.".format(text))
+
+
+def parse_text(text):
+    return text
+
+
+# column is the column filtered on, position its index in the rows of
+# the list query, and ranged whether it takes low..high ranges.
+Field = namedtuple('Field', ['column', 'parse', 'ranged', 'position'])
+
+FIELDS = {
+    'quests': {
+        'id': Field('id', parse_id, True, 0),
+        'tier': Field('tier', parse_text, False, 1),
+        'creator': Field('creator', parse_text, False, 2),
+    },
+    'groups': {
+        'id': Field('id', parse_id, True, 0),
+        'creator': Field('creator', parse_text, False, 1),
+        'date': Field('start_date', parse_date, True, 2),
+    },
+}
+
+# Words that filter on their own, as (column, operator).
+FLAGS = {
+    'quests': {},
+    'groups': {
+        'open': ('member_count', 'open'),
+        'full': ('member_count', 'full'),
+    },
+}
+
+Predicate = namedtuple('Predicate', ['column', 'op', 'value'])
+
+
+class Filter(namedtuple('Filter', ['table', 'predicates', 'sort',
+                                   'descending'])):
+    """
+    A parsed list filter. Hashable, so it can be part of a cache key.
+    """
+
+    __slots__ = ()
+
+    def shape(self):
+        """
+        Returns what the statement of this filter depends on: everything
+        but the values.
+        """
+
+        return (self.table,
+                tuple((predicate.column, predicate.op)
+                      for predicate in self.predicates),
+                FIELDS[self.table][self.sort].column,
+                self.descending)
+
+    def args(self):
+        """
+        Returns the values of the predicates, in the order of their
+        parameters.
+        """
+
+        args = []
+        for predicate in self.predicates:
+            if predicate.op == 'between':
+                args.extend(predicate.value)
+            elif predicate.op == 'any':
+                args.append(list(predicate.value))
+            elif predicate.value is not None:
+                args.append(predicate.value)
+        return args
+
+    def cursor(self, row):
+        """
+        Returns the position of row in the list, to page after or before
+        it: its ID, or (sort column, ID) when sorting by another column.
+        """
+
+        if self.sort == 'id':
+            return row[0]
+        return (row[FIELDS[self.table][self.sort].position], row[0])
+
+
+def predicate(field, value):
+    """
+    Parses the value of one key=value filter.
+    """
+
+    match = RANGE.fullmatch(value) if field.ranged else None
+    if match is not None:
+        low, high = match.group('low'), match.group('high')
+        if low and high:
+            low, high = field.parse(low), field.parse(high)
+            if low > high:
+                raise FilterError("The range {} is empty.".format(value))
+            return Predicate(field.column, 'between', (low, high))
+        if low:
+            return Predicate(field.column, '>=', field.parse(low))
+        if high:
+            return Predicate(field.column, '<=', field.parse(high))
+        raise FilterError("A range needs at least one end.")
+
+    values = [part for part in value.split(',') if part]
+    if not values:
+        raise FilterError("Give {} a value.".format(field.column))
+    if len(values) > MAX_VALUES:
+        raise FilterError("Filter on up to {} values at once."
+                          .format(MAX_VALUES))
+
+    # Duplicates dropped, first seen order kept.
+    values = tuple(dict.fromkeys(field.parse(part) for part in values))
+    if len(values) == 1:
+        return Predicate(field.column, '=', values[0])
+    return Predicate(field.column, 'any', values)
+
+
+def parse(table, args):
+    """
+    Parses the arguments of a list command into a Filter.
+
+    Predicates are put in a fixed order, so the same filters written in
+    a different order run the same statement.
+    """
+
+    fields = FIELDS[table]
+    flags = FLAGS[table]
+
+    found = {}
+    sort = 'id'
+    descending = False
+
+    for arg in args:
+        word = arg.lower()
+        if word in flags:
+            if 'flag' in found:
+                raise FilterError("Use only one of {}.".format(
+                    " and ".join(flags)))
+            found['flag'] = Predicate(*flags[word], None)
+            continue
+
+        match = TERM.fullmatch(arg)
+        if match is None:
+            raise FilterError("Filters look like key=value, not {}."
+                              .format(arg))
+
+        key, value = match.group('key').lower(), match.group('value')
+        if key == 'sort':
+            descending = value.startswith('-')
+            sort = value.lstrip('-').lower()
+            if sort not in fields:
+                raise FilterError("Sort by one of: {}.".format(
+                    ", ".join(fields)))
+        elif key not in fields:
+            raise FilterError("Unknown filter {}. Filter on: {}.".format(
+                key, ", ".join(list(fields) + list(flags))))
+        elif key in found:
+            raise FilterError("Filter on {} only once; separate values "
+                              "with commas.".format(key))
+        else:
+            found[key] = predicate(fields[key], value)
+
+    predicates = tuple(found[key] for key in list(fields) + ['flag']
+                       if key in found)
+
+    return Filter(table, predicates, sort, descending)
+
+
+def joined_by(list_filter, user_id):
+    """
+    Narrows a group Filter to the groups user_id has joined.
+    """
+
+    return list_filter._replace(predicates=list_filter.predicates + (
+        Predicate('id', 'member', user_id),))
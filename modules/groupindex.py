@@ -0,0 +1,134 @@
+"""
+In-memory index of the Discord objects that belong to each group.
+"""
+
+from collections import namedtuple
+
+GroupObjects = namedtuple('GroupObjects', [
+    'guild_id',
+    'group_id',
+    'role_id',
+    'text_channel_id',
+    'voice_channel_id',
+    'announce_message_id',
+])
+
+
+class GroupIndex:
+    """
+    Maps groups to their role, channels and announcement, and those IDs
+    back to the group, so commands resolve them with dictionary lookups
+    instead of scanning every role and channel in the guild by name.
+
+    Rebuilt from the groups table on startup with load().
+    """
+
+    def __init__(self):
+        self._groups = {}
+        self._channels = {}
+        self._messages = {}
+
+    def add(self, objects):
+        """
+        Adds or replaces a group's objects.
+        """
+
+        self.remove(objects.guild_id, objects.group_id)
+
+        key = (objects.guild_id, objects.group_id)
+        self._groups[key] = objects
+        for channel_id in (objects.text_channel_id, objects.voice_channel_id):
+            if channel_id is not None:
+                self._channels[channel_id] = key
+        if objects.announce_message_id is not None:
+            self._messages[objects.announce_message_id] = key
+
+    def remove(self, guild_id, group_id):
+        """
+        Forgets a group. Returns its objects, or None.
+        """
+
+        objects = self._groups.pop((guild_id, group_id), None)
+        if objects is not None:
+            self._channels.pop(objects.text_channel_id, None)
+            self._channels.pop(objects.voice_channel_id, None)
+            self._messages.pop(objects.announce_message_id, None)
+
+        return objects
+
+    def group(self, guild_id, group_id):
+        """
+        Returns the objects of a group, or None.
+        """
+
+        return self._groups.get((guild_id, int(group_id)))
+
+    def by_channel(self, channel_id):
+        """
+        Returns the objects of the group that owns a channel, or None.
+        """
+
+        key = self._channels.get(channel_id)
+        return self._groups.get(key) if key is not None else None
+
+    def by_announcement(self, message_id):
+        """
+        Returns the objects of the group announced by a message, or None.
+        """
+
+        key = self._messages.get(message_id)
+        return self._groups.get(key) if key is not None else None
+
+    def __len__(self):
+        return len(self._groups)
+
+    async def load(self, bot):
+        """
+        Rebuilds the index for every guild the bot is in.
+
+        Groups created before their IDs were stored are matched to their
+        "group-<id>" role and channels by name once, and the IDs saved.
+        """
+
+        self._groups.clear()
+        self._channels.clear()
+        self._messages.clear()
+
+        rows = await bot.pg.retrieve_group_objects(
+            [guild.id for guild in bot.guilds])
+
+        by_name = {}
+        for row in rows:
+            objects = GroupObjects(**dict(row))
+
+            if objects.role_id is None:
+                guild = bot.get_guild(objects.guild_id)
+                if guild is None:
+                    continue
+
+                names = by_name.get(guild.id)
+                if names is None:
+                    names = by_name[guild.id] = named_objects(guild)
+
+                name = "group-{}".format(objects.group_id)
+                objects = objects._replace(
+                    role_id=names.get(('role', name)),
+                    text_channel_id=names.get(('channel', name + "-text")),
+                    voice_channel_id=names.get(('channel', name + "-voice")))
+
+                await bot.pg.set_group_objects(*objects)
+
+            self.add(objects)
+
+
+def named_objects(guild):
+    """
+    Returns the IDs of a guild's roles and channels, keyed by name.
+    """
+
+    names = {}
+    for role in guild.roles:
+        names[('role', role.name)] = role.id
+    for channel in guild.channels:
+        names[('channel', channel.name)] = channel.id
+    return names
@@ -0,0 +1,434 @@
+"""
+Latency and error metrics for vishnu.
+
+Commands are timed through the bot's before/after invoke hooks, and every
+pgSQLManagement method is timed by wrapping it, along with the time spent
+waiting for a pooled connection and the statements sent to the server.
+Database work is charged to the command that caused it.
+
+Everything is kept in plain dictionaries of counters and fixed-bucket
+histograms, so recording a value is a bisect and a few additions. The
+numbers are served in the Prometheus text format by serve() and
+summarized by the !stats command.
+"""
+
+import time
+import asyncio
+import inspect
+import functools
+from bisect import bisect_left
+
+try:
+    import contextvars
+except ImportError:
+    # Python 3.6: database work can't be charged to commands.
+    contextvars = None
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+# Connection methods that are one round trip each.
+ROUND_TRIPS = {'execute', 'executemany', 'fetch', 'fetchrow', 'fetchval',
+               'copy_records_to_table', 'copy_from_query'}
+
+# pgSQLManagement methods that aren't queries.
+UNTIMED = {'connect', 'close', 'dedicated_connection'}
+
+HELP = {
+    'vishnu_command_duration_seconds': "Time taken by commands.",
+    'vishnu_command_errors_total': "Commands that raised an error.",
+    'vishnu_command_db_round_trips_total':
+        "Statements sent to the database by commands.",
+    'vishnu_command_pool_wait_seconds_total':
+        "Time commands spent waiting for a database connection.",
+    'vishnu_query_duration_seconds': "Time taken by database methods.",
+    'vishnu_query_errors_total': "Database methods that raised an error.",
+    'vishnu_query_db_round_trips_total':
+        "Statements sent to the database by database methods.",
+    'vishnu_pool_wait_seconds': "Time spent waiting for a database "
+                                "connection.",
+    'vishnu_cache': "Result cache counters.",
+    'vishnu_pages': "Rendered list page cache counters.",
+    'vishnu_statements': "Estimated prepared statement reuse counters.",
+}
+
+
+class Histogram:
+    """
+    Counts of observations per bucket, plus their sum.
+    """
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        """
+        Estimates a quantile by interpolating inside its bucket, the way
+        Prometheus' histogram_quantile() does.
+        """
+
+        if not self.count:
+            return 0.0
+
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if index == len(BUCKETS):
+                    return BUCKETS[-1]
+                low = BUCKETS[index - 1] if index else 0.0
+                return low + (BUCKETS[index] - low) * (rank - seen) / count
+            seen += count
+
+        return BUCKETS[-1]
+
+
+class Timing:
+    """
+    What one command has done so far.
+    """
+
+    __slots__ = ('started', 'round_trips', 'pool_wait')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.round_trips = 0
+        self.pool_wait = 0.0
+
+
+class CountedConnection:
+    """
+    Forwards to an asyncpg connection, calling count() for every call
+    that goes to the server.
+    """
+
+    def __init__(self, conn, count):
+        self._conn = conn
+        self._count = count
+
+    def __getattr__(self, name):
+        attribute = getattr(self._conn, name)
+        if name in ROUND_TRIPS:
+            self._count()
+        return attribute
+
+
+class TimedAcquire:
+    """
+    Wraps pool.acquire(), timing the wait for a connection.
+    """
+
+    def __init__(self, context, metrics):
+        self._context = context
+        self._metrics = metrics
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        conn = await self._context.__aenter__()
+        self._metrics.pool_waited(time.perf_counter() - start)
+        return CountedConnection(conn, self._metrics.round_trip)
+
+    async def __aexit__(self, *exc):
+        return await self._context.__aexit__(*exc)
+
+
+class Metrics:
+    """
+    Every metric the bot records. Histograms and counters are keyed by
+    (metric name, label values).
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self.pg = None
+
+        if contextvars is not None:
+            self._command = contextvars.ContextVar('command', default=None)
+            self._query = contextvars.ContextVar('query', default=None)
+        else:
+            self._command = self._query = None
+
+    def observe(self, name, labels, value):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+
+    def increment(self, name, labels, amount=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def current(self, var):
+        return var.get() if var is not None else None
+
+    # Database
+
+    def instrument(self, pg):
+        """
+        Times every query method of a pgSQLManagement and counts the
+        statements and connection waits of each.
+        """
+
+        self.pg = pg
+
+        for name, method in inspect.getmembers(type(pg),
+                                               inspect.iscoroutinefunction):
+            if name.startswith('_') or name in UNTIMED:
+                continue
+            setattr(pg, name, self.timed_query(name, getattr(pg, name)))
+
+        acquire = pg.acquire
+        pg.acquire = lambda: TimedAcquire(acquire(), self)
+
+    def timed_query(self, name, method):
+        labels = (name,)
+
+        @functools.wraps(method)
+        async def timed(*args, **kwargs):
+            token = self._query.set(labels) if self._query is not None \
+                else None
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            except Exception as e:
+                self.increment('vishnu_query_errors_total',
+                               labels + (type(e).__name__,))
+                raise
+            finally:
+                self.observe('vishnu_query_duration_seconds', labels,
+                             time.perf_counter() - start)
+                if token is not None:
+                    self._query.reset(token)
+
+        return timed
+
+    def round_trip(self):
+        query = self.current(self._query)
+        if query is not None:
+            self.increment('vishnu_query_db_round_trips_total', query)
+
+        timing = self.current(self._command)
+        if timing is not None:
+            timing.round_trips += 1
+
+    def pool_waited(self, seconds):
+        self.observe('vishnu_pool_wait_seconds', (), seconds)
+
+        timing = self.current(self._command)
+        if timing is not None:
+            timing.pool_wait += seconds
+
+    # Commands
+
+    def install(self, bot):
+        """
+        Times every command of bot.
+        """
+
+        bot.before_invoke(self.command_started)
+        bot.after_invoke(self.command_finished)
+
+        # Wrapped rather than listened to: any on_command_error listener
+        # stops the default handler from printing the traceback.
+        default = bot.on_command_error
+
+        async def on_command_error(ctx, error):
+            await self.command_error(ctx, error)
+            await default(ctx, error)
+
+        bot.on_command_error = on_command_error
+
+    @staticmethod
+    def command_labels(ctx):
+        command = ctx.command.qualified_name if ctx.command else 'unknown'
+        guild = str(ctx.guild.id) if ctx.guild else 'dm'
+        return (command, guild)
+
+    async def command_started(self, ctx):
+        timing = Timing()
+        ctx.timing = timing
+        if self._command is not None:
+            self._command.set(timing)
+
+    async def command_finished(self, ctx):
+        timing = getattr(ctx, 'timing', None)
+        if timing is None:
+            return
+
+        labels = self.command_labels(ctx)
+        self.observe('vishnu_command_duration_seconds', labels,
+                     time.perf_counter() - timing.started)
+        if timing.round_trips:
+            self.increment('vishnu_command_db_round_trips_total', labels,
+                           timing.round_trips)
+        if timing.pool_wait:
+            self.increment('vishnu_command_pool_wait_seconds_total',
+                           labels, timing.pool_wait)
+
+    async def command_error(self, ctx, error):
+        error = getattr(error, 'original', error)
+        self.increment('vishnu_command_errors_total',
+                       self.command_labels(ctx) + (type(error).__name__,))
+
+    # Output
+
+    def gauges(self):
+        """
+        Current counters of the result cache, page cache and statement
+        registry.
+        """
+
+        gauges = {}
+        if self.pg is not None:
+            for key, value in self.pg.cache.stats().items():
+                gauges[('vishnu_cache', (key,))] = value
+            for key, value in self.pg.pages.stats().items():
+                gauges[('vishnu_pages', (key,))] = value
+            for key, value in self.pg.statements.stats().items():
+                gauges[('vishnu_statements', (key,))] = value
+        return gauges
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+
+        lines = []
+        names = {
+            'vishnu_command': ('command', 'guild'),
+            'vishnu_query': ('query',),
+            'vishnu_pool': (),
+            'vishnu_cache': ('counter',),
+            'vishnu_pages': ('counter',),
+            'vishnu_statements': ('counter',),
+        }
+
+        def label_names(name, extra=()):
+            for prefix, labels in names.items():
+                if name.startswith(prefix):
+                    return labels + extra
+            return extra
+
+        def header(name, kind):
+            lines.append("# HELP {} {}".format(name, HELP.get(name, name)))
+            lines.append("# TYPE {} {}".format(name, kind))
+
+        seen = set()
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in seen:
+                header(name, 'histogram')
+                seen.add(name)
+
+            keys = label_names(name)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    name, format_labels(keys + ('le',),
+                                        labels + (str(bound),)),
+                    cumulative))
+            lines.append("{}_sum{} {}".format(
+                name, format_labels(keys, labels), histogram.sum))
+            lines.append("{}_count{} {}".format(
+                name, format_labels(keys, labels), histogram.count))
+
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in seen:
+                header(name, 'counter')
+                seen.add(name)
+
+            extra = ('error',) if name.endswith('errors_total') else ()
+            lines.append("{}{} {}".format(
+                name, format_labels(label_names(name, extra), labels),
+                value))
+
+        for (name, labels), value in sorted(self.gauges().items()):
+            if name not in seen:
+                header(name, 'gauge')
+                seen.add(name)
+
+            lines.append("{}{} {}".format(
+                name, format_labels(label_names(name), labels), value))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self, name, guild_id=None, limit=10):
+        """
+        Returns (labels, count, p50, p99, errors) for the label sets of a
+        histogram with the most observations. With guild_id, only the
+        command histograms of that guild are included.
+        """
+
+        errors = {}
+        for (counter, labels), value in self.counters.items():
+            if counter == name.replace('duration_seconds', 'errors_total'):
+                errors[labels[:-1]] = errors.get(labels[:-1], 0) + value
+
+        rows = [(labels, histogram.count, histogram.quantile(0.5),
+                 histogram.quantile(0.99), errors.get(labels, 0))
+                for (histogram_name, labels), histogram
+                in self.histograms.items() if histogram_name == name and
+                (guild_id is None or len(labels) < 2 or
+                 labels[1] == str(guild_id))]
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return rows[:limit]
+
+    # Endpoint
+
+    async def serve(self, host, port):
+        """
+        Serves render() at /metrics over HTTP on the running event loop.
+        """
+
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # Skip the headers.
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and \
+                    parts[1].split('?')[0] == '/metrics':
+                status = "200 OK"
+                body = self.render().encode()
+            else:
+                status = "404 Not Found"
+                body = b"Not found\n"
+
+            writer.write("HTTP/1.0 {}\r\n"
+                         "Content-Type: text/plain; version=0.0.4\r\n"
+                         "Content-Length: {}\r\n\r\n"
+                         .format(status, len(body)).encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)) + "}"
+
+
+metrics = Metrics()
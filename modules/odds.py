@@ -0,0 +1,435 @@
+"""
+Exact outcome distributions of dice expressions.
+
+Works on the trees from modules.dice. Sums of dice are built by
+convolution, doubling the number of dice each step, with an FFT once the
+distributions get wide; keep highest/lowest uses the order statistics
+of the dice, face by face. Every intermediate distribution is memoized,
+so once 10d6 is known, 20d6 costs one convolution and asking about 10d6
+again costs nothing.
+"""
+
+import math
+import functools
+import threading
+import numpy as np
+from modules.cache import LRUCache
+from modules.dice import (Number, Dice, Negate, Repeat, DiceError,
+                          MAX_EXPLODE, COMPARE, parse)
+
+# Exploding dice are followed until the chance of another explosion drops
+# below this.
+EXPLODE_EPSILON = 1e-12
+
+# Keep highest/lowest is exact, but its cost grows with the square of the
+# number of dice.
+MAX_KEEP_DICE = 100
+
+# Largest number of outcomes * and / are computed for.
+MAX_PRODUCT = 10 ** 6
+
+# Most outcomes a distribution may have, lowest to highest.
+MAX_OUTCOMES = 10 ** 6
+
+# Keep highest/lowest takes about faces * dice ** 2 * kept * faces steps,
+# under a second at this bound.
+MAX_KEEP_WORK = 2 * 10 ** 8
+
+# Sums of distributions with more pairs of outcomes than this are
+# convolved with an FFT, which costs n log n instead of n * m.
+FFT_PAIRS = 10 ** 5
+
+# Bytes the memoized distributions take up together. One distribution
+# can hold MAX_OUTCOMES, 8 MB, so a count of entries doesn't bound this.
+MEMO_BYTES = 64 * 2 ** 20
+
+
+class Distribution:
+    """
+    Probabilities of the integers offset, offset + 1, ... in probs.
+    Instances are shared by the caches and must not be modified.
+    """
+
+    def __init__(self, offset, probs):
+        probs = np.asarray(probs, dtype=np.float64)
+
+        # Trim impossible outcomes off both ends.
+        nonzero = np.flatnonzero(probs > 0)
+        if len(nonzero):
+            offset += int(nonzero[0])
+            probs = probs[nonzero[0]:nonzero[-1] + 1]
+
+        probs.setflags(write=False)
+        self.offset = offset
+        self.probs = probs
+
+    @property
+    def values(self):
+        return np.arange(self.offset, self.offset + len(self.probs))
+
+    @property
+    def low(self):
+        return self.offset
+
+    @property
+    def high(self):
+        return self.offset + len(self.probs) - 1
+
+    def mean(self):
+        return float(np.dot(self.values, self.probs))
+
+    def std(self):
+        mean = self.mean()
+        return math.sqrt(max(float(np.dot((self.values - mean) ** 2,
+                                          self.probs)), 0.0))
+
+    def chance(self, compare, target):
+        """
+        Returns the probability that the outcome compares to target.
+        """
+
+        mask = COMPARE[compare](self.values, target)
+        return float(self.probs[mask].sum())
+
+    def percentile(self, fraction):
+        """
+        Returns the smallest outcome with at least fraction of the
+        probability at or below it.
+        """
+
+        cumulative = np.cumsum(self.probs)
+        index = int(np.searchsorted(cumulative, fraction - 1e-12))
+        return self.offset + min(index, len(self.probs) - 1)
+
+    def __add__(self, other):
+        return Distribution(self.offset + other.offset,
+                            convolve(self.probs, other.probs))
+
+    def __neg__(self):
+        return Distribution(-self.high, self.probs[::-1])
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def combine(self, other, function):
+        """
+        Distribution of function(a, b) over every pair of outcomes.
+        """
+
+        if len(self.probs) * len(other.probs) > MAX_PRODUCT:
+            raise DiceError("Too many outcomes to multiply or divide.")
+
+        results = function(self.values[:, None], other.values[None, :])
+        weights = self.probs[:, None] * other.probs[None, :]
+
+        low = int(results.min())
+        probs = np.zeros(int(results.max()) - low + 1)
+        np.add.at(probs, (results - low).ravel(), weights.ravel())
+        return Distribution(low, probs)
+
+
+class Memo(LRUCache):
+    """
+    The memoized distributions, least recently used evicted first once
+    they take up more than MEMO_BYTES.
+    """
+
+    def __init__(self):
+        super().__init__(ttl=math.inf, max_entries=4096,
+                         max_memory=MEMO_BYTES)
+        # odds are worked out in executor threads.
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(dist):
+        return dist.probs.nbytes
+
+
+memo = Memo()
+
+
+def memoized(function):
+    """
+    Memoizes a function returning a Distribution in memo.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        key = (function.__name__, args, tuple(sorted(kwargs.items())))
+        with memo.lock:
+            dist = memo.get(key)
+        if dist is None:
+            dist = function(*args, **kwargs)
+            with memo.lock:
+                memo.set(key, dist)
+        return dist
+
+    return wrapper
+
+
+def convolve(a, b):
+    """
+    Probabilities of the sum of two independent outcomes.
+    """
+
+    size = len(a) + len(b) - 1
+    if size > MAX_OUTCOMES:
+        raise DiceError("Too many outcomes to work out the odds of.")
+
+    if len(a) * len(b) <= FFT_PAIRS:
+        return np.convolve(a, b)
+
+    # Rounding leaves tiny negative values where the chance is zero.
+    length = 1 << (size - 1).bit_length()
+    probs = np.fft.irfft(np.fft.rfft(a, length) * np.fft.rfft(b, length),
+                         length)[:size]
+    return np.clip(probs, 0.0, None)
+
+
+def constant(value):
+    return Distribution(value, [1.0])
+
+
+@memoized
+def exploding(sides):
+    """
+    One exploding die: every maximum adds another roll of the same die.
+    """
+
+    face = 1.0 / sides
+    probs = []
+    chance = 1.0
+    depth = 0
+
+    # Each level contributes the values depth * sides + 1 ... + sides - 1;
+    # rolling the maximum moves on to the next level.
+    while depth < MAX_EXPLODE and chance * face > EXPLODE_EPSILON:
+        probs.extend([chance * face] * (sides - 1))
+        probs.append(0.0)
+        chance *= face
+        depth += 1
+
+    # Stop exploding where the roller stops, or where it no longer
+    # matters: the last maximum stays as it is.
+    probs[-1] = chance
+    return Distribution(1, probs)
+
+
+@memoized
+def single_die(sides, explode, reroll):
+    """
+    Distribution of one die after its reroll and explosion.
+    """
+
+    probs = np.full(sides, 1.0 / sides)
+
+    if reroll is not None:
+        compare, target = reroll
+        mask = COMPARE[compare](np.arange(1, sides + 1), target)
+        # Rerolled once: the second roll stands, whatever it is.
+        probs = np.where(mask, 0.0, probs) + mask.sum() / sides / sides
+
+    if not explode:
+        return Distribution(1, probs)
+
+    # A maximum on the (possibly rerolled) first roll adds a plain
+    # exploding die on top.
+    first = Distribution(1, np.append(probs[:-1], 0.0))
+    chain = exploding(sides)
+    tail = Distribution(sides + chain.offset, chain.probs * probs[-1])
+    return add_mixture(first, tail)
+
+
+def add_mixture(a, b):
+    """
+    Sums two partial distributions that each carry part of the mass.
+    """
+
+    low = min(a.low, b.low)
+    high = max(a.high, b.high)
+    probs = np.zeros(high - low + 1)
+    probs[a.low - low:a.high - low + 1] += a.probs
+    probs[b.low - low:b.high - low + 1] += b.probs
+    return Distribution(low, probs)
+
+
+@memoized
+def dice_sum(sides, explode, reroll, count):
+    """
+    Distribution of the sum of count dice, by repeated doubling.
+    """
+
+    die = single_die(sides, explode, reroll)
+    if count == 1:
+        return die
+
+    # Checked up front, so 10000d10000 fails before any convolution.
+    if count * (len(die.probs) - 1) + 1 > MAX_OUTCOMES:
+        raise DiceError("Too many outcomes to work out the odds of.")
+
+    half = dice_sum(sides, explode, reroll, count // 2)
+    total = half + half
+    if count % 2:
+        total = total + die
+    return total
+
+
+@memoized
+def keep_highest(sides, explode, reroll, count, keep, lowest=False):
+    """
+    Distribution of the sum of the keep highest (or lowest) of count dice.
+
+    Goes through the faces from best to worst. Given that the m dice not
+    placed yet all show this face or worse, the number showing exactly
+    this face is binomial; the first keep dice placed are the ones kept.
+    The state is (dice placed, sum kept so far).
+    """
+
+    if count > MAX_KEEP_DICE:
+        raise DiceError("Can only keep or drop from up to {} dice."
+                        .format(MAX_KEEP_DICE))
+
+    die = single_die(sides, explode, reroll)
+    if len(die.probs) ** 2 * count ** 2 * keep > MAX_KEEP_WORK:
+        raise DiceError("Too many outcomes to work out the odds of.")
+    if lowest:
+        die = -die
+
+    values = die.values[::-1]
+    probs = die.probs[::-1]
+    # Chance of a face this good or worse, for the conditional binomials.
+    at_most = np.cumsum(probs[::-1])[::-1]
+
+    low = min(0, keep * int(values.min()))
+    high = max(0, keep * int(values.max()))
+    width = high - low + 1
+
+    state = np.zeros((count + 1, width))
+    state[0, -low] = 1.0
+
+    for face, chance, remaining in zip(values, probs, at_most):
+        q = min(chance / remaining, 1.0) if remaining > 0 else 0.0
+        new = np.zeros_like(state)
+
+        for placed in range(count + 1):
+            row = state[placed]
+            if not row.any():
+                continue
+
+            left = count - placed
+            weights = binomial(left, q)
+            for showing, weight in enumerate(weights):
+                if weight == 0.0:
+                    continue
+                kept = min(showing, max(0, keep - placed))
+                shift = kept * int(face)
+                if shift > 0:
+                    new[placed + showing, shift:] += row[:width - shift] * weight
+                elif shift < 0:
+                    new[placed + showing, :shift] += row[-shift:] * weight
+                else:
+                    new[placed + showing] += row * weight
+
+        state = new
+
+    total = Distribution(low, state[count])
+    return -total if lowest else total
+
+
+def binomial(n, q):
+    """
+    Binomial(n, q) probabilities of 0 ... n successes.
+    """
+
+    if q <= 0.0:
+        weights = np.zeros(n + 1)
+        weights[0] = 1.0
+        return weights
+    if q >= 1.0:
+        weights = np.zeros(n + 1)
+        weights[n] = 1.0
+        return weights
+
+    k = np.arange(n + 1)
+    log_choose = (math.lgamma(n + 1) -
+                  np.array([math.lgamma(i + 1) + math.lgamma(n - i + 1)
+                            for i in k]))
+    return np.exp(log_choose + k * math.log(q) + (n - k) * math.log1p(-q))
+
+
+@memoized
+def distribution(tree):
+    """
+    Exact distribution of a parsed expression. A repeated expression has
+    the distribution of one repetition.
+    """
+
+    if isinstance(tree, Number):
+        return constant(tree.value)
+
+    if isinstance(tree, Dice):
+        if tree.keep is None or tree.keep[1] == tree.count:
+            return dice_sum(tree.sides, tree.explode, tree.reroll,
+                            tree.count)
+        if tree.keep[1] == 0:
+            return constant(0)
+        direction, amount = tree.keep
+        return keep_highest(tree.sides, tree.explode, tree.reroll,
+                            tree.count, amount, lowest=direction == 'l')
+
+    if isinstance(tree, Negate):
+        return -distribution(tree.operand)
+
+    if isinstance(tree, Repeat):
+        return distribution(tree.expr)
+
+    left = distribution(tree.left)
+    right = distribution(tree.right)
+
+    if tree.op == '+':
+        return left + right
+    if tree.op == '-':
+        return left - right
+    if tree.op == '*':
+        return left.combine(right, np.multiply)
+    if right.chance('=', 0) > 0:
+        raise DiceError("Division by zero.")
+    return left.combine(right, np.floor_divide)
+
+
+def expression_distribution(text):
+    """
+    Parses an expression and returns its distribution.
+    """
+
+    return distribution(parse(text.lower().replace(" ", "")))
+
+
+def histogram(dist, rows=20, width=30, tail=0.0005):
+    """
+    Renders a distribution as text bars, grouping outcomes into at most
+    rows buckets. Outcomes in the outer tail of either end are left out.
+    """
+
+    first = dist.percentile(tail) - dist.offset
+    last = dist.percentile(1 - tail) - dist.offset
+    size = last - first + 1
+    bucket = max(1, -(-size // rows))
+
+    lines = []
+    buckets = []
+    for start in range(first, last + 1, bucket):
+        chunk = dist.probs[start:min(start + bucket, last + 1)]
+        low = dist.offset + start
+        high = low + len(chunk) - 1
+        label = str(low) if low == high else "{}-{}".format(low, high)
+        buckets.append((label, float(chunk.sum())))
+
+    top = max(chance for label, chance in buckets)
+    label_width = max(len(label) for label, chance in buckets)
+    for label, chance in buckets:
+        bar = "#" * int(round(chance / top * width)) if top else ""
+        lines.append("{:>{}} {:6.2%} {}".format(label, label_width,
+                                                chance, bar))
+
+    return "\n".join(lines)
@@ -0,0 +1,150 @@
+"""
+Interactive paged messages for vishnu.
+"""
+
+import asyncio
+import discord
+
+previous_emoji = "\N{BLACK LEFT-POINTING TRIANGLE}"
+next_emoji = "\N{BLACK RIGHT-POINTING TRIANGLE}"
+
+
+class Paginator:
+    """
+    Shows query results one page at a time in a single message.
+
+    fetch(after, limit) returns up to limit rows in list order, starting
+    after the cursor after. render(rows, page) returns the text of a page
+    and how many of rows fit on it, and key(row) is a row's cursor, its
+    ID unless given. Pages are only fetched when someone presses the
+    arrow reactions, so the cost of a list is one page of rows no matter
+    how many match.
+
+    With a PageCache, pages are cached under cache_key, which starts
+    with the (table, guild_id) the rows come from, and showing a page
+    that was shown before since the table last changed takes neither a
+    query nor rendering.
+    """
+
+    def __init__(self, ctx, fetch, render, batch=25, timeout=120,
+                 key=None, cache=None, cache_key=None):
+        self.ctx = ctx
+        self.fetch = fetch
+        self.render = render
+        self.key = key or (lambda row: row[0])
+        self.batch = batch
+        self.timeout = timeout
+        self.cache = cache
+        self.cache_key = cache_key
+
+        self.text = None
+        self.page = 1
+        # The cursors the pages shown so far start after, and that of
+        # the next page, or None on the last page.
+        self.starts = [None]
+        self.next_start = None
+
+    async def load(self, start, page):
+        """
+        Returns the text of the page starting after start and the cursor
+        of the page after it, or None if there are no rows.
+        """
+
+        if self.cache is not None:
+            cache_key = self.cache.key(self.cache_key + (start, page))
+            loaded = self.cache.get(cache_key)
+            if loaded is not None:
+                return loaded
+
+        rows = await self.fetch(after=start, limit=self.batch + 1)
+        if not rows:
+            return None
+
+        text, shown = self.render(rows[:self.batch], page)
+        next_start = self.key(rows[shown - 1]) if len(rows) > shown \
+            else None
+
+        if self.cache is not None:
+            self.cache.set(cache_key, (text, next_start))
+
+        return text, next_start
+
+    async def start(self):
+        """
+        Sends the first page, then follows the arrow reactions until
+        nobody has pressed one for timeout seconds.
+        """
+
+        loaded = await self.load(None, self.page)
+        if loaded is None:
+            return
+
+        self.text, self.next_start = loaded
+        message = await self.ctx.send(self.text)
+
+        # A single page needs no controls.
+        if self.next_start is None:
+            return
+
+        await message.add_reaction(previous_emoji)
+        await message.add_reaction(next_emoji)
+
+        bot = self.ctx.bot
+
+        def check(reaction, user):
+            return (reaction.message.id == message.id and
+                    not user.bot and
+                    str(reaction.emoji) in (previous_emoji, next_emoji))
+
+        while True:
+            try:
+                reaction, user = await bot.wait_for('reaction_add',
+                                                    check=check,
+                                                    timeout=self.timeout)
+            except asyncio.TimeoutError:
+                break
+
+            if str(reaction.emoji) == next_emoji:
+                changed = await self.next_page()
+            else:
+                changed = await self.previous_page()
+
+            if changed:
+                await message.edit(content=self.text)
+
+            try:
+                await message.remove_reaction(reaction.emoji, user)
+            except discord.HTTPException:
+                pass
+
+        try:
+            await message.clear_reactions()
+        except discord.HTTPException:
+            pass
+
+    async def next_page(self):
+        if self.next_start is None:
+            return False
+
+        loaded = await self.load(self.next_start, self.page + 1)
+        if loaded is None:
+            self.next_start = None
+            return False
+
+        self.starts.append(self.next_start)
+        self.text, self.next_start = loaded
+        self.page += 1
+        return True
+
+    async def previous_page(self):
+        if self.page == 1:
+            return False
+
+        loaded = await self.load(self.starts[-2], self.page - 1)
+        if loaded is None:
+            return False
+
+        self.starts.pop()
+        self.text, self.next_start = loaded
+        self.page -= 1
+        return True
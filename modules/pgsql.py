@@ -2,67 +2,988 @@
 PostgreSQL module for vishnu.
 """
 
-import yaml
+import os
+import re
+import json
+import asyncio
 import asyncpg
 import datetime
+from collections import OrderedDict
+from modules.cache import ResultCache, PageCache
+import modules.filters as filters
+from modules.config import config, GUILD_OPTIONS
 
-config = yaml.safe_load(open("config.yaml"))
+SCHEMA_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_version
+(scope VARCHAR PRIMARY KEY,
+version INTEGER NOT NULL);
+"""
+
+# Every guild shares the same tables, keyed by guild_id. The schema
+# version of those tables is stored under this scope.
+SHARED_SCOPE = 'shared'
+
+# Migrations of the shared tables, in order. A database at version N has
+# had the first N applied. {partition_by} is empty, or a PARTITION BY
+# clause when pg_connection.partitions is set.
+MIGRATIONS = [
+    # 1: Shared tables.
+    """
+    CREATE TABLE IF NOT EXISTS quests
+    (guild_id BIGINT NOT NULL,
+    id SERIAL,
+    tier VARCHAR,
+    description VARCHAR,
+    creator VARCHAR,
+    completed BOOLEAN,
+    PRIMARY KEY (guild_id, id)) {partition_by};
+
+    CREATE TABLE IF NOT EXISTS groups
+    (guild_id BIGINT NOT NULL,
+    id SERIAL,
+    creator VARCHAR NOT NULL,
+    start_date DATE NOT NULL,
+    max_users VARCHAR NOT NULL,
+    notes VARCHAR,
+    members VARCHAR[],
+    PRIMARY KEY (guild_id, id)) {partition_by};
+
+    CREATE TABLE IF NOT EXISTS guild_config
+    (guild_id BIGINT NOT NULL,
+    option VARCHAR NOT NULL,
+    value VARCHAR,
+    PRIMARY KEY (guild_id, option)) {partition_by};
+    """,
+
+    # 2: Store group capacity as integers instead of "taken/max" strings
+    # so joins can be checked and counted in a single UPDATE.
+    """
+    ALTER TABLE groups
+    ADD COLUMN IF NOT EXISTS member_count INTEGER NOT NULL DEFAULT 0;
+
+    UPDATE groups
+    SET member_count = split_part(max_users, '/', 1)::integer
+    WHERE max_users ~ '^[0-9]+/[0-9]+$';
+
+    ALTER TABLE groups
+    ALTER COLUMN max_users TYPE INTEGER
+    USING (CASE
+        WHEN max_users ~ '^[0-9]+/[0-9]+$' THEN split_part(max_users, '/', 2)
+        WHEN max_users ~ '^[0-9]+$' THEN max_users
+        ELSE '0'
+    END)::integer;
+    """,
+
+    # 3: Remember each group's announcement message so reactions on it
+    # can be mapped back to the group.
+    """
+    ALTER TABLE groups
+    ADD COLUMN IF NOT EXISTS announce_message_id BIGINT;
+
+    CREATE INDEX IF NOT EXISTS groups_announce_message_id
+    ON groups (announce_message_id);
+    """,
+
+    # 4: Indexes for the list filters. Only open quests are ever listed,
+    # so the quest indexes leave completed ones out.
+    """
+    CREATE INDEX IF NOT EXISTS quests_open
+    ON quests (guild_id, id) WHERE NOT completed;
+
+    CREATE INDEX IF NOT EXISTS quests_open_tier
+    ON quests (guild_id, tier, id) WHERE NOT completed;
+
+    CREATE INDEX IF NOT EXISTS quests_open_creator
+    ON quests (guild_id, creator, id) WHERE NOT completed;
+
+    CREATE INDEX IF NOT EXISTS groups_creator
+    ON groups (guild_id, creator, id);
+
+    CREATE INDEX IF NOT EXISTS groups_start_date
+    ON groups (start_date);
+    """,
+
+    # 5: Remember each group's role and channels by ID.
+    """
+    ALTER TABLE groups
+    ADD COLUMN IF NOT EXISTS role_id BIGINT,
+    ADD COLUMN IF NOT EXISTS text_channel_id BIGINT,
+    ADD COLUMN IF NOT EXISTS voice_channel_id BIGINT;
+    """,
+
+    # 6: Groups whose sessions are long over are moved here.
+    """
+    CREATE TABLE IF NOT EXISTS groups_archive
+    (guild_id BIGINT NOT NULL,
+    id INTEGER NOT NULL,
+    creator VARCHAR NOT NULL,
+    start_date DATE NOT NULL,
+    max_users INTEGER NOT NULL,
+    member_count INTEGER NOT NULL,
+    notes VARCHAR,
+    members VARCHAR[],
+    archived_at TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (guild_id, id));
+    """,
+
+    # 7: Group lists filtered or sorted by start date.
+    """
+    CREATE INDEX IF NOT EXISTS groups_guild_start_date
+    ON groups (guild_id, start_date, id);
+    """,
+
+    # 8: Full-text search over open quests (PostgreSQL 12+). pg_trgm,
+    # for the typo fallback, isn't always available or allowed, so
+    # search works without it.
+    """
+    ALTER TABLE quests
+    ADD COLUMN IF NOT EXISTS search TSVECTOR
+    GENERATED ALWAYS AS (to_tsvector('english', coalesce(description, '')))
+    STORED;
+
+    CREATE INDEX IF NOT EXISTS quests_open_search
+    ON quests USING GIN (search) WHERE NOT completed;
+
+    DO $$
+    BEGIN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS quests_open_description_trgm
+        ON quests USING GIN (description gin_trgm_ops) WHERE NOT completed;
+    EXCEPTION WHEN OTHERS THEN
+        RAISE NOTICE 'Quest search will not correct typos: %', SQLERRM;
+    END
+    $$;
+    """,
+
+    # 9: Group membership by Discord user ID. The members arrays of older
+    # groups hold names, which only the bot can resolve to users; see
+    # migrate_group_members(). Archived groups keep their members' IDs.
+    """
+    CREATE TABLE IF NOT EXISTS group_members
+    (guild_id BIGINT NOT NULL,
+    group_id INTEGER NOT NULL,
+    user_id BIGINT NOT NULL,
+    joined_at TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (guild_id, group_id, user_id),
+    FOREIGN KEY (guild_id, group_id) REFERENCES groups (guild_id, id)
+    ON DELETE CASCADE) {partition_by};
+
+    CREATE INDEX IF NOT EXISTS group_members_user
+    ON group_members (guild_id, user_id, group_id);
+
+    ALTER TABLE groups_archive
+    ADD COLUMN IF NOT EXISTS member_ids BIGINT[];
+    """,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Tables partitioned by guild_id when partitioning is enabled, and the
+# migration that creates each.
+SHARED_TABLES = {
+    'quests': 1,
+    'groups': 1,
+    'guild_config': 1,
+    'group_members': 9,
+}
+
+# Version of the per-guild setup (the seeded config rows), stored under
+# the scope "guild:<id>".
+GUILD_SCHEMA_VERSION = 1
+
+# Matches the tables of the old table-per-guild layout.
+LEGACY_TABLE = re.compile(r'^(\d+)_(quests|groups|config)$')
+
+LEGACY_TABLES = """
+SELECT tablename FROM pg_tables
+WHERE schemaname = current_schema()
+AND tablename ~ '^\\d+_(quests|groups|config)$';
+"""
+
+# Recorded in schema_version once migrate.py has copied the old tables.
+LEGACY_SCOPE = 'legacy'
+
+# Rows of an old table whose ID was taken by a different quest or group
+# added since the upgrade, so they weren't copied.
+LEGACY_CONFLICTS = {
+    'quests': """
+    SELECT count(*) FROM "{}" AS legacy
+    WHERE EXISTS (
+        SELECT 1 FROM quests
+        WHERE guild_id = $1 AND id = legacy.id AND
+        (tier, description, creator) IS DISTINCT FROM
+        (legacy.tier, legacy.description, legacy.creator));
+    """,
+
+    'groups': """
+    SELECT count(*) FROM "{}" AS legacy
+    WHERE EXISTS (
+        SELECT 1 FROM groups
+        WHERE guild_id = $1 AND id = legacy.id AND
+        (creator, start_date, notes) IS DISTINCT FROM
+        (legacy.creator, legacy.start_date, legacy.notes));
+    """,
+}
+
+# The list queries, before any filters. Filters are appended by
+# list_query() so each combination gets its own statement.
+LIST_QUERIES = {
+    'quests': """
+    SELECT id, tier, creator, description
+    FROM quests
+    WHERE
+    guild_id = $1 AND
+    NOT completed""",
+
+    'groups': """
+    SELECT id, creator, start_date,
+    member_count || '/' || max_users AS max_users, notes
+    FROM groups
+    WHERE
+    guild_id = $1""",
+}
+
+# SQL of each filter operator, and how many parameters it takes.
+PREDICATES = {
+    '=': ("{column} = ${0}", 1),
+    'any': ("{column} = ANY(${0})", 1),
+    'between': ("{column} BETWEEN ${0} AND ${1}", 2),
+    '>=': ("{column} >= ${0}", 1),
+    '<=': ("{column} <= ${0}", 1),
+    'open': ("member_count < max_users", 0),
+    'full': ("member_count >= max_users", 0),
+    'member': ("{column} IN (SELECT group_id FROM group_members "
+               "WHERE guild_id = $1 AND user_id = ${0})", 1),
+}
+
+# Filters EXPLAINed by check_indexes(), one per shape worth checking.
+INDEX_CHECKS = {
+    'quests': ['', 'id=1', 'id=1,2', 'id=1..5', 'tier=TIER-1',
+               'tier=TIER-1,TIER-2', 'creator=nobody',
+               'tier=TIER-1 creator=nobody', 'sort=tier', 'sort=-creator',
+               'tier=TIER-1 sort=-id'],
+    'groups': ['', 'id=1', 'id=1..5', 'creator=nobody',
+               'date=2019-01-01..2019-12-31', 'date=2019-01-01..', 'open',
+               'full creator=nobody', 'sort=date', 'sort=-date open',
+               'date=..2019-12-31 sort=date'],
+}
+
+# Sort column values the checked pages start after or before.
+CURSOR_SAMPLES = {'id': '1', 'tier': 'TIER-1', 'creator': 'nobody',
+                  'date': '2019-01-01'}
+
+# Every query shape the bot runs. The text is the same for every guild,
+# so one prepared statement serves all of them.
+QUERIES = {
+    'retrieve_group_info': """
+    SELECT id, max_users, member_count, creator
+    FROM groups
+    WHERE guild_id = $1 AND id = $2""",
+
+    # Joins only if the group has room and the user isn't a member yet.
+    # Concurrent joins queue on the group's row lock, then see its latest
+    # member_count, so the group can't be overfilled. When nothing was
+    # inserted the second half reports why.
+    'join_group': """
+    WITH target AS (
+        SELECT member_count, max_users
+        FROM groups
+        WHERE guild_id = $1 AND id = $3
+        FOR UPDATE),
+    added AS (
+        INSERT INTO group_members (guild_id, group_id, user_id)
+        SELECT $1, $3, $2
+        FROM target
+        WHERE member_count < max_users
+        ON CONFLICT DO NOTHING
+        RETURNING user_id),
+    joined AS (
+        UPDATE groups
+        SET member_count = member_count + 1
+        WHERE guild_id = $1 AND id = $3
+        AND EXISTS (SELECT 1 FROM added)
+        RETURNING member_count, max_users)
+    SELECT TRUE AS joined, FALSE AS is_member, member_count, max_users
+    FROM joined
+    UNION ALL
+    SELECT FALSE,
+    member_count < max_users OR EXISTS (
+        SELECT 1 FROM group_members
+        WHERE guild_id = $1 AND group_id = $3 AND user_id = $2),
+    member_count, max_users
+    FROM target
+    WHERE NOT EXISTS (SELECT 1 FROM joined);""",
+
+    # Joins a batch of users, in the order they reacted, until the group
+    # is full. Users already in the group are skipped.
+    'join_group_batch': """
+    WITH target AS (
+        SELECT id, member_count, max_users
+        FROM groups
+        WHERE guild_id = $1 AND announce_message_id = $2
+        FOR UPDATE),
+    candidates AS (
+        SELECT c.user_id, min(c.ord) AS ord
+        FROM target, unnest($3::bigint[]) WITH ORDINALITY AS c(user_id, ord)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM group_members m
+            WHERE m.guild_id = $1 AND m.group_id = target.id
+            AND m.user_id = c.user_id)
+        GROUP BY c.user_id),
+    accepted AS (
+        SELECT ranked.user_id
+        FROM target, (
+            SELECT user_id, row_number() OVER (ORDER BY ord) AS position
+            FROM candidates) ranked
+        WHERE ranked.position <= target.max_users - target.member_count),
+    added AS (
+        INSERT INTO group_members (guild_id, group_id, user_id)
+        SELECT $1, target.id, accepted.user_id
+        FROM target, accepted
+        ON CONFLICT DO NOTHING
+        RETURNING user_id)
+    UPDATE groups
+    SET member_count = member_count + (SELECT count(*) FROM added)
+    WHERE guild_id = $1 AND announce_message_id = $2
+    AND EXISTS (SELECT 1 FROM added)
+    RETURNING id, (SELECT array_agg(user_id) FROM added) AS joined;""",
+
+    # Removes a batch of users from the group announced by a message.
+    'leave_group_batch': """
+    WITH target AS (
+        SELECT id
+        FROM groups
+        WHERE guild_id = $1 AND announce_message_id = $2
+        FOR UPDATE),
+    removed AS (
+        DELETE FROM group_members m
+        USING target
+        WHERE m.guild_id = $1 AND m.group_id = target.id
+        AND m.user_id = ANY($3::bigint[])
+        RETURNING m.user_id)
+    UPDATE groups
+    SET member_count = member_count - (SELECT count(*) FROM removed)
+    WHERE guild_id = $1 AND announce_message_id = $2
+    AND EXISTS (SELECT 1 FROM removed)
+    RETURNING id, (SELECT array_agg(user_id) FROM removed) AS left;""",
+
+    # Removes one user from a group. Like join_group, the second half
+    # reports an existing group the user wasn't in.
+    'leave_group': """
+    WITH target AS (
+        SELECT member_count, max_users
+        FROM groups
+        WHERE guild_id = $1 AND id = $3
+        FOR UPDATE),
+    removed AS (
+        DELETE FROM group_members
+        WHERE guild_id = $1 AND group_id = $3 AND user_id = $2
+        AND EXISTS (SELECT 1 FROM target)
+        RETURNING user_id),
+    left_group AS (
+        UPDATE groups
+        SET member_count = member_count - 1
+        WHERE guild_id = $1 AND id = $3
+        AND EXISTS (SELECT 1 FROM removed)
+        RETURNING member_count, max_users)
+    SELECT TRUE AS left, member_count, max_users
+    FROM left_group
+    UNION ALL
+    SELECT FALSE, member_count, max_users
+    FROM target
+    WHERE NOT EXISTS (SELECT 1 FROM left_group);""",
+
+    # Groups whose members arrays still hold names from before
+    # group_members.
+    'legacy_group_members': """
+    SELECT guild_id, id, members
+    FROM groups
+    WHERE guild_id = ANY($1::bigint[]) AND cardinality(members) > 0""",
+
+    # Moves resolved names out of a group's members array. Users that
+    # were in group_members already were counted twice.
+    'move_group_members': """
+    WITH added AS (
+        INSERT INTO group_members (guild_id, group_id, user_id)
+        SELECT $1, $2, unnest($3::bigint[])
+        ON CONFLICT DO NOTHING
+        RETURNING user_id)
+    UPDATE groups
+    SET members = ARRAY(
+        SELECT m FROM unnest(members) AS m
+        WHERE NOT m = ANY($4::varchar[])),
+    member_count = member_count -
+        (cardinality($3::bigint[]) - (SELECT count(*) FROM added))
+    WHERE guild_id = $1 AND id = $2;""",
+
+    'set_group_objects': """
+    UPDATE groups
+    SET role_id = $3, text_channel_id = $4, voice_channel_id = $5,
+    announce_message_id = $6
+    WHERE guild_id = $1 AND id = $2;""",
+
+    'retrieve_guild_config': """
+    SELECT guild_id, option, value
+    FROM guild_config
+    WHERE guild_id = ANY($1::bigint[]) AND value IS NOT NULL;""",
+
+    'set_guild_config': """
+    INSERT INTO guild_config (guild_id, option, value)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (guild_id, option) DO UPDATE SET value = EXCLUDED.value;""",
+
+    'retrieve_group_objects': """
+    SELECT guild_id, id AS group_id, role_id, text_channel_id,
+    voice_channel_id, announce_message_id
+    FROM groups
+    WHERE guild_id = ANY($1::bigint[]);""",
+
+    'import_group_data': """
+    INSERT INTO groups(guild_id, creator, start_date, max_users, notes)
+    VALUES ($1, $2::varchar, $3::date, $4::integer, $5::varchar)
+    returning id;""",
+
+    'delete_group': """
+    DELETE FROM groups
+    WHERE guild_id = $1 AND id = $2;""",
+
+    'import_quest_data': """
+    INSERT INTO quests (guild_id, tier, description, creator, completed)
+    VALUES ($1, $2, $3, $4, False);""",
+
+    'delete_quest': """
+    DELETE FROM quests
+    WHERE guild_id = $1 AND id = $2;""",
+
+    'complete_quest': """
+    UPDATE quests
+    SET completed = $2::bool
+    WHERE guild_id = $1 AND id = $3::integer;""",
+
+    # Uses the groups_start_date index.
+    'retrieve_upcoming_groups': """
+    SELECT guild_id, id, start_date
+    FROM groups
+    WHERE start_date >= $1 AND guild_id = ANY($2::bigint[])
+    ORDER BY start_date""",
+
+    # Groups that started before $1, oldest first, at most $3 of them.
+    'expired_groups': """
+    SELECT guild_id, id, start_date, role_id, text_channel_id,
+    voice_channel_id
+    FROM groups
+    WHERE start_date < $1
+    AND ($2::bigint[] IS NULL OR guild_id = ANY($2::bigint[]))
+    ORDER BY start_date
+    LIMIT $3""",
+
+    # Moves a batch of expired groups to groups_archive in one statement.
+    # Rows locked by another archiver are left for its batch.
+    'archive_groups': """
+    WITH expired AS (
+        SELECT guild_id, id
+        FROM groups
+        WHERE start_date < $1
+        AND ($2::bigint[] IS NULL OR guild_id = ANY($2::bigint[]))
+        ORDER BY start_date
+        LIMIT $3
+        FOR UPDATE SKIP LOCKED),
+    moved AS (
+        DELETE FROM groups
+        USING expired
+        WHERE groups.guild_id = expired.guild_id AND groups.id = expired.id
+        RETURNING groups.*),
+    archived AS (
+        INSERT INTO groups_archive (guild_id, id, creator, start_date,
+        max_users, member_count, notes, members, member_ids)
+        SELECT guild_id, id, creator, start_date, max_users, member_count,
+        notes, members, (
+            SELECT array_agg(user_id ORDER BY joined_at)
+            FROM group_members
+            WHERE group_members.guild_id = moved.guild_id
+            AND group_members.group_id = moved.id)
+        FROM moved
+        ON CONFLICT (guild_id, id) DO NOTHING)
+    SELECT guild_id, id, start_date, role_id, text_channel_id,
+    voice_channel_id
+    FROM moved""",
+
+    'search_quests': """
+    SELECT id, tier, creator,
+    ts_headline('english', description, query, $4) AS snippet
+    FROM (
+        SELECT id, tier, creator, description, query,
+        ts_rank(search, query) AS rank
+        FROM quests, websearch_to_tsquery('english', $2) AS query
+        WHERE
+        guild_id = $1 AND
+        NOT completed AND
+        search @@ query
+        ORDER BY rank DESC, id
+        LIMIT $3) AS ranked
+    ORDER BY rank DESC, id;""",
+
+    'search_quests_fuzzy': """
+    SELECT id, tier, creator, description AS snippet
+    FROM quests
+    WHERE
+    guild_id = $1 AND
+    NOT completed AND
+    $2 <% description
+    ORDER BY word_similarity($2, description) DESC, id
+    LIMIT $3;""",
+
+    'export_quests': """
+    SELECT id, tier, description, creator, completed
+    FROM quests
+    WHERE guild_id = $1
+    ORDER BY id""",
+}
+
+# ts_headline() options of search results: matched words in bold.
+SEARCH_HEADLINE = "StartSel=**, StopSel=**, MinWords=10, MaxWords=25"
+
+# Columns filled by import_quests(), in the order of its records.
+QUEST_IMPORT_COLUMNS = ['guild_id', 'tier', 'description', 'creator',
+                        'completed']
+
+
+def list_query(shape, after=None, before=None):
+    """
+    Returns the name of the list query for a filter shape (see
+    Filter.shape()), adding it to QUERIES the first time.
+
+    Only the predicates the filter uses end up in the statement, so the
+    planner can pick the index that fits each combination. Pages are
+    found by keyset: the ID, or the sort column and the ID, of the row
+    after or before. Parameters are guild_id, the filter's args(), then
+    the cursor, then the limit.
+    """
+
+    table, predicates, sort, descending = shape
+
+    if before is not None:
+        direction = 'before'
+    elif after is not None:
+        direction = 'after'
+    else:
+        direction = 'first'
+
+    name = "{}_list:{}:{}{}:{}".format(
+        table, ",".join(column + op for column, op in predicates),
+        "-" if descending else "", sort, direction)
+    if name in QUERIES:
+        return name
+
+    sql = [LIST_QUERIES[table]]
+    param = 2
+    for column, op in predicates:
+        template, count = PREDICATES[op]
+        sql.append(" AND\n    " + template.format(
+            *range(param, param + count), column=column))
+        param += count
+
+    keys = ['id'] if sort == 'id' else [sort, 'id']
+    ascending = not descending
+
+    if direction != 'first':
+        placeholders = ["${}".format(param + n) for n in range(len(keys))]
+        param += len(keys)
+        if len(keys) > 1:
+            left = "({})".format(", ".join(keys))
+            right = "({})".format(", ".join(placeholders))
+        else:
+            left, right = keys[0], placeholders[0]
+
+        # Pages before the cursor are read backwards, then reversed.
+        if direction == 'before':
+            ascending = not ascending
+        sql.append(" AND\n    {} {} {}".format(
+            left, ">" if ascending else "<", right))
+
+    sql.append("\n    ORDER BY {}".format(", ".join(
+        key + ("" if ascending else " DESC") for key in keys)))
+    sql.append("\n    LIMIT ${};".format(param))
+
+    QUERIES[name] = "".join(sql)
+    return name
+
+
+def plan_nodes(plan):
+    """
+    Yields every node of an EXPLAIN (FORMAT JSON) plan.
+    """
+
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+class StatementRegistry:
+    """
+    Hands out the SQL text for a query shape.
+
+    asyncpg keeps an LRU of prepared statements on every connection, keyed
+    by the exact query text, and that cache survives the connection being
+    returned to the pool. Handing out the same string for the same shape
+    means each shape is parsed and planned once per pooled connection. The
+    registry mirrors that LRU, using the same bound, to estimate how often
+    a statement was already prepared.
+
+    The counters are an approximation. asyncpg also drops statements that
+    are older than max_cached_statement_lifetime, the pool closes idle
+    connections, and statements that don't go through the registry
+    (migrations, EXPLAINs, NOTIFYs) take places in the same LRU, so
+    some hits were really prepared again. A connection the pool replaces
+    has a new backend PID, so its statements count as new.
+    """
+
+    def __init__(self, max_size, max_connections):
+        self.max_size = max_size
+        self.max_connections = max_connections
+        self.hits = 0
+        self.misses = 0
+
+        self._prepared = OrderedDict()
+
+    def get(self, conn, name):
+        """
+        Returns the query text for name and records whether conn has it
+        prepared already.
+        """
+
+        sql = QUERIES[name]
+
+        # The backend PID identifies the pooled connection across
+        # acquire/release cycles.
+        pid = conn.get_server_pid()
+        prepared = self._prepared.get(pid)
+        if prepared is None:
+            prepared = self._prepared[pid] = OrderedDict()
+            if len(self._prepared) > self.max_connections:
+                self._prepared.popitem(last=False)
+        else:
+            self._prepared.move_to_end(pid)
+
+        if name in prepared:
+            self.hits += 1
+            prepared.move_to_end(name)
+        else:
+            self.misses += 1
+            prepared[name] = True
+            if len(prepared) > self.max_size:
+                prepared.popitem(last=False)
+
+        return sql
+
+    def stats(self):
+        """
+        Returns the estimated hit/miss counters.
+        """
+
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
 
 
 class pgSQLManagement:
+    """
+    Wraps a single asyncpg connection pool that lives as long as the bot.
+
+    app.py creates one instance and hangs it off the bot as bot.pg, every
+    cog shares it. Each method acquires a connection for the duration of
+    one operation; only writes open a transaction.
+    """
+
+    def __init__(self):
+        self.pool = None
+
+        pg_connection = config['pg_connection']
+        self.min_size = pg_connection.get('min_size', 2)
+        # max_size is shared by every process started by launcher.py.
+        processes = int(os.environ.get('VISHNU_PROCESSES', 1))
+        self.max_size = max(self.min_size,
+                            pg_connection.get('max_size', 10) // processes)
+        self.acquire_timeout = pg_connection.get('acquire_timeout', 10)
+        self.statement_cache_size = pg_connection.get(
+            'statement_cache_size', 100)
+        self.bootstrap_concurrency = pg_connection.get(
+            'bootstrap_concurrency', 4)
+        self.partitions = pg_connection.get('partitions', 0)
+
+        self.statements = StatementRegistry(self.statement_cache_size,
+                                            self.max_size)
+
+        # Cleared when the typo fallback finds pg_trgm missing.
+        self.fuzzy_search = True
+
+        cache_config = config.get('cache', {})
+        self.cache = ResultCache(ttl=cache_config.get('ttl', 60),
+                                 max_entries=cache_config.get('max_entries',
+                                                              1000))
+        self.pages = PageCache(self.cache,
+                               ttl=cache_config.get('ttl', 60),
+                               max_entries=cache_config.get('max_pages', 500))
 
     async def connect(self):
+        """
+        Creates the connection pool. Safe to call more than once.
+        """
+
+        if self.pool is not None:
+            return
+
+        self.pool = await asyncpg.create_pool(
+            min_size=self.min_size,
+            max_size=self.max_size,
+            statement_cache_size=self.statement_cache_size,
+            **self.connection_args())
+
+    @staticmethod
+    def connection_args():
         pg_connection = config['pg_connection']
-        username = pg_connection['user']
-        password = pg_connection['password']
-        host = pg_connection['host']
-        database = pg_connection['database']
-        self.conn = await asyncpg.connect(
-            database=database,
-            user=username,
-            password=password,
-            host=host)
-        self.tr = self.conn.transaction()
-        await self.tr.start()
+        return {
+            'database': pg_connection['database'],
+            'user': pg_connection['user'],
+            'password': pg_connection['password'],
+            'host': pg_connection['host'],
+        }
+
+    async def dedicated_connection(self):
+        """
+        Opens a connection outside the pool, for LISTEN and session-level
+        locks that must outlive a single operation.
+        """
+
+        return await asyncpg.connect(**self.connection_args())
+
+    async def close(self):
+        """
+        Closes every connection in the pool.
+        """
+
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    def acquire(self):
+        """
+        Returns a context manager that borrows a connection from the pool.
+        """
+
+        return self.pool.acquire(timeout=self.acquire_timeout)
+
+    def query(self, conn, name):
+        """
+        Returns the SQL for a named query.
+        """
+
+        return self.statements.get(conn, name)
+
+    async def migrate_shared_tables(self):
+        """
+        Brings the shared tables up to SCHEMA_VERSION.
+        """
+
+        if self.partitions:
+            partition_by = "PARTITION BY HASH (guild_id)"
+        else:
+            partition_by = ""
+
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(SCHEMA_VERSION_TABLE)
+
+                # Serialize migrations between bot processes.
+                await conn.execute("SELECT pg_advisory_xact_lock(0)")
+
+                version = await conn.fetchval("""
+                SELECT version FROM schema_version WHERE scope = $1;
+                """, SHARED_SCOPE) or 0
+
+                for migration in MIGRATIONS[version:]:
+                    await conn.execute(
+                        migration.format(partition_by=partition_by))
+
+                if self.partitions:
+                    for table, created in SHARED_TABLES.items():
+                        if version >= created:
+                            continue
+                        for remainder in range(self.partitions):
+                            await conn.execute("""
+                            CREATE TABLE IF NOT EXISTS "{0}_p{1}"
+                            PARTITION OF {0}
+                            FOR VALUES WITH (MODULUS {2}, REMAINDER {1});
+                            """.format(table, remainder, self.partitions))
+
+                await conn.execute("""
+                INSERT INTO schema_version (scope, version)
+                VALUES ($1, $2)
+                ON CONFLICT (scope) DO UPDATE SET version = EXCLUDED.version;
+                """, SHARED_SCOPE, SCHEMA_VERSION)
+
+    async def bootstrap(self, guild_ids):
+        """
+        Migrates the shared tables, then sets up every guild that isn't
+        current yet.
+
+        One query finds the guilds that are already current, the rest are
+        set up concurrently, at most bootstrap_concurrency at a time.
+        Returns the number of guilds that were set up.
+        """
+
+        await self.migrate_shared_tables()
+
+        scopes = {guild_id: "guild:{}".format(guild_id)
+                  for guild_id in guild_ids}
+
+        async with self.acquire() as conn:
+            rows = await conn.fetch("""
+            SELECT scope FROM schema_version
+            WHERE scope = ANY($1::varchar[]) AND version >= $2;
+            """, list(scopes.values()), GUILD_SCHEMA_VERSION)
+
+        current = {row['scope'] for row in rows}
+        stale = [guild_id for guild_id, scope in scopes.items()
+                 if scope not in current]
+
+        semaphore = asyncio.Semaphore(self.bootstrap_concurrency)
+
+        async def migrate(guild_id):
+            async with semaphore:
+                await self.create_tables(guild_id)
+
+        await asyncio.gather(*[migrate(guild_id) for guild_id in stale])
+
+        return len(stale)
 
     async def create_tables(self, guild_id):
         """
-        Creates the tables.
+        Sets up one guild's rows in the shared tables.
+        """
+
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                INSERT INTO guild_config (guild_id, option)
+                SELECT $1, unnest($2::varchar[])
+                ON CONFLICT (guild_id, option) DO NOTHING;
+                """, int(guild_id), GUILD_OPTIONS)
+
+                await conn.execute("""
+                INSERT INTO schema_version (scope, version)
+                VALUES ($1, $2)
+                ON CONFLICT (scope) DO UPDATE SET version = EXCLUDED.version;
+                """, "guild:{}".format(guild_id), GUILD_SCHEMA_VERSION)
+
+    async def migrate_legacy_tables(self, drop=False):
+        """
+        Copies every guild's old "<guild>_quests", "<guild>_groups" and
+        "<guild>_config" tables into the shared tables.
+
+        Each table is copied server-side with one INSERT ... SELECT, and
+        rows that were already copied are skipped, so running this twice
+        is harmless. With drop=True the old tables are dropped once copied.
+
+        A quest or group whose ID was taken by one added since the upgrade
+        can't be copied. Tables with such rows are kept, even with
+        drop=True. Returns the number of tables copied and a list of
+        (table, rows not copied).
         """
 
-        await self.connect()
+        await self.migrate_shared_tables()
 
-        # Make the table if it doesn't exist.
+        async with self.acquire() as conn:
+            tables = [row['tablename']
+                      for row in await conn.fetch(LEGACY_TABLES)]
 
-        await self.conn.execute("""
-        CREATE TABLE IF NOT EXISTS "{0}_quests"
-        (id SERIAL PRIMARY KEY, tier VARCHAR,
-        description VARCHAR, creator VARCHAR,
-        completed BOOLEAN);
+            copied = 0
+            conflicts = []
+            async with conn.transaction():
+                for table in tables:
+                    guild_id, kind = LEGACY_TABLE.match(table).groups()
 
-        CREATE TABLE IF NOT EXISTS "{0}_groups"
-        (id SERIAL PRIMARY KEY,
-        creator VARCHAR NOT NULL,
-        start_date DATE NOT NULL,
-        max_users VARCHAR NOT NULL,
-        notes VARCHAR,
-        members VARCHAR[] );
+                    if kind == 'quests':
+                        await conn.execute("""
+                        INSERT INTO quests
+                        (guild_id, id, tier, description, creator, completed)
+                        SELECT $1, id, tier, description, creator, completed
+                        FROM "{}"
+                        ON CONFLICT (guild_id, id) DO NOTHING;
+                        """.format(table), int(guild_id))
+                    elif kind == 'groups':
+                        await conn.execute("""
+                        INSERT INTO groups
+                        (guild_id, id, creator, start_date, member_count,
+                        max_users, notes, members)
+                        SELECT $1, id, creator, start_date,
+                        split_part(max_users, '/', 1)::integer,
+                        split_part(max_users, '/', 2)::integer,
+                        notes, members
+                        FROM "{}"
+                        ON CONFLICT (guild_id, id) DO NOTHING;
+                        """.format(table), int(guild_id))
+                    else:
+                        await conn.execute("""
+                        INSERT INTO guild_config (guild_id, option, value)
+                        SELECT DISTINCT ON (option) $1, option, value
+                        FROM "{}"
+                        WHERE option IS NOT NULL
+                        ORDER BY option, value IS NULL
+                        ON CONFLICT (guild_id, option) DO UPDATE
+                        SET value = COALESCE(guild_config.value,
+                                             EXCLUDED.value);
+                        """.format(table), int(guild_id))
+
+                    if kind in LEGACY_CONFLICTS:
+                        skipped = await conn.fetchval(
+                            LEGACY_CONFLICTS[kind].format(table),
+                            int(guild_id))
+                        if skipped:
+                            conflicts.append((table, skipped))
+                            continue
+
+                    if drop:
+                        await conn.execute('DROP TABLE "{}";'.format(table))
+
+                    copied += 1
+
+                # IDs are now drawn from one sequence per table, move it
+                # past every copied ID.
+                for table in ['quests', 'groups']:
+                    await conn.execute("""
+                    SELECT setval(pg_get_serial_sequence('{0}', 'id'),
+                                  GREATEST((SELECT max(id) FROM {0}), 1));
+                    """.format(table))
+
+                await conn.execute("""
+                INSERT INTO schema_version (scope, version)
+                VALUES ($1, 1)
+                ON CONFLICT (scope) DO NOTHING;
+                """, LEGACY_SCOPE)
+
+        return copied, conflicts
+
+    async def legacy_tables_pending(self):
+        """
+        Returns True if there are tables of the old table-per-guild layout
+        that migrate.py hasn't copied yet.
+        """
 
-        CREATE TABLE IF NOT EXISTS "{0}_config"
-        (option VARCHAR,
-        value VARCHAR);
+        async with self.acquire() as conn:
+            if not await conn.fetch(LEGACY_TABLES):
+                return False
 
-        INSERT INTO "{0}_config"
-        (option)
-        VALUES
-        ('chan_whitelist'),
-        ('group_category'),
-        ('announce_chan'),
-        ('role_whitelist'),
-        ('quest_tiers');
-        """.format(guild_id))
+            if await conn.fetchval(
+                    "SELECT to_regclass('schema_version');") is None:
+                return True
 
-        await self.tr.commit()
+            return not await conn.fetchval("""
+            SELECT EXISTS (SELECT 1 FROM schema_version WHERE scope = $1);
+            """, LEGACY_SCOPE)
 
     async def retrieve_group_info(self,
                                   guild_id,
@@ -72,40 +993,228 @@ class pgSQLManagement:
         info about said group.
         """
 
-        await self.connect()
-
-        group = list(await self.conn.fetch("""
-        SELECT id, max_users, members, creator
-        FROM "{}_groups"
-        WHERE id = $1""".format(guild_id), int(group_id)))
+        async with self.acquire() as conn:
+            group = list(await conn.fetch(
+                self.query(conn, 'retrieve_group_info'),
+                guild_id, int(group_id)))
 
         return group
 
     async def join_group(self,
                          guild_id,
                          group_id,
-                         author,
-                         new_max):
+                         user_id):
+        """
+        Allows a user to join a group if it's not full, in one statement.
+
+        Returns None if the group doesn't exist, otherwise a record with
+        joined, is_member, member_count and max_users.
+        """
+
+        async with self.acquire() as conn:
+            result = await conn.fetchrow(
+                self.query(conn, 'join_group'),
+                guild_id, user_id, int(group_id))
+
+        if result is not None and result['joined']:
+            self.cache.invalidate('groups', guild_id)
+
+        return result
+
+    async def join_group_batch(self,
+                               guild_id,
+                               message_id,
+                               user_ids):
+        """
+        Joins several users to the group announced by message_id in one
+        statement, in order, until it's full.
+
+        Returns None if nobody joined, otherwise a record with the group's
+        id and the list of user IDs that joined.
         """
-        Allows a member to join a group if it's not full.
+
+        async with self.acquire() as conn:
+            result = await conn.fetchrow(
+                self.query(conn, 'join_group_batch'),
+                guild_id, message_id, user_ids)
+
+        if result is not None:
+            self.cache.invalidate('groups', guild_id)
+
+        return result
+
+    async def leave_group_batch(self,
+                                guild_id,
+                                message_id,
+                                user_ids):
+        """
+        Removes several users from the group announced by message_id.
+
+        Returns None if nobody left, otherwise a record with the group's
+        id and the list of user IDs that left.
         """
 
-        await self.connect()
+        async with self.acquire() as conn:
+            result = await conn.fetchrow(
+                self.query(conn, 'leave_group_batch'),
+                guild_id, message_id, user_ids)
 
-        await self.conn.execute("""
-        UPDATE "{}_groups"
-        SET members =
-        array_append(members, $1)
-        WHERE id = $2;
-        """.format(guild_id), author, int(group_id))
+        if result is not None:
+            self.cache.invalidate('groups', guild_id)
 
-        await self.conn.execute("""
-        UPDATE "{}_groups"
-        SET max_users = $1
-        WHERE id = $2;
-        """.format(guild_id), new_max, int(group_id))
+        return result
 
-        await self.tr.commit()
+    async def leave_group(self,
+                          guild_id,
+                          group_id,
+                          user_id):
+        """
+        Removes a user from a group, in one statement.
+
+        Returns None if the group doesn't exist, otherwise a record with
+        left, member_count and max_users.
+        """
+
+        async with self.acquire() as conn:
+            result = await conn.fetchrow(
+                self.query(conn, 'leave_group'),
+                guild_id, user_id, int(group_id))
+
+        if result is not None and result['left']:
+            self.cache.invalidate('groups', guild_id)
+
+        return result
+
+    async def migrate_group_members(self, guild_ids, resolve):
+        """
+        Moves the names in the members arrays of older groups to
+        group_members. resolve(guild_id, name) returns the user ID of a
+        name, or None; names it can't resolve stay in the array and keep
+        their place in member_count.
+
+        Returns how many members were moved.
+        """
+
+        moves = []
+        async with self.acquire() as conn:
+            for group in await conn.fetch(
+                    self.query(conn, 'legacy_group_members'), guild_ids):
+                resolved = {}
+                for name in group['members']:
+                    user_id = resolve(group['guild_id'], name)
+                    if user_id is not None:
+                        resolved[name] = user_id
+
+                if resolved:
+                    moves.append((group['guild_id'], group['id'],
+                                  list(set(resolved.values())),
+                                  list(resolved)))
+
+            if moves:
+                async with conn.transaction():
+                    await conn.executemany(
+                        self.query(conn, 'move_group_members'), moves)
+
+        for guild_id in {move[0] for move in moves}:
+            self.cache.invalidate('groups', guild_id)
+
+        return sum(len(move[3]) for move in moves)
+
+    async def set_group_objects(self,
+                                guild_id,
+                                group_id,
+                                role_id,
+                                text_channel_id,
+                                voice_channel_id,
+                                announce_message_id):
+        """
+        Records the IDs of a group's role, channels and announcement.
+        """
+
+        async with self.acquire() as conn:
+            await conn.execute(
+                self.query(conn, 'set_group_objects'),
+                guild_id, int(group_id), role_id, text_channel_id,
+                voice_channel_id, announce_message_id)
+
+    async def retrieve_guild_config(self, guild_ids):
+        """
+        Returns every option the given guilds have set.
+        """
+
+        async with self.acquire() as conn:
+            results = list(await conn.fetch(
+                self.query(conn, 'retrieve_guild_config'),
+                guild_ids))
+
+        return results
+
+    async def set_guild_config(self, guild_id, option, value):
+        """
+        Sets one of a guild's options. None unsets it.
+        """
+
+        async with self.acquire() as conn:
+            await conn.execute(
+                self.query(conn, 'set_guild_config'),
+                guild_id, option, value)
+
+    async def retrieve_group_objects(self, guild_ids):
+        """
+        Returns the Discord object IDs of every group in the given guilds.
+        """
+
+        async with self.acquire() as conn:
+            results = list(await conn.fetch(
+                self.query(conn, 'retrieve_group_objects'),
+                guild_ids))
+
+        return results
+
+    async def retrieve_upcoming_groups(self, since, guild_ids):
+        """
+        Returns the guild, ID and start date of every group in the given
+        guilds starting on or after since.
+        """
+
+        async with self.acquire() as conn:
+            results = list(await conn.fetch(
+                self.query(conn, 'retrieve_upcoming_groups'),
+                since, guild_ids))
+
+        return results
+
+    async def expired_groups(self, before, guild_ids, limit):
+        """
+        Returns up to limit groups of the given guilds (or of every guild
+        if guild_ids is None) that started before the date before, without
+        changing anything.
+        """
+
+        async with self.acquire() as conn:
+            results = list(await conn.fetch(
+                self.query(conn, 'expired_groups'),
+                before, guild_ids, limit))
+
+        return results
+
+    async def archive_groups(self, before, guild_ids, limit):
+        """
+        Moves up to limit groups of the given guilds (or of every guild if
+        guild_ids is None) that started before the date before to
+        groups_archive, in one transaction. Returns the moved groups with
+        the IDs of their Discord objects.
+        """
+
+        async with self.acquire() as conn:
+            results = list(await conn.fetch(
+                self.query(conn, 'archive_groups'),
+                before, guild_ids, limit))
+
+        for guild_id in {row['guild_id'] for row in results}:
+            self.cache.invalidate('groups', guild_id)
+
+        return results
 
     async def import_group_data(self,
                                 guild_id,
@@ -117,43 +1226,123 @@ class pgSQLManagement:
         Takes input from app.py and imports it into the groups table.
         """
 
-        await self.connect()
-
         # Convert date string to datetime
         date = datetime.datetime.strptime(start_date, '%Y-%m-%d')
 
-        group_id = await self.conn.fetch("""
-        INSERT INTO "{0}_groups"(creator, start_date, max_users, notes)
-        VALUES ($1::varchar, $2::date, $3::varchar, $4::varchar)
-        returning id;
-        """.format(guild_id),
-                                creator,
-                                date, "0/{}".format(max_users),
-                                group_notes)
+        async with self.acquire() as conn:
+            group_id = await conn.fetchval(
+                self.query(conn, 'import_group_data'),
+                guild_id, creator, date, int(max_users), group_notes)
+
+        self.cache.invalidate('groups', guild_id)
+
+        return group_id
+
+    async def _retrieve_list(self,
+                             guild_id,
+                             list_filter,
+                             after=None,
+                             before=None,
+                             limit=None):
+        """
+        Runs the list query of a Filter, and returns the rows in the
+        filter's order.
+        """
+
+        name = list_query(list_filter.shape(), after, before)
+
+        args = [guild_id] + list_filter.args()
+        cursor = before if before is not None else after
+        if isinstance(cursor, tuple):
+            args.extend(cursor)
+        elif cursor is not None:
+            args.append(cursor)
+        args.append(limit)
+
+        async with self.acquire() as conn:
+            results = list(await conn.fetch(self.query(conn, name), *args))
+
+        if before is not None:
+            results.reverse()
+
+        return results
+
+    async def check_indexes(self):
+        """
+        EXPLAINs every shape of the list queries with sequential scans
+        disabled, and returns (name, plan nodes, uses_index) for each.
+
+        A query that still plans a Seq Scan over quests or groups has no
+        index it can use.
+        """
 
-        await self.tr.commit()
+        report = []
 
-        print(group_id)
-        return group_id[0][0]
+        async with self.acquire() as conn:
+            for table, checks in INDEX_CHECKS.items():
+                for check in checks:
+                    list_filter = filters.parse(table, check.split())
+                    field = filters.FIELDS[table][list_filter.sort]
+                    cursor = field.parse(CURSOR_SAMPLES[list_filter.sort])
+                    if list_filter.sort != 'id':
+                        cursor = (cursor, 1)
+
+                    for after, before in [(None, None), (cursor, None),
+                                          (None, cursor)]:
+                        name = list_query(list_filter.shape(), after, before)
+
+                        args = [0] + list_filter.args()
+                        if after is not None or before is not None:
+                            args.extend(cursor if isinstance(cursor, tuple)
+                                        else (cursor,))
+                        args.append(5)
+
+                        async with conn.transaction():
+                            await conn.execute("SET LOCAL enable_seqscan = off")
+                            plan = await conn.fetchval(
+                                "EXPLAIN (FORMAT JSON) " + QUERIES[name],
+                                *args)
+
+                        nodes = list(plan_nodes(json.loads(plan)[0]['Plan']))
+                        uses_index = not any(
+                            node['Node Type'] == 'Seq Scan' and
+                            node.get('Relation Name', '').startswith(table)
+                            for node in nodes)
+
+                        report.append((name,
+                                       [node['Node Type'] for node in nodes],
+                                       uses_index))
+
+        return report
 
     async def retrieve_group_list(self,
                                   guild_id,
-                                  value_id,
-                                  value_creator):
+                                  list_filter=None,
+                                  after=None,
+                                  before=None,
+                                  limit=None):
         """
-        Takes a group ID, creator, or neither and returns
-        a list of matched groups.
+        Returns the groups matched by a Filter from filters.parse(), or
+        every group if list_filter is None.
+
+        Pass limit with after (the cursor of the last row of the previous
+        page) or before (the cursor of the first row of the next page) to
+        fetch one page. See Filter.cursor().
         """
 
-        await self.connect()
+        if list_filter is None:
+            list_filter = filters.parse('groups', ())
 
-        results = list(await self.conn.fetch("""
-        SELECT id, creator, start_date, max_users, notes
-        FROM "{0}_groups"
-        WHERE
-        ($1::integer is null or id = $1::integer) AND
-        ($2::varchar is null or creator = $2::varchar);
-        """.format(guild_id), value_id, value_creator))
+        key = ('groups', guild_id, list_filter, after, before, limit)
+        results = self.cache.get(key)
+        if results is not None:
+            return results
+
+        version = self.cache.version('groups', guild_id)
+        results = await self._retrieve_list(guild_id, list_filter, after,
+                                            before, limit)
+
+        self.cache.set(key, results, version)
 
         return results
 
@@ -165,14 +1354,12 @@ class pgSQLManagement:
         the database after closing it.
         """
 
-        await self.connect()
-
-        await self.conn.execute("""
-        DELETE FROM "{}_groups"
-        WHERE id = $1;
-        """.format(guild_id), int(group_id))
+        async with self.acquire() as conn:
+            await conn.execute(
+                self.query(conn, 'delete_group'),
+                guild_id, int(group_id))
 
-        await self.tr.commit()
+        self.cache.invalidate('groups', guild_id)
 
     async def import_quest_data(self,
                                 guild_id,
@@ -183,15 +1370,76 @@ class pgSQLManagement:
         Takes input from app.py and imports it into the quests table.
         """
 
-        await self.connect()
+        async with self.acquire() as conn:
+            await conn.execute(
+                self.query(conn, 'import_quest_data'),
+                guild_id, quest_tier, quest_desc, creator)
+
+        self.cache.invalidate('quests', guild_id)
+
+    async def import_quests(self, guild_id, records):
+        """
+        Adds many quests at once with a single COPY. records are
+        (tier, description, creator, completed) tuples. Returns the
+        number of quests added.
+        """
+
+        async with self.acquire() as conn:
+            await conn.copy_records_to_table(
+                'quests',
+                records=[(guild_id,) + tuple(record) for record in records],
+                columns=QUEST_IMPORT_COLUMNS)
+
+        self.cache.invalidate('quests', guild_id)
+
+        return len(records)
+
+    async def export_quests(self, guild_id, output):
+        """
+        Streams every quest of a guild to output as CSV with a header.
+        output is a binary file or a coroutine function called with each
+        chunk, as for asyncpg's copy_from_query().
+        """
+
+        async with self.acquire() as conn:
+            await conn.copy_from_query(
+                QUERIES['export_quests'], guild_id,
+                output=output, format='csv', header=True)
+
+    async def search_quests(self, guild_id, text, limit=10):
+        """
+        Returns up to limit open quests whose descriptions match text,
+        best first, as (id, tier, creator, snippet) with the matched
+        words in bold.
+
+        text is a web search style query: phrases in quotes, -word to
+        leave a word out. If nothing matches and pg_trgm is installed,
+        quests with words similar to text are returned instead, to get
+        past typos.
+        """
+
+        key = ('quests', guild_id, 'search', text, limit)
+        results = self.cache.get(key)
+        if results is not None:
+            return results
 
-        await self.conn.execute(
-            """
-        INSERT INTO "{}_quests" (tier, description, creator, completed)
-        VALUES ($1, $2, $3, False);
-        """.format(guild_id), quest_tier, quest_desc, creator)
+        version = self.cache.version('quests', guild_id)
+        async with self.acquire() as conn:
+            results = list(await conn.fetch(
+                self.query(conn, 'search_quests'),
+                guild_id, text, limit, SEARCH_HEADLINE))
 
-        await self.tr.commit()
+            if not results and self.fuzzy_search:
+                try:
+                    results = list(await conn.fetch(
+                        self.query(conn, 'search_quests_fuzzy'),
+                        guild_id, text, limit))
+                except asyncpg.UndefinedFunctionError:
+                    self.fuzzy_search = False
+
+        self.cache.set(key, results, version)
+
+        return results
 
     async def delete_quest(self,
                            guild_id,
@@ -200,13 +1448,12 @@ class pgSQLManagement:
         Deletes a quest from the quests table.
         """
 
-        await self.connect()
+        async with self.acquire() as conn:
+            await conn.execute(
+                self.query(conn, 'delete_quest'),
+                guild_id, int(quest_id))
 
-        await self.conn.execute("""
-        DELETE FROM "{}_quests"
-        WHERE id = $1;""".format(guild_id), int(quest_id))
-
-        await self.tr.commit()
+        self.cache.invalidate('quests', guild_id)
 
     async def complete_quest(self,
                              guild_id,
@@ -216,41 +1463,38 @@ class pgSQLManagement:
         Sets a quest as "complete"
         """
 
-        await self.connect()
-
-        await self.conn.execute(
-            """
-        UPDATE "{}_quests"
-        SET completed = $1::bool
-        WHERE id = $2::integer;
-        """.format(guild_id), completion, int(quest_id))
+        async with self.acquire() as conn:
+            await conn.execute(
+                self.query(conn, 'complete_quest'),
+                guild_id, completion, int(quest_id))
 
-        await self.tr.commit()
+        self.cache.invalidate('quests', guild_id)
 
     async def retrieve_quest_data(self,
                                   guild_id,
-                                  value_id,
-                                  value_tier,
-                                  value_creator):
+                                  list_filter=None,
+                                  after=None,
+                                  before=None,
+                                  limit=None):
         """
-        Retrieves information about a quest based on user input.
+        Returns the open quests matched by a Filter, or every open quest
+        if list_filter is None.
+
+        Paged the same way as retrieve_group_list.
         """
 
-        await self.connect()
+        if list_filter is None:
+            list_filter = filters.parse('quests', ())
 
-        if value_id is not None:
-            id = int(value_id)
-        else:
-            id = None
+        key = ('quests', guild_id, list_filter, after, before, limit)
+        results = self.cache.get(key)
+        if results is not None:
+            return results
 
-        results = list(await self.conn.fetch("""
-        SELECT id, tier, creator, description
-        FROM "{}_quests"
-        WHERE
-        completed = 'f' AND
-        ($1::integer is null or id = $1::integer) AND
-        ($2::varchar is null or tier = $2::varchar) AND
-        ($3::varchar is null or creator = $3::varchar)
-        """.format(guild_id), id, value_tier, value_creator))
+        version = self.cache.version('quests', guild_id)
+        results = await self._retrieve_list(guild_id, list_filter, after,
+                                            before, limit)
+
+        self.cache.set(key, results, version)
 
         return results
@@ -0,0 +1,171 @@
+"""
+Creates the Discord side of a group: role, channels and announcement.
+"""
+
+import asyncio
+import discord
+
+join_emoji = "\N{WHITE HEAVY CHECK MARK}"
+
+
+class RouteLimiter:
+    """
+    Queues Discord calls per rate-limit route.
+
+    A route is a tuple such as ('channels', guild_id). Each route allows
+    concurrency calls in flight at once and starts them at least interval
+    seconds apart, so a burst of work doesn't run into 429s that
+    discord.py would then have to sleep off.
+    """
+
+    def __init__(self, concurrency=2, interval=0.25):
+        self.concurrency = concurrency
+        self.interval = interval
+
+        self._semaphores = {}
+        self._next_start = {}
+
+    async def run(self, route, function, *args, **kwargs):
+        """
+        Awaits function(*args, **kwargs) once route has room for it.
+        """
+
+        semaphore = self._semaphores.get(route)
+        if semaphore is None:
+            semaphore = self._semaphores[route] = asyncio.Semaphore(
+                self.concurrency)
+
+        async with semaphore:
+            loop = asyncio.get_event_loop()
+            delay = self._next_start.get(route, 0) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_start[route] = loop.time() + self.interval
+
+            return await function(*args, **kwargs)
+
+
+class Provisioned:
+    """
+    Remembers every Discord object created for a group, with the route to
+    delete it through, so a failed group can be torn down again.
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.ids = {}
+
+        self._objects = []
+
+    async def create(self, key, route, function, *args, **kwargs):
+        """
+        Creates an object through the limiter and records its ID as key.
+        """
+
+        created = await self.limiter.run(route, function, *args, **kwargs)
+        self.ids[key] = created.id
+        self._objects.append((route, created))
+        return created
+
+    async def rollback(self, reason):
+        """
+        Deletes everything that was created, newest first.
+        """
+
+        async def delete(route, created):
+            try:
+                if isinstance(created, discord.Message):
+                    await self.limiter.run(route, created.delete)
+                else:
+                    await self.limiter.run(route, created.delete,
+                                           reason=reason)
+            except discord.NotFound:
+                pass
+
+        await asyncio.gather(*[delete(route, created)
+                               for route, created in reversed(self._objects)],
+                             return_exceptions=True)
+        self._objects = []
+
+
+async def provision_group(limiter,
+                          ctx,
+                          group_id,
+                          category_id,
+                          announce_channel_id,
+                          embed,
+                          announced=None):
+    """
+    Creates a group's role, text and voice channels and announcement.
+
+    Both channels are created at the same time once the role exists. The
+    announcement is posted last, so nobody can react to it before there's
+    a role to give them, and announced, if given, is called with the IDs
+    as soon as it's posted. If any step fails, everything created so far
+    is deleted and the exception is raised. Returns the IDs of the
+    created objects.
+    """
+
+    guild = ctx.guild
+    name = "group-{}".format(group_id)
+    reason = "Automated role creation, requested by {}".format(ctx.author)
+
+    provisioned = Provisioned(limiter)
+
+    async def role_and_channels():
+        role = await provisioned.create(
+            'role_id', ('roles', guild.id), guild.create_role,
+            name=name, mentionable=True, reason=reason)
+
+        overwrites = {
+            guild.default_role: discord.PermissionOverwrite(
+                read_messages=False),
+            role: discord.PermissionOverwrite(
+                read_messages=True)
+        }
+        category = guild.get_channel(category_id)
+
+        check(await asyncio.gather(
+            limiter.run(('member_roles', guild.id),
+                        ctx.author.add_roles, role),
+            provisioned.create(
+                'text_channel_id', ('channels', guild.id),
+                guild.create_text_channel, name + "-text",
+                category=category, overwrites=overwrites, reason=reason),
+            provisioned.create(
+                'voice_channel_id', ('channels', guild.id),
+                guild.create_voice_channel, name + "-voice",
+                category=category, overwrites=overwrites, reason=reason),
+            return_exceptions=True))
+
+    async def announce():
+        channel = guild.get_channel(announce_channel_id)
+        message = await provisioned.create(
+            'announce_message_id', ('messages', channel.id),
+            channel.send, embed=embed)
+        if announced is not None:
+            announced(provisioned.ids)
+        await limiter.run(('reactions', channel.id),
+                          message.add_reaction, join_emoji)
+
+    try:
+        await role_and_channels()
+        await announce()
+    except Exception:
+        await provisioned.rollback("Group {} could not be created."
+                                   .format(group_id))
+        raise
+
+    return provisioned.ids
+
+
+def check(results):
+    """
+    Raises the first exception in a gather(return_exceptions=True) result.
+    """
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+    return results
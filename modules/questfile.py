@@ -0,0 +1,103 @@
+"""
+Reading and checking quest files for !questimport.
+
+A quest file is a CSV file with a header row, or a YAML list of
+mappings. Both have the columns tier and description, and optionally
+creator and completed, the same columns !questexport writes.
+"""
+
+import io
+import csv
+import yaml
+import numpy as np
+
+COLUMNS = ['tier', 'description', 'creator', 'completed']
+
+# Most words in a description; questadd takes fewer than 100.
+MAX_DESCRIPTION_WORDS = 99
+
+TRUE = {'true', 't', 'yes', 'y', '1'}
+FALSE = {'false', 'f', 'no', 'n', '0', ''}
+
+
+class QuestFileError(ValueError):
+    """
+    Raised for files that can't be read as quests.
+    """
+
+
+def read_quests(filename, data):
+    """
+    Parses the bytes of a quest file into a list of dictionaries.
+    """
+
+    text = data.decode('utf-8-sig')
+    name = filename.lower()
+
+    if name.endswith('.csv'):
+        reader = csv.DictReader(io.StringIO(text))
+        if reader.fieldnames is None:
+            raise QuestFileError("The file is empty.")
+        reader.fieldnames = [field.strip().lower()
+                             for field in reader.fieldnames]
+        rows = list(reader)
+    elif name.endswith(('.yaml', '.yml')):
+        try:
+            rows = yaml.safe_load(text) or []
+        except yaml.YAMLError as e:
+            raise QuestFileError("Could not parse the file: {}".format(e))
+        if not isinstance(rows, list) or \
+                not all(isinstance(row, dict) for row in rows):
+            raise QuestFileError("The file should be a list of quests.")
+    else:
+        raise QuestFileError("Quest files should be .csv or .yaml.")
+
+    for column in ('tier', 'description'):
+        if rows and column not in rows[0]:
+            raise QuestFileError("The file has no {} column.".format(column))
+
+    return rows
+
+
+def check_quests(rows, tiers, creator):
+    """
+    Validates every row at once and turns them into records for the
+    quests table. Returns (records, errors); errors lists the number
+    (counting from 1) and problem of every invalid row, and the records
+    should only be used if there are none.
+    """
+
+    tier = np.array([str(row.get('tier') or '').strip() for row in rows],
+                    dtype=str)
+    description = np.array([str(row.get('description') or '').strip()
+                            for row in rows], dtype=str)
+    completed = np.char.lower(np.array(
+        [str(row.get('completed') or '').strip() for row in rows], dtype=str))
+
+    words = np.array([len(text.split()) for text in description],
+                     dtype=int)
+
+    tiers = [str(name) for name in tiers]
+
+    problems = [
+        (~np.isin(tier, tiers), "tier not in {}".format(", ".join(tiers))),
+        (words > MAX_DESCRIPTION_WORDS,
+         "description longer than {} words".format(MAX_DESCRIPTION_WORDS)),
+        (description == '', "no description"),
+        (~np.isin(completed, list(TRUE | FALSE)),
+         "completed should be true or false"),
+    ]
+
+    errors = []
+    for mask, problem in problems:
+        for index in np.flatnonzero(mask):
+            errors.append((int(index) + 1, problem))
+    errors.sort()
+
+    records = [(str(tier[index]),
+                str(description[index]),
+                str(row.get('creator') or '').strip() or creator,
+                completed[index] in TRUE)
+               for index, row in enumerate(rows)]
+
+    return records, errors
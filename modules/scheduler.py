@@ -0,0 +1,183 @@
+"""
+Session reminders for vishnu.
+"""
+
+import time
+import heapq
+import asyncio
+import datetime
+import traceback
+from modules.config import config
+
+# Reminders that were due up to this many seconds ago are still sent,
+# older ones (the bot was offline) are skipped.
+GRACE = 300
+
+# Longest single sleep, so a changed system clock is noticed eventually.
+MAX_SLEEP = 3600
+
+
+class ReminderScheduler:
+    """
+    Pings each group's role in its text channel some hours before the
+    session starts.
+
+    Every upcoming reminder sits in one min-heap ordered by due time, and
+    a single task sleeps until the earliest is due. add() and remove()
+    keep the heap current as groups are created and closed; a removed
+    group's entries stay in the heap and are skipped when they come up.
+
+    Sessions start at reminders.session_time (UTC) on their start date,
+    and a reminder is sent reminders.before hours ahead of it, both from
+    config.yaml and read on startup.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+
+        settings = config.get('reminders') or {}
+        hour, minute = str(settings.get('session_time', '18:00')).split(':')
+        self.session_time = datetime.time(int(hour), int(minute))
+        self.before = sorted(settings.get('before', [24, 1]), reverse=True)
+
+        self._heap = []
+        self._sessions = {}
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def session_start(self, start_date):
+        """
+        Returns the UNIX time a session on start_date starts.
+        """
+
+        start = datetime.datetime.combine(start_date, self.session_time)
+        return start.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    def entries(self, guild_id, group_id, start, now):
+        """
+        Returns the heap entries of the reminders of a session that
+        aren't past yet.
+        """
+
+        return [(start - hours * 3600, guild_id, group_id, start, hours)
+                for hours in self.before
+                if start - hours * 3600 > now - GRACE]
+
+    async def load(self):
+        """
+        Schedules every upcoming session of the bot's guilds, replacing
+        whatever was scheduled before.
+        """
+
+        rows = await self.bot.pg.retrieve_upcoming_groups(
+            datetime.datetime.utcnow().date() - datetime.timedelta(days=1),
+            [guild.id for guild in self.bot.guilds])
+
+        now = time.time()
+        self._sessions = {}
+        self._heap = []
+        for row in rows:
+            start = self.session_start(row['start_date'])
+            entries = self.entries(row['guild_id'], row['id'], start, now)
+            if entries:
+                self._sessions[(row['guild_id'], row['id'])] = start
+                self._heap.extend(entries)
+        heapq.heapify(self._heap)
+
+        self._wake.set()
+
+    def add(self, guild_id, group_id, start_date):
+        """
+        Schedules the reminders of a new (or moved) session.
+        """
+
+        start = self.session_start(start_date)
+        entries = self.entries(guild_id, int(group_id), start, time.time())
+        if not entries:
+            self._sessions.pop((guild_id, int(group_id)), None)
+            return
+
+        self._sessions[(guild_id, int(group_id))] = start
+        for entry in entries:
+            heapq.heappush(self._heap, entry)
+
+        self._wake.set()
+
+    def remove(self, guild_id, group_id):
+        """
+        Cancels the reminders of a session.
+        """
+
+        self._sessions.pop((guild_id, int(group_id)), None)
+
+        # Drop the cancelled entries once they make up most of the heap.
+        if len(self._heap) > 2 * len(self.before) * len(self._sessions) + 64:
+            self._heap = [entry for entry in self._heap
+                          if self._sessions.get(entry[1:3]) == entry[3]]
+            heapq.heapify(self._heap)
+
+    def start(self):
+        """
+        Starts the scheduler task, if it isn't running yet.
+        """
+
+        if self._task is None or self._task.done():
+            self._task = self.bot.loop.create_task(self.run())
+
+    async def run(self):
+        while True:
+            self._wake.clear()
+            now = time.time()
+
+            while self._heap and self._heap[0][0] <= now:
+                due, guild_id, group_id, start, hours = heapq.heappop(
+                    self._heap)
+
+                key = (guild_id, group_id)
+                if self._sessions.get(key) != start:
+                    continue
+                if hours == self.before[-1]:
+                    del self._sessions[key]
+                if due < now - GRACE:
+                    continue
+
+                asyncio.ensure_future(self.remind(guild_id, group_id,
+                                                  start, hours))
+
+            timeout = None
+            if self._heap:
+                timeout = min(self._heap[0][0] - now, MAX_SLEEP)
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def remind(self, guild_id, group_id, start, hours):
+        """
+        Sends one reminder to a group's text channel.
+        """
+
+        try:
+            objects = self.bot.groups.group(guild_id, group_id)
+            guild = self.bot.get_guild(guild_id)
+            if objects is None or guild is None:
+                return
+
+            channel = guild.get_channel(objects.text_channel_id)
+            if channel is None:
+                return
+
+            role = guild.get_role(objects.role_id)
+            when = datetime.datetime.fromtimestamp(
+                start, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M')
+
+            await channel.send("{}The session starts in {:g} hour{}, at {} UTC."
+                               .format(role.mention + " " if role else "",
+                                       hours, "" if hours == 1 else "s",
+                                       when))
+        except Exception:
+            traceback.print_exc()
@@ -0,0 +1,159 @@
+"""
+Startup timing for vishnu.
+
+The timeline records how long each step of startup took, counted from
+when this module was first imported, and is printed once the bot is
+ready. With --profile-imports, app.py also installs an ImportTimer
+before importing anything else, and the slowest imports are printed
+with the timeline.
+
+This module is imported before everything else, so it only uses the
+standard library.
+"""
+
+import sys
+import time
+import threading
+import importlib
+import importlib.abc
+
+
+class Timeline:
+    """
+    Seconds since startup at each step.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.events = []
+        self.finished = False
+
+    def mark(self, event):
+        if not self.finished:
+            self.events.append((time.perf_counter() - self.started, event))
+
+    def finish(self):
+        """
+        Stops recording and returns the report.
+        """
+
+        self.finished = True
+        return self.report()
+
+    def report(self):
+        """
+        Returns the steps so far, one per line, with the time each took.
+        """
+
+        lines = []
+        previous = 0.0
+        for elapsed, event in self.events:
+            lines.append("{:8.3f}s {:+8.3f}s  {}".format(
+                elapsed, elapsed - previous, event))
+            previous = elapsed
+        return "\n".join(lines)
+
+
+class TimedLoader:
+    """
+    Wraps a module loader, timing exec_module() for an ImportTimer.
+    """
+
+    def __init__(self, loader, timer):
+        self._loader = loader
+        self._timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._timer.run(module.__name__, self._loader.exec_module, module)
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    """
+    Records how long every module imported after install() takes to run,
+    on its own and including the modules it imports in turn.
+    """
+
+    def __init__(self):
+        # Module name: (own seconds, cumulative seconds).
+        self.times = {}
+
+        # Per thread, the time spent importing the children of each
+        # module being imported.
+        self._local = threading.local()
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+
+        if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+            spec.loader = TimedLoader(spec.loader, self)
+        return spec
+
+    def run(self, name, exec_module, module):
+        stack = self._local.__dict__.setdefault('children', [])
+
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            exec_module(module)
+        finally:
+            total = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += total
+            self.times[name] = (total - children, total)
+
+    def report(self, limit=15):
+        """
+        Returns the limit slowest top-level packages and the slowest
+        modules on their own, one per line.
+        """
+
+        packages = sorted(((total, name)
+                           for name, (own, total) in self.times.items()
+                           if '.' not in name), reverse=True)
+        modules = sorted(((own, name)
+                          for name, (own, total) in self.times.items()),
+                         reverse=True)
+
+        lines = ["Slowest packages (with their imports):"]
+        lines += ["{:8.3f}s  {}".format(total, name)
+                  for total, name in packages[:limit]]
+        lines.append("Slowest modules (on their own):")
+        lines += ["{:8.3f}s  {}".format(own, name)
+                  for own, name in modules[:limit]]
+        return "\n".join(lines)
+
+
+def warm(loop, names):
+    """
+    Imports the modules that were left out of startup in a thread, so
+    the first command that needs one doesn't wait for it.
+    """
+
+    def import_all():
+        for name in names:
+            try:
+                importlib.import_module(name)
+            except ImportError as e:
+                print("Could not import {}: {}".format(name, e))
+
+    return loop.run_in_executor(None, import_all)
+
+
+timeline = Timeline()
@@ -0,0 +1,98 @@
+"""
+Fixed-width tables for the quest and group lists.
+
+A Table lays rows out in columns inside a code block, wrapping cells
+that are wider than their column allows, and packs as many rows as fit
+into one Discord message.
+"""
+
+import textwrap
+
+# Longest message Discord accepts.
+MESSAGE_LIMIT = 2000
+
+# Lines a wrapped cell is cut to, so any one row fits in a message.
+MAX_CELL_LINES = 4
+
+COLUMN_GAP = "  "
+
+
+class Table:
+    """
+    columns are (heading, widest) pairs, widest being the most
+    characters a line of that column takes before wrapping.
+    """
+
+    def __init__(self, columns):
+        self.headings = [heading for heading, widest in columns]
+        self.widest = [widest for heading, widest in columns]
+
+    def cells(self, row):
+        # Backticks would close the code block.
+        return ["" if value is None else str(value).replace("`", "'")
+                for value in row]
+
+    def widths(self, rows):
+        """
+        Returns the width of each column: its longest cell or heading,
+        up to its widest.
+        """
+
+        widths = [len(heading) for heading in self.headings]
+        for row in rows:
+            for column, cell in enumerate(row):
+                length = min(len(cell), self.widest[column])
+                if length > widths[column]:
+                    widths[column] = length
+        return widths
+
+    def lines(self, cells, widths):
+        """
+        Returns the lines of one row, wrapping cells that don't fit.
+        """
+
+        wrapped = [textwrap.wrap(cell, width, max_lines=MAX_CELL_LINES,
+                                 placeholder="...") or [""]
+                   if len(cell) > width else [cell]
+                   for cell, width in zip(cells, widths)]
+
+        return [COLUMN_GAP.join(
+            (parts[line] if line < len(parts) else "").ljust(width)
+            for parts, width in zip(wrapped, widths)).rstrip()
+            for line in range(max(len(parts) for parts in wrapped))]
+
+    def pack(self, rows, footer="", limit=MESSAGE_LIMIT):
+        """
+        Renders as many of rows as fit in limit characters, always at
+        least one, and returns the message and how many rows it shows.
+        footer goes after the code block.
+        """
+
+        rows = [self.cells(row) for row in rows]
+        widths = self.widths(rows)
+
+        lines = self.lines(self.headings, widths)
+        lines.append(COLUMN_GAP.join("-" * width for width in widths))
+
+        # The code block fences and the newlines between lines.
+        length = len("``````") + len(footer) + sum(
+            len(line) + 1 for line in lines) - 1
+
+        shown = 0
+        for row in rows:
+            row_lines = self.lines(row, widths)
+            row_length = sum(len(line) + 1 for line in row_lines)
+            if shown and length + row_length > limit:
+                break
+            lines.extend(row_lines)
+            length += row_length
+            shown += 1
+
+        return "```{}```{}".format("\n".join(lines), footer), shown
+
+
+QUESTS = Table([('ID', 6), ('TIER', 12), ('CREATOR', 18),
+                ('DESCRIPTION', 36)])
+
+GROUPS = Table([('ID', 6), ('CREATOR', 18), ('START DATE', 10),
+                ('MAX USERS', 9), ('NOTES', 27)])